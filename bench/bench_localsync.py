@@ -0,0 +1,84 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+Compare local_engine = native (LocalSync) with forking rsync, for
+server = localhost transfers.
+
+Builds a weewx like tree, many small html/NOAA files and some larger
+images, in a temporary directory, then times each engine for a first copy,
+a pass with nothing changed and a pass with a few files changed.
+
+Run from the top of the source tree, with weewx importable, eg:
+    PYTHONPATH=/usr/share/weewx python3 bench/bench_localsync.py [files]
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+import user.rsynctransfer as rsynctransfer
+from benchtree import make_tree
+
+
+def touch_some(root, n):
+    changed = 0
+    for (dirpath, _, filenames) in os.walk(root):
+        for name in filenames:
+            if changed >= n:
+                return
+            with open(os.path.join(dirpath, name), 'a') as f:
+                f.write("changed\n")
+            changed += 1
+
+
+def native(src, dst):
+    rsynctransfer.LocalSync([src + os.sep], dst, delete=True).run()
+
+
+def forked(src, dst):
+    subprocess.check_call(['rsync', '-a', '--delete', '--stats',
+                           src + os.sep, dst], stdout=subprocess.DEVNULL)
+
+
+def timed(func, *args):
+    t1 = time.time()
+    func(*args)
+    return time.time() - t1
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    engines = [('native', native)]
+    if shutil.which('rsync'):
+        engines.append(('rsync', forked))
+    else:
+        print("rsync not found, timing the native engine only")
+    work = tempfile.mkdtemp(prefix='rsynct-bench-')
+    try:
+        src = os.path.join(work, 'src')
+        make_tree(src, files, random.Random(1))
+        print("%s files" % files)
+        print("%-8s %10s %10s %10s" % ('engine', 'first', 'unchanged', 'changed'))
+        for (name, func) in engines:
+            dst = os.path.join(work, name)
+            first = timed(func, src, dst)
+            unchanged = timed(func, src, dst)
+            touch_some(src, 20)
+            changed = timed(func, src, dst)
+            print("%-8s %9.3fs %9.3fs %9.3fs" % (name, first, unchanged, changed))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+Benchmark rsynctransfer, end to end, through Rsynct.
+
+Builds a weewx like HTML_ROOT (thousands of small html/NOAA files, png
+plots) and an archive database, then, for each case, has Rsynct send it
+three times; a first copy, a pass with nothing changed and a pass after
+a report cycle's worth of churn (pages and plots rewritten, new archive
+records). The localhost cases copy to a directory here, the link cases
+go through slowlink.py, put on the PATH as ssh, a link to this same
+machine with latency and a bandwidth limit. Nothing leaves the machine;
+it does need rsync, and weewx importable.
+
+Each case runs in a process of its own, for a clean peak RSS. For each
+pass it reports wall time, CPU time (this process and its children,
+rsync and the link included) and bytes on the wire; what slowlink
+relayed, for the link cases, and rsync's sent + received otherwise.
+
+    PYTHONPATH=/usr/share/weewx python3 bench/bench_transfer.py
+        [--files N] [--db-rows N] [--latency ms] [--bandwidth kbit/s]
+        [--cases a,b] [--save FILE] [--compare FILE] [--tolerance pct]
+
+--save writes the results as a baseline, --compare reports the change
+from one; and exits 1 if anything is slower, or sends more, than
+tolerance percent beyond it.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'bin'))
+
+from benchtree import make_tree
+
+PASSES = ('first', 'unchanged', 'churn')
+
+# name: the RsyncTransfer options, on top of those every case has
+CASES = {
+    'local-rsync': {'server': 'localhost'},
+    'local-native': {'server': 'localhost', 'local_engine': 'native'},
+    'local-publish': {'server': 'localhost', 'local_engine': 'native',
+                      'publish': 'atomic'},
+    'link-rsync': {'server': 'bench.invalid', 'compress': 'false'},
+    'link-skip': {'server': 'bench.invalid', 'skip_unchanged': 'true'},
+    'link-compress': {'server': 'bench.invalid', 'compress': 'true'},
+    'link-auto': {'server': 'bench.invalid', 'compress': 'auto'},
+    'link-pack': {'server': 'bench.invalid', 'pack_small': '16384'},
+    'link-db': {'server': 'bench.invalid', 'db_backup': '%(db)s'},
+}
+
+# the archive columns, less dateTime, a realistic width
+COLUMNS = ['usUnits', 'interval', 'barometer', 'pressure', 'altimeter',
+           'inTemp', 'outTemp', 'inHumidity', 'outHumidity', 'windSpeed',
+           'windDir', 'windGust', 'windGustDir', 'rainRate', 'rain',
+           'dewpoint', 'windchill', 'heatindex', 'ET', 'radiation', 'UV',
+           'extraTemp1', 'extraTemp2', 'soilTemp1', 'leafWet1',
+           'rxCheckPercent', 'txBatteryStatus', 'consBatteryVoltage']
+
+
+def make_db(path, rows, rng):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE archive (dateTime INTEGER PRIMARY KEY, %s)"
+                 % ", ".join("%s REAL" % c for c in COLUMNS))
+    start = int(time.time()) - rows * 300
+    conn.executemany("INSERT INTO archive VALUES (%s)" % ", ".join("?" * (len(COLUMNS) + 1)),
+                     ([start + n * 300] + [rng.random() * 100 for _ in COLUMNS]
+                      for n in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def churn(root, db, rng):
+    """One report cycle; the current pages and plots, and new records."""
+    for (dirpath, _, filenames) in os.walk(root):
+        for name in filenames:
+            if name.endswith('.png') or rng.random() < 0.02:
+                path = os.path.join(dirpath, name)
+                with open(path, 'r+b') as f:
+                    f.seek(rng.randrange(max(os.path.getsize(path), 1)))
+                    f.write(b"%0.3f" % rng.random())
+    conn = sqlite3.connect(db)
+    last = conn.execute("SELECT MAX(dateTime) FROM archive").fetchone()[0]
+    conn.executemany("INSERT INTO archive VALUES (%s)" % ", ".join("?" * (len(COLUMNS) + 1)),
+                     ([last + n * 300] + [rng.random() * 100 for _ in COLUMNS]
+                      for n in range(1, 13)))
+    conn.commit()
+    conn.close()
+
+
+class Generator(object):
+    """Just enough of a weewx report generator for Rsynct."""
+
+    def __init__(self, config_dict, skin_dict):
+        self.config_dict = config_dict
+        self.skin_dict = skin_dict
+
+
+def usage():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (r.ru_utime + r.ru_stime + c.ru_utime + c.ru_stime,
+            max(r.ru_maxrss, c.ru_maxrss))
+
+
+def wire_bytes(path):
+    try:
+        with open(path) as f:
+            return sum(int(n) for line in f for n in line.split())
+    except IOError:
+        return 0
+
+
+def run_case(name, work, args):
+    """Run in a process of its own, prints the results as json."""
+    import user.rsynctransfer as rsynctransfer
+
+    src = os.path.join(work, 'src')
+    db = os.path.join(work, 'weewx.sdb')
+    dest = os.path.join(work, 'dest-%s' % name)
+    state = os.path.join(work, 'state-%s' % name)
+    wire = os.path.join(work, 'wire-%s' % name)
+    os.makedirs(state)
+    options = dict((k, v % {'db': db}) for (k, v) in CASES[name].items())
+    options.update({'background': 'false', 'ssh_master': 'false',
+                    'state_dir': state, 'remote_root': dest, 'user': 'bench',
+                    'delete': 'true'})
+    generator = Generator({'StdReport': {'HTML_ROOT': src}},
+                          {'REPORT_NAME': name, 'RsyncTransfer': options})
+    os.environ['RSYNCT_BENCH_WIRE'] = wire
+    store = rsynctransfer.get_metrics(os.path.join(state, rsynctransfer.METRICS_FILE))
+    rng = random.Random(2)
+    results = {}
+    for step in PASSES:
+        if step == 'churn':
+            churn(src, db, rng)
+        (cpu, _) = usage()
+        before = wire_bytes(wire)
+        t1 = time.time()
+        rsynctransfer.Rsynct(generator)
+        wall = time.time() - t1
+        (cpu2, _) = usage()
+        last = store.records(0)[-1]
+        if name.startswith('link'):
+            nbytes = wire_bytes(wire) - before
+        else:
+            nbytes = last.sent + last.received or last.transferred
+        results[step] = {'wall': wall, 'cpu': cpu2 - cpu, 'wire': nbytes,
+                         'ok': last.ok}
+    results['rss_kb'] = usage()[1]
+    print(json.dumps(results))
+
+
+def compare(results, baseline, tolerance):
+    """Print the change from baseline. Returns True if nothing regressed."""
+    good = True
+    print("%-14s %-10s %-5s %12s %12s %8s" % ('case', 'pass', '', 'baseline',
+                                              'now', 'change'))
+    for (name, case) in results.items():
+        if name not in baseline:
+            continue
+        for step in PASSES:
+            for metric in ('wall', 'cpu', 'wire'):
+                (old, new) = (baseline[name][step][metric], case[step][metric])
+                change = (new - old) * 100.0 / old if old else 0.0
+                flag = ''
+                # a few ms of noise isn't a regression
+                if change > tolerance and new - old > (0.05 if metric != 'wire' else 0):
+                    flag = ' !'
+                    good = False
+                print("%-14s %-10s %-5s %12.3f %12.3f %+7.1f%%%s"
+                      % (name, step, metric, old, new, change, flag))
+    return good
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--db-rows', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=40,
+                        help="one way, milliseconds")
+    parser.add_argument('--bandwidth', type=float, default=8000,
+                        help="kbit/s each way, 0 for no limit")
+    parser.add_argument('--cases', default=",".join(sorted(CASES)))
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=10)
+    parser.add_argument('--keep', action='store_true',
+                        help="leave the trees behind")
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--work', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, args.work, args)
+        return 0
+
+    if not shutil.which('rsync'):
+        print("rsync not found")
+        return 2
+    work = tempfile.mkdtemp(prefix='rsynct-bench-')
+    # the slow link, as ssh
+    bindir = os.path.join(work, 'bin')
+    os.makedirs(bindir)
+    with open(os.path.join(bindir, 'ssh'), 'w') as f:
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n'
+                % (sys.executable, os.path.join(BENCH_DIR, 'slowlink.py')))
+    os.chmod(os.path.join(bindir, 'ssh'), 0o755)
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ['PATH'],
+               RSYNCT_BENCH_LATENCY=str(args.latency),
+               RSYNCT_BENCH_BANDWIDTH=str(args.bandwidth))
+    results = {}
+    try:
+        print("%s files, %s archive records, link %sms %skbit/s"
+              % (args.files, args.db_rows, args.latency, args.bandwidth))
+        print("%-14s %-10s %9s %9s %12s" % ('case', 'pass', 'wall', 'cpu', 'wire'))
+        for name in args.cases.split(','):
+            # every case starts from the same tree
+            for path in ('src', 'weewx.sdb'):
+                path = os.path.join(work, path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.unlink(path)
+            rng = random.Random(1)
+            make_tree(os.path.join(work, 'src'), args.files, rng)
+            make_db(os.path.join(work, 'weewx.sdb'), args.db_rows, rng)
+            out = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--case', name,
+                 '--work', work], env=env)
+            results[name] = json.loads(out.decode().strip().splitlines()[-1])
+            for step in PASSES:
+                r = results[name][step]
+                print("%-14s %-10s %8.3fs %8.3fs %12s%s"
+                      % (name, step, r['wall'], r['cpu'], format(r['wire'], ','),
+                         '' if r['ok'] else '  FAILED'))
+            print("%-14s peak RSS %s kB" % (name, format(results[name]['rss_kb'], ',')))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,28 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+The weewx like HTML_ROOT the benchmarks work on; thousands of small
+html/NOAA files in a few dozen directories and some larger png plots.
+"""
+
+import os
+
+
+def make_tree(root, files, rng):
+    """Reports, NOAA summaries and plots, much as weewx leaves them. rng,
+    a random.Random, makes the same tree for the same seed."""
+    for i in range(files):
+        d = os.path.join(root, "NOAA" if i % 3 == 0 else "html", "%02d" % (i % 40))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        with open(os.path.join(d, "f%05d.html" % i), 'w') as f:
+            f.write("<tr><td>%s</td><td>%0.1f</td></tr>\n" % (i, rng.random())
+                    * (20 + i % 200))
+    plots = os.path.join(root, "plots")
+    os.makedirs(plots)
+    for i in range(max(files // 100, 1)):
+        with open(os.path.join(plots, "plot%03d.png" % i), 'wb') as f:
+            f.write(bytes(rng.getrandbits(8) for _ in range(20000)))
@@ -0,0 +1,116 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+A stand in for ssh, for benchmarks; a slow link to this same machine.
+
+Takes ssh's arguments, ignores the options and the host, and runs the
+command here, relaying its stdin and stdout with a delay and a bandwidth
+limit on each direction. Bytes relayed each way are appended to a file,
+so what went over the 'wire' can be added up afterwards.
+
+Set by the environment, see bench_transfer.py which puts it on the PATH
+as ssh:
+    RSYNCT_BENCH_LATENCY    one way delay, milliseconds [default 0]
+    RSYNCT_BENCH_BANDWIDTH  kbit/s each way, 0 for no limit [default 0]
+    RSYNCT_BENCH_WIRE       append "<bytes in> <bytes out>" here
+"""
+
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+# ssh options that take a value
+SSH_VALUE_OPTS = set('-B -b -c -D -E -e -F -I -i -J -L -l -m -O -o -p -Q -R -S -W -w'.split())
+
+
+def parse(argv):
+    """ssh's arguments, returns (host, remote command)."""
+    i = 0
+    while i < len(argv) and argv[i].startswith('-'):
+        i += 2 if argv[i] in SSH_VALUE_OPTS else 1
+    if i >= len(argv):
+        sys.exit("slowlink: no host")
+    return argv[i], " ".join(argv[i + 1:])
+
+
+class Relay(object):
+    """Copies src to dst, each chunk delayed by latency and paced to rate."""
+
+    def __init__(self, src, dst, latency, rate, close=None):
+        self.src = src
+        self.dst = dst
+        self.latency = latency
+        self.rate = rate
+        self.close = close
+        self.nbytes = 0
+        self.chunks = queue.Queue()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+
+    def start(self):
+        self.reader.start()
+        self.writer.start()
+
+    def read(self):
+        while True:
+            try:
+                chunk = os.read(self.src, 65536)
+            except OSError:
+                chunk = b''
+            self.chunks.put((time.time(), chunk))
+            if not chunk:
+                return
+
+    def write(self):
+        free = 0
+        while True:
+            (sent, chunk) = self.chunks.get()
+            if not chunk:
+                break
+            # arrives latency after it was sent, and no sooner than the
+            # link has finished with what came before it
+            due = max(sent + self.latency, free)
+            if self.rate:
+                due += len(chunk) / self.rate
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            free = due
+            try:
+                os.write(self.dst, chunk)
+            except OSError:
+                break
+            self.nbytes += len(chunk)
+        if self.close is not None:
+            self.close()
+
+
+def main(argv):
+    (host, command) = parse(argv[1:])
+    latency = float(os.environ.get('RSYNCT_BENCH_LATENCY', 0)) / 1000
+    # kbit/s to bytes/s
+    rate = float(os.environ.get('RSYNCT_BENCH_BANDWIDTH', 0)) * 125
+    proc = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    up = Relay(sys.stdin.fileno(), proc.stdin.fileno(), latency, rate,
+               close=proc.stdin.close)
+    down = Relay(proc.stdout.fileno(), sys.stdout.fileno(), latency, rate)
+    up.start()
+    down.start()
+    down.writer.join()
+    returncode = proc.wait()
+    wire = os.environ.get('RSYNCT_BENCH_WIRE')
+    if wire:
+        with open(wire, 'a') as f:
+            f.write("%d %d\n" % (up.nbytes, down.nbytes))
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,247 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#
+"""
+Bundles of small files, for rsynctransfer's pack_small mode.
+
+Over a link with a long round trip, rsync spends more time on each of a
+weewx site's thousands of tiny files than on the bytes in them. With
+pack_small, the changed files below a size are put in one gzip'd tar, a
+bundle, sent in one stream over ssh and unpacked at the far end by this
+script, which rsynctransfer copies there (DEST/.rsynct/) the first time.
+It needs nothing but python.
+
+A bundle is named for the sha256 of its contents:
+    bundle-<sha256>.tar.gz
+and holds regular files only, paths relative to the destination. It is
+checked against its name before anything is unpacked, then every file is
+written alongside its target under a temporary name and only when all of
+them are there are they renamed into place; a bundle that is damaged, or
+can't be written out in full, leaves the destination as it was. Before
+the renames start, the files to be renamed are listed in a journal
+(DEST/.rsynct/unpack.journal); should the renames be cut short, by a
+crash or a power cut, the next unpack finishes them first, so the
+destination has all of the bundle, never some of it.
+
+Usage, at the far end (rsynctransfer runs this itself):
+    python3 rsynct_receiver.py unpack DEST SHA256 [BUNDLE]
+    python3 rsynct_receiver.py verify BUNDLE
+unpack reads the bundle from standard input if BUNDLE isn't given.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+
+# the directory, in the destination, rsynctransfer keeps this script in
+RECEIVER_DIR = '.rsynct'
+# in RECEIVER_DIR, the files an unpack is renaming into place
+JOURNAL = 'unpack.journal'
+
+
+class BundleError(Exception):
+    """A bundle that is damaged, or would write outside the destination."""
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_bundle(root, paths, dest_dir):
+    """
+    Pack the files paths (relative to root) into a new bundle in dest_dir.
+
+    Returns (bundle path, sha256, the paths packed, bytes packed); files
+    that have gone since they were listed are left out. The gzip header
+    carries no timestamp, so the same files always make the same bundle.
+    """
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    tmp = os.path.join(dest_dir, ".bundle.tmp")
+    packed = []
+    size = 0
+    with open(tmp, 'wb') as raw:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode='w|',
+                              format=tarfile.PAX_FORMAT) as tar:
+                for rel in sorted(paths):
+                    path = os.path.join(root, rel)
+                    try:
+                        with open(path, 'rb') as f:
+                            info = tar.gettarinfo(arcname=rel, fileobj=f)
+                            if not info.isreg():
+                                continue
+                            info.uid = info.gid = 0
+                            info.uname = info.gname = ''
+                            tar.addfile(info, f)
+                    except (IOError, OSError):
+                        # vanished, it'll be a deletion next time
+                        continue
+                    packed.append(rel)
+                    size += info.size
+    digest = file_sha256(tmp)
+    path = os.path.join(dest_dir, "bundle-%s.tar.gz" % digest)
+    os.replace(tmp, path)
+    return path, digest, packed, size
+
+
+def check_member(member):
+    """A regular file, somewhere under the destination."""
+    name = member.name
+    if not member.isreg():
+        raise BundleError("%s isn't a regular file" % name)
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts or RECEIVER_DIR == parts[0]:
+        raise BundleError("%s is outside the destination" % name)
+
+
+def staged_name(target):
+    """Where a file is written before it is renamed to target."""
+    return os.path.join(os.path.dirname(target), ".%s.rsynct-tmp"
+                        % os.path.basename(target))
+
+
+def finish_unpack(dest):
+    """
+    Finish the renames of an unpack that was cut short, as its journal
+    lists them. Returns the number of files put in place.
+    """
+    journal = os.path.join(dest, RECEIVER_DIR, JOURNAL)
+    try:
+        with open(journal) as f:
+            names = json.load(f)
+    except (IOError, OSError):
+        return 0
+    except ValueError:
+        # it's written whole or not at all, but don't stop on it
+        names = []
+    n = 0
+    for name in names:
+        target = os.path.join(dest, name)
+        tmp = staged_name(target)
+        if os.path.exists(tmp):
+            os.replace(tmp, target)
+            n += 1
+    os.unlink(journal)
+    return n
+
+
+def write_journal(dest, names):
+    """List names, the files about to be renamed into place, in the
+    journal; written in full, or not at all."""
+    holding = os.path.join(dest, RECEIVER_DIR)
+    if not os.path.isdir(holding):
+        os.makedirs(holding)
+    journal = os.path.join(holding, JOURNAL)
+    tmp = journal + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(names, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, journal)
+    return journal
+
+
+def unpack(bundle, dest, digest=None):
+    """
+    Unpack bundle into dest, all of it or, if anything goes wrong, none
+    of it. Returns the number of files.
+
+    Any unpack left unfinished is finished first.
+    """
+    finish_unpack(dest)
+    if digest is not None and file_sha256(bundle) != digest:
+        raise BundleError("%s doesn't match its sha256, damaged on the way?"
+                          % os.path.basename(bundle))
+    names = []
+    staged = []
+    try:
+        with tarfile.open(bundle, 'r:gz') as tar:
+            for member in tar:
+                check_member(member)
+                target = os.path.join(dest, member.name)
+                directory = os.path.dirname(target)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                tmp = staged_name(target)
+                names.append(member.name)
+                staged.append((tmp, target))
+                src = tar.extractfile(member)
+                with open(tmp, 'wb') as out:
+                    shutil.copyfileobj(src, out)
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.chmod(tmp, member.mode & 0o7777)
+                os.utime(tmp, (member.mtime, member.mtime))
+    except (tarfile.TarError, EOFError, IOError, OSError, BundleError):
+        for (tmp, target) in staged:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        raise
+    journal = write_journal(dest, names)
+    for (tmp, target) in staged:
+        os.replace(tmp, target)
+    os.unlink(journal)
+    return len(staged)
+
+
+def receive(stream, dest, digest):
+    """unpack() a bundle read from stream, kept in RECEIVER_DIR meanwhile."""
+    holding = os.path.join(dest, RECEIVER_DIR)
+    if not os.path.isdir(holding):
+        os.makedirs(holding)
+    (fd, tmp) = tempfile.mkstemp(prefix='bundle-', suffix='.tmp', dir=holding)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        return unpack(tmp, dest, digest)
+    finally:
+        os.unlink(tmp)
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ('unpack', 'verify') or \
+            (argv[1] == 'unpack' and len(argv) < 4):
+        print(__doc__)
+        return 2
+    try:
+        if argv[1] == 'verify':
+            bundle = argv[2]
+            name = os.path.basename(bundle)
+            if name.startswith('bundle-') and \
+                    file_sha256(bundle) != name[7:].split('.')[0]:
+                raise BundleError("%s doesn't match its sha256" % name)
+            with tarfile.open(bundle, 'r:gz') as tar:
+                members = tar.getmembers()
+            for member in members:
+                check_member(member)
+            print("%s ok, %s files" % (name, len(members)))
+            return 0
+        (dest, digest) = argv[2:4]
+        if len(argv) > 4:
+            n = unpack(argv[4], dest, digest)
+        else:
+            n = receive(sys.stdin.buffer, dest, digest)
+        print("unpacked %s files" % n)
+    except (BundleError, tarfile.TarError, EOFError, IOError, OSError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
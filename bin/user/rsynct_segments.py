@@ -0,0 +1,219 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+#
+"""
+Archive segments, for rsynctransfer's db_ship mode.
+
+Rather than send the whole weewx database each cycle, db_ship sends a base
+copy once and then, each cycle, only the archive records added since the
+last one; as a segment file. This module writes and reads those segments
+and rebuilds a database from them. It needs nothing but python, so it can
+be copied to, and run on, the machine holding the backups; weewx need not
+be installed there.
+
+A segment is gzip'd JSON lines:
+    {"format": 1, "table": "archive", "columns": [...]}   header
+    [dateTime, ...]                                       one per record
+    {"rows": n, "first": ts, "last": ts, "sha256": "..."} trailer
+where sha256 is over every line before the trailer. Names sort in record
+order: seg-<first dateTime>-<last dateTime>.jsonl.gz
+
+Usage, on the backup machine:
+    python3 rsynct_segments.py verify DIR
+    python3 rsynct_segments.py restore DIR OUT.sdb
+    python3 rsynct_segments.py compact DIR
+DIR is where db_ship sends to, base-*.sdb and the seg-* files. restore
+writes a complete database to OUT.sdb; compact folds the segments into a
+new base and removes them.
+"""
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+
+SEGMENT_FORMAT = 1
+
+
+class SegmentError(Exception):
+    """A segment that is damaged, or doesn't follow on from the last."""
+
+
+def write_segment(conn, since, dest_dir, table='archive'):
+    """
+    Write the records of table newer than since to a new segment.
+
+    Returns (path, last dateTime, number of records), or None if there
+    were no new records.
+    """
+    cursor = conn.execute("SELECT * FROM %s WHERE dateTime > ? ORDER BY dateTime"
+                          % table, (since,))
+    columns = [d[0] for d in cursor.description]
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    tmp = os.path.join(dest_dir, ".seg.tmp")
+    h = hashlib.sha256()
+    first = last = None
+    rows = 0
+    with gzip.open(tmp, 'wb') as f:
+        def put(obj):
+            line = (json.dumps(obj, separators=(',', ':')) + "\n").encode('utf-8')
+            h.update(line)
+            f.write(line)
+        put({'format': SEGMENT_FORMAT, 'table': table, 'columns': columns})
+        for row in cursor:
+            put(list(row))
+            if first is None:
+                first = row[columns.index('dateTime')]
+            last = row[columns.index('dateTime')]
+            rows += 1
+        f.write((json.dumps({'rows': rows, 'first': first, 'last': last,
+                             'sha256': h.hexdigest()}) + "\n").encode('utf-8'))
+    if not rows:
+        os.unlink(tmp)
+        return None
+    path = os.path.join(dest_dir, "seg-%010d-%010d.jsonl.gz" % (first, last))
+    os.replace(tmp, path)
+    return path, last, rows
+
+
+def read_segment(path):
+    """
+    Read and check a segment.
+
+    Returns (table, columns, records, trailer); raises SegmentError if it
+    is damaged.
+    """
+    h = hashlib.sha256()
+    records = []
+    try:
+        with gzip.open(path, 'rb') as f:
+            lines = f.read().splitlines(True)
+    except (IOError, OSError, EOFError) as e:
+        raise SegmentError("%s: unreadable, %s" % (path, e))
+    if len(lines) < 2:
+        raise SegmentError("%s: truncated" % path)
+    for line in lines[:-1]:
+        h.update(line)
+    try:
+        header = json.loads(lines[0].decode('utf-8'))
+        trailer = json.loads(lines[-1].decode('utf-8'))
+        records = [json.loads(line.decode('utf-8')) for line in lines[1:-1]]
+    except ValueError as e:
+        raise SegmentError("%s: corrupt, %s" % (path, e))
+    if header.get('format') != SEGMENT_FORMAT:
+        raise SegmentError("%s: unknown format %s" % (path, header.get('format')))
+    if trailer.get('sha256') != h.hexdigest() or trailer.get('rows') != len(records):
+        raise SegmentError("%s: checksum mismatch" % path)
+    return header['table'], header['columns'], records, trailer
+
+
+def segments_in(directory):
+    """The segments in directory, in record order."""
+    return sorted(glob.glob(os.path.join(directory, "seg-*.jsonl.gz")))
+
+
+def latest_base(directory):
+    """The newest base copy in directory, None if there isn't one."""
+    bases = sorted(glob.glob(os.path.join(directory, "base-*.sdb")))
+    return bases[-1] if bases else None
+
+
+def base_name(directory, last):
+    """Where a base holding the records up to last belongs."""
+    return os.path.join(directory, "base-%010d.sdb" % last)
+
+
+def apply_segments(conn, paths, after=None):
+    """
+    Add the records of each segment to the database conn.
+
+    Segments holding nothing newer than after (the base's newest record)
+    are passed over. Returns the newest dateTime applied.
+    """
+    for path in paths:
+        (table, columns, records, trailer) = read_segment(path)
+        if after is not None and trailer['last'] <= after:
+            continue
+        conn.executemany("INSERT OR REPLACE INTO %s (%s) VALUES (%s)"
+                         % (table, ", ".join(columns),
+                            ", ".join("?" * len(columns))), records)
+        conn.commit()
+        after = trailer['last']
+    return after
+
+
+def base_last(path, table='archive'):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT MAX(dateTime) FROM %s" % table).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def restore(directory, out):
+    """Rebuild the complete database, from base plus segments, into out."""
+    base = latest_base(directory)
+    if base is None:
+        raise SegmentError("%s: no base-*.sdb to start from" % directory)
+    tmp = "%s.tmp" % out
+    shutil.copyfile(base, tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        last = apply_segments(conn, segments_in(directory), base_last(tmp))
+    finally:
+        conn.close()
+    os.replace(tmp, out)
+    return last
+
+
+def compact(directory):
+    """Fold the segments into a new base, then remove them and the old base."""
+    old = latest_base(directory)
+    segments = segments_in(directory)
+    if not segments:
+        return old
+    tmp = os.path.join(directory, ".base.tmp")
+    last = restore(directory, tmp)
+    new = base_name(directory, last)
+    os.replace(tmp, new)
+    for path in segments:
+        os.unlink(path)
+    if old is not None and old != new:
+        os.unlink(old)
+    return new
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ('verify', 'restore', 'compact'):
+        print(__doc__)
+        return 2
+    (command, directory) = argv[1:3]
+    try:
+        if command == 'verify':
+            for path in segments_in(directory):
+                trailer = read_segment(path)[3]
+                print("%s ok, %s records" % (os.path.basename(path), trailer['rows']))
+        elif command == 'restore':
+            if len(argv) < 4:
+                print(__doc__)
+                return 2
+            last = restore(directory, argv[3])
+            print("restored %s, records up to %s" % (argv[3], last))
+        else:
+            print("compacted into %s" % compact(directory))
+    except (SegmentError, sqlite3.Error, IOError, OSError) as e:
+        print("error: %s" % e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -13,56 +13,3884 @@
 """
 For transferring files; anywhere.
 To a remote server, to a thumb drive all via Rsync
+
+A report section's transfer can also be run by hand, or from cron, with
+the results printed as JSON; see main():
+    PYTHONPATH=/usr/share/weewx python3 -m user.rsynctransfer \
+        /etc/weewx/weewx.conf [--section RsyncTransfer] [--dry-run]
+        [--repeat N] [--interval SECONDS] [--profile FILE] [-v]
 """
 
-import os
-import errno
-import sys
-import subprocess
-import time
-import configobj
+import os
+import atexit
+import errno
+import fcntl
+import collections
+import datetime
+import hashlib
+import json
+import re
+import selectors
+import shlex
+import shutil
+import signal
+import socket
+import sqlite3
+import stat
+import sys
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+import concurrent.futures
+import configobj
+
+import weewx
+import weewx.engine
+import weewx.manager
+import weewx.units
+from weeutil.weeutil import to_int, to_bool
+from weewx.cheetahgenerator import SearchList
+
+import user.rsynct_segments as rsynct_segments
+import user.rsynct_receiver as rsynct_receiver
+
+rsynct_version = "0.0.2"
+
+# https://github.com/weewx/weewx/wiki/WeeWX-v4-and-logging
+import logging
+log = logging.getLogger(__name__)
+
+
+def logdbg(msg):
+    log.debug(msg)
+
+
+def loginf(msg):
+    log.info(msg)
+
+
+def logerr(msg):
+    log.error(msg)
+
+
+class RsyncOutput(object):
+    """
+    Follows a running rsync's output, keeping only what is needed.
+
+    stdout is read a chunk at a time and split into lines. The file names
+    -v prints are counted, not kept; the --stats block is picked out into
+    stats; stderr, where rsync and ssh report their errors, is kept as a
+    short, bounded, list of lines. Memory stays flat however many files
+    are sent. With --info=progress2 the latest progress line is logged
+    every progress_interval seconds. With timing, the time spent here is
+    added up in parse_time and --itemize-changes lines are counted, by
+    kind, in items.
+    """
+
+    # longest line kept, anything beyond is dropped
+    MAX_LINE = 4096
+    # most error lines kept, the first few and the last
+    MAX_ERRORS = 20
+
+    def __init__(self, label='', progress_interval=None, timing=False):
+        self.label = label
+        self.progress_interval = progress_interval
+        self.parse_time = 0.0 if timing else None
+        self.items = collections.Counter()
+        self.cpu = None
+        self.stats = {}
+        self.errors = []
+        self.last_errors = collections.deque(maxlen=self.MAX_ERRORS // 2)
+        self.nlines = 0
+        self.in_stats = False
+        self.progress = None
+        self.progress_logged = time.time()
+
+    def follow(self, proc, timeout=None):
+        """Read proc's stdout and stderr until it exits.
+
+        Returns True if it had to be killed for exceeding timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        timed_out = False
+        sel = selectors.DefaultSelector()
+        sel.register(proc.stdout, selectors.EVENT_READ, (self.line, []))
+        sel.register(proc.stderr, selectors.EVENT_READ, (self.error, []))
+        while sel.get_map():
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0 and not timed_out:
+                    # a hung link, don't let it hold up the next request
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    timed_out = True
+                if timed_out:
+                    wait = None
+            if self.progress_interval:
+                # wake to log progress even if rsync has gone quiet
+                wait = self.progress_interval if wait is None \
+                    else min(wait, self.progress_interval)
+            for (key, _) in sel.select(wait):
+                (handler, partial) = key.data
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    if partial:
+                        handler(b''.join(partial)[:self.MAX_LINE], False)
+                    continue
+                if self.parse_time is None:
+                    self._split(chunk, handler, partial)
+                else:
+                    t = time.perf_counter()
+                    self._split(chunk, handler, partial)
+                    self.parse_time += time.perf_counter() - t
+            self._log_progress()
+        sel.close()
+        self.reap(proc)
+        return timed_out
+
+    def reap(self, proc):
+        """Wait for proc, noting the CPU time it used in cpu."""
+        try:
+            (_, status, usage) = os.wait4(proc.pid, 0)
+        except (OSError, AttributeError):
+            proc.wait()
+            return
+        proc.returncode = os.waitstatus_to_exitcode(status) \
+            if hasattr(os, 'waitstatus_to_exitcode') else \
+            (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+             else os.WEXITSTATUS(status))
+        self.cpu = usage.ru_utime + usage.ru_stime
+
+    def _split(self, chunk, handler, partial):
+        # progress2 ends its lines in \r, everything else in \n
+        start = 0
+        for m in LINE_END.finditer(chunk):
+            partial.append(chunk[start:m.start()])
+            line = b''.join(partial)
+            del partial[:]
+            handler(line[:self.MAX_LINE], m.group() == b'\r')
+            start = m.end()
+        rest = chunk[start:]
+        if rest and sum(len(p) for p in partial) < self.MAX_LINE:
+            partial.append(rest)
+
+    def line(self, raw, cr):
+        """The stdout state machine; file list, then the --stats block."""
+        line = raw.decode('utf-8', 'replace')
+        if cr:
+            self.progress = line.strip()
+            return
+        self.nlines += 1
+        if not self.in_stats:
+            if line.startswith('Number of files:'):
+                self.in_stats = True
+            else:
+                if self.parse_time is not None:
+                    self.itemize(line)
+                return
+        if ':' in line:
+            (n, v) = line.split(':', 1)
+            self.stats[n.strip()] = v.strip()
+        elif line.startswith('sent '):
+            # sent 2,345 bytes  received 123 bytes  4,936.00 bytes/sec
+            words = line.split()
+            self.stats['sent'] = words[1]
+            self.stats['received'] = words[4]
+            self.stats['rate'] = words[6]
+        elif line.startswith('total size is '):
+            # total size is 12,345,678  speedup is 5,002.30
+            words = line.split()
+            self.stats['total size'] = words[3]
+            self.stats['speedup'] = words[6]
+
+    def itemize(self, line):
+        """Count an --itemize-changes line, YXcstpoguax name."""
+        if line.startswith('*deleting'):
+            kind = 'deleted'
+        elif len(line) > 12 and line[11] == ' ' and line[0] in '<>ch.':
+            if '+++++++' in line[2:11]:
+                kind = 'created'
+            elif line[0] in '<>':
+                kind = 'updated'
+            elif line[0] == 'h':
+                kind = 'hardlinked'
+            else:
+                kind = 'attributes'
+        else:
+            return
+        self.items[kind] += 1
+
+    def error(self, raw, cr):
+        line = raw.decode('utf-8', 'replace').strip()
+        if not line:
+            return
+        if len(self.errors) < self.MAX_ERRORS // 2:
+            self.errors.append(line)
+        else:
+            self.last_errors.append(line)
+
+    def error_text(self):
+        """The error lines kept, as one string."""
+        return "\n".join(self.errors + list(self.last_errors))
+
+    def _log_progress(self):
+        if self.progress_interval and self.progress is not None and \
+                time.time() - self.progress_logged >= self.progress_interval:
+            loginf(": progress to %s: %s" % (self.label, self.progress))
+            self.progress_logged = time.time()
+            self.progress = None
+
+
+LINE_END = re.compile(b'[\r\n]')
+
+
+class LocalSync(object):
+    """
+    What rsync -a does for server = localhost, without forking rsync.
+
+    rsync runs its whole sender/receiver protocol even when both ends are
+    on this machine. Here, files are compared on size and mtime, as rsync
+    does, and those that differ are copied by the kernel (copy_file_range,
+    else sendfile) on a small thread pool. Each is written under a
+    temporary name in its directory and renamed into place, so nothing
+    ever sees half a file. Directories are given their source's mode and
+    mtime once the files in them are written. Devices, sockets and fifos
+    are left out; native_options() has rsync do -D. Source paths follow
+    rsync's trailing slash rule. delete, an explicit file list (files_from) and link_dest (hard
+    link files unchanged from an earlier snapshot) are honoured. Where
+    the filesystems allow (btrfs, XFS, ...; see reflink()) a copy is a
+    copy on write clone, which shares the source's blocks rather than
+    writing them again. The result is a dict of the same --stats fields
+    rsync reports, with the cloned bytes as Matched data.
+    """
+
+    def __init__(self, sources, dest, delete=False, files_from=None,
+                 link_dest=None, threads=4):
+        self.sources = sources
+        self.dest = dest
+        self.delete = delete
+        self.files_from = files_from
+        self.link_dest = link_dest
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        # directory: the names the sources have there, from every source;
+        # several ending in / all fill dest
+        self.keep = {}
+        # directory: the source directory it is a copy of
+        self.dirs = {}
+
+    def run(self):
+        t1 = time.time()
+        # (source, destination, relative) for every file
+        work = []
+        for src in self.sources:
+            if src.endswith(os.sep) or self.files_from is not None:
+                (top, base) = (src, self.dest)
+            else:
+                top = src
+                base = os.path.join(self.dest, os.path.basename(src))
+            self._plan(top, base, work)
+        if self.delete:
+            for (target, keep) in self.keep.items():
+                self._delete_extra(target, keep)
+        t2 = time.time()
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+            for _ in pool.map(self._sync, work):
+                pass
+        # now nothing more is written to them
+        for (target, src) in self.dirs.items():
+            self._copy_dir(src, target)
+        c = self.counts
+        literal = c['copied'] - c['cloned']
+        return {
+            'Number of files': format(c['files'], ','),
+            'Number of created files': format(c['created'], ','),
+            'Number of deleted files': format(c['deleted'], ','),
+            'Number of regular files transferred': format(c['transferred'], ','),
+            'Total file size': "%s bytes" % format(c['size'], ','),
+            'Total transferred file size': "%s bytes" % format(c['copied'], ','),
+            'Literal data': "%s bytes" % format(literal, ','),
+            'Matched data': "%s bytes" % format(c['cloned'], ','),
+            'File list generation time': "%0.3f seconds" % (t2 - t1),
+            'File list transfer time': "0.000 seconds",
+            'Total bytes sent': format(literal, ','),
+            'Total bytes received': '0',
+        }
+
+    def _plan(self, top, base, work):
+        """Build the directory tree at base and list the files to sync."""
+        if self.files_from is not None:
+            for rel in self.files_from:
+                path = os.path.join(top, rel)
+                if os.path.lexists(path):
+                    work.append((path, os.path.join(base, rel), rel))
+                    self._makedirs(os.path.dirname(os.path.join(base, rel)))
+                    # and the directories on the way to it
+                    rel = os.path.dirname(os.path.normpath(rel))
+                    while rel:
+                        self.dirs[os.path.join(base, rel)] = \
+                            os.path.join(top, rel)
+                        rel = os.path.dirname(rel)
+            return
+        try:
+            st = os.lstat(top.rstrip(os.sep) or os.sep)
+        except OSError:
+            raise IOError("link_stat %s failed, no such file or directory" % top)
+        # where base is in dest, for link_dest
+        prefix = os.path.relpath(base, self.dest)
+        if not stat.S_ISDIR(st.st_mode):
+            work.append((top, base, prefix))
+            return
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            rel_dir = os.path.normpath(os.path.join(
+                prefix, os.path.relpath(dirpath, top)))
+            target = os.path.normpath(os.path.join(self.dest, rel_dir))
+            self._makedirs(target)
+            self.dirs[target] = dirpath
+            self.counts['files'] += 1
+            names = set(filenames)
+            for name in dirnames[:]:
+                if os.path.islink(os.path.join(dirpath, name)):
+                    # a symlink to a directory is copied as a link
+                    dirnames.remove(name)
+                    names.add(name)
+            for name in sorted(names):
+                work.append((os.path.join(dirpath, name),
+                             os.path.join(target, name),
+                             os.path.normpath(os.path.join(rel_dir, name))))
+            self.keep.setdefault(target, set()).update(set(dirnames) | names)
+
+    def _makedirs(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+            self.counts['created'] += 1
+
+    @staticmethod
+    def _copy_dir(src, target):
+        """Give target src's mode and mtime, if it hasn't them already."""
+        st = os.stat(src)
+        dt = os.stat(target)
+        if stat.S_IMODE(dt.st_mode) != stat.S_IMODE(st.st_mode):
+            os.chmod(target, stat.S_IMODE(st.st_mode))
+        if dt.st_mtime_ns != st.st_mtime_ns:
+            os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def _delete_extra(self, target, keep):
+        for name in os.listdir(target):
+            if name in keep:
+                continue
+            path = os.path.join(target, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            self.counts['deleted'] += 1
+
+    def _sync(self, item):
+        (src, dst, rel) = item
+        st = os.lstat(src)
+        with self.lock:
+            self.counts['files'] += 1
+            self.counts['size'] += st.st_size
+        try:
+            dt = os.lstat(dst)
+        except OSError:
+            dt = None
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(src)
+            if dt is None or not stat.S_ISLNK(dt.st_mode) or os.readlink(dst) != target:
+                tmp = self._tmp_name(dst)
+                os.symlink(target, tmp)
+                os.replace(tmp, dst)
+            return
+        if not stat.S_ISREG(st.st_mode):
+            # devices, sockets and the like aren't for a backup
+            return
+        if dt is not None and same_file(st, dt):
+            return
+        if self.link_dest is not None:
+            old = os.path.join(self.link_dest, rel)
+            try:
+                if same_file(st, os.lstat(old)):
+                    tmp = self._tmp_name(dst)
+                    os.link(old, tmp)
+                    os.replace(tmp, dst)
+                    return
+            except OSError:
+                pass
+        cloned = self._copy(src, dst, st)
+        with self.lock:
+            self.counts['transferred'] += 1
+            self.counts['copied'] += st.st_size
+            if cloned:
+                self.counts['cloned'] += st.st_size
+
+    @staticmethod
+    def _tmp_name(dst):
+        """The temporary name for dst, cleared of any an interrupted run
+        left behind."""
+        tmp = os.path.join(os.path.dirname(dst),
+                           ".%s.%s" % (os.path.basename(dst), threading.get_ident()))
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        return tmp
+
+    def _copy(self, src, dst, st):
+        """Copy src to dst, by way of a temporary file. Returns True if
+        it was a clone."""
+        tmp = self._tmp_name(dst)
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                cloned = reflink(fsrc.fileno(), fdst.fileno(), st.st_dev)
+                if not cloned:
+                    kernel_copy(fsrc.fileno(), fdst.fileno(), st.st_size)
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            raise
+        return cloned
+
+
+def same_file(st, dt):
+    """rsync's quick check, size and modification time."""
+    return st.st_size == dt.st_size and st.st_mtime_ns == dt.st_mtime_ns \
+        and stat.S_IFMT(st.st_mode) == stat.S_IFMT(dt.st_mode)
+
+
+# linux/fs.h, _IOW(0x94, 9, int); clone a whole file
+FICLONE = 0x40049409
+
+# (source device, destination device): whether they can share blocks,
+# learnt from the first try
+reflink_devices = {}
+
+
+def reflink(fd_in, fd_out, dev_in):
+    """
+    Make fd_out a copy on write clone of fd_in, if the filesystem can
+    (btrfs, XFS with reflink, bcachefs, ...). Nothing is copied, the two
+    share blocks until one is written to. Returns False, quickly after
+    the first time, where it can't; across filesystems, tmpfs, ext4.
+    """
+    key = (dev_in, os.fstat(fd_out).st_dev)
+    if reflink_devices.get(key) is False:
+        return False
+    try:
+        fcntl.ioctl(fd_out, FICLONE, fd_in)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                           errno.ENOTTY, errno.ENOSYS, errno.EPERM):
+            raise
+        reflink_devices[key] = False
+        return False
+    reflink_devices[key] = True
+    return True
+
+
+def kernel_copy(fd_in, fd_out, size):
+    """Copy size bytes between file descriptors without passing through
+    python; copy_file_range where there is one, else sendfile, else read
+    and write."""
+    copied = 0
+    for call in ('copy_file_range', 'sendfile'):
+        func = getattr(os, call, None)
+        if func is None:
+            continue
+        try:
+            while copied < size:
+                if call == 'copy_file_range':
+                    n = func(fd_in, fd_out, min(size - copied, 1 << 30))
+                else:
+                    n = func(fd_out, fd_in, None, min(size - copied, 1 << 30))
+                if n == 0:
+                    break
+                copied += n
+            if copied >= size:
+                return copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP) or copied:
+                raise
+    # a file that grew while being copied, or no kernel copy at all
+    while True:
+        block = os.read(fd_in, 1 << 20)
+        if not block:
+            break
+        os.write(fd_out, block)
+        copied += len(block)
+    return copied
+
+
+# options LocalSync either does anyway or that don't apply to a local copy;
+# not -D, it leaves devices and specials out
+NATIVE_FLAGS = set('arlptgovzOJhiPq')
+NATIVE_OPTIONS = ('--stats', '--delete', '--compress', '--no-whole-file',
+                  '--info=', '--block-size=', '--link-dest=', '--files-from=')
+
+
+def native_options(cmd):
+    """Whether LocalSync can stand in for an rsync with these options."""
+    for opt in cmd[1:]:
+        if opt.startswith('--'):
+            if not opt.startswith(NATIVE_OPTIONS):
+                return False
+        elif opt.startswith('-'):
+            if set(opt[1:]) - NATIVE_FLAGS:
+                return False
+    return True
+
+
+# rsync's exit codes (man rsync, EXIT VALUES) and the class of each
+RSYNC_EXIT = {
+    0: 'ok',
+    1: 'config',           # syntax or usage error
+    2: 'config',           # protocol incompatibility
+    3: 'config',           # errors selecting input/output files, dirs
+    4: 'config',           # requested action not supported
+    5: 'unreachable',      # error starting client-server protocol
+    6: 'transient',        # daemon unable to append to log-file
+    10: 'unreachable',     # error in socket I/O
+    11: 'missing_dir',     # error in file I/O
+    12: 'unreachable',     # error in rsync protocol data stream
+    13: 'transient',       # errors with program diagnostics
+    14: 'transient',       # error in IPC code
+    20: 'transient',       # received SIGUSR1 or SIGINT
+    21: 'transient',       # some error returned by waitpid()
+    22: 'transient',       # error allocating core memory buffers
+    23: 'partial',         # partial transfer due to error
+    24: 'vanished',        # partial transfer due to vanished source files
+    25: 'config',          # the --max-delete limit stopped deletions
+    30: 'unreachable',     # timeout in data send/receive
+    35: 'unreachable',     # timeout waiting for daemon connection
+    255: 'unreachable',    # ssh couldn't connect
+}
+
+# rsync's error text, where it says more than the exit code; and the
+# exit codes it means that with, None for any. A Permission denied
+# reading a local file (23) isn't ssh's
+AUTH_EXITS = (5, 12, 255)
+MISSING_DIR_EXITS = (3, 11, 23)
+RSYNC_ERROR_TEXT = (
+    ('Permission denied', 'auth', AUTH_EXITS),
+    ('Host key verification failed', 'auth', AUTH_EXITS),
+    ('Read-only file system', 'readonly', None),
+    ('No space left on device', 'disk_full', None),
+    ('change_dir#3', 'missing_dir', MISSING_DIR_EXITS),
+    ('mkdir', 'missing_dir', MISSING_DIR_EXITS),
+    ('link_stat', 'local_missing', None),
+)
+
+# for each class; what to do, whether it counts towards the host's circuit
+# breaker, and what to tell the log. A host that can't be reached isn't
+# retried within the cycle, each try would cost connect_timeout; the
+# breaker decides when to try it again
+RSYNC_POLICY = {
+    'ok':            ('done', False, 'ok'),
+    'vanished':      ('done', False, 'source files vanished'),
+    'partial':       ('retry', False, 'some files were not transferred'),
+    'transient':     ('retry', False, 'a transient error'),
+    'unreachable':   ('fail', True, "can't reach the remote host"),
+    'timeout':       ('fail', True, 'it exceeded transfer_timeout'),
+    'missing_dir':   ('mkdir', False, 'the destination directory is missing'),
+    'auth':          ('fail', False, 'permission denied, check the remote'
+                      ' authentication (ssh keys)'),
+    'readonly':      ('fail', False, 'the destination is read-only'),
+    'disk_full':     ('fail', False, 'the destination is full'),
+    'local_missing': ('fail', False, "a local_root path doesn't exist"),
+    'config':        ('fail', False, 'rsync rejected the command, check'
+                      ' rsync_options'),
+    'unknown':       ('fail', False, 'an unrecognised error'),
+}
+
+
+def classify(returncode, errors, timed_out=False):
+    """Sort an rsync outcome into one of the RSYNC_POLICY classes."""
+    if timed_out:
+        return 'timeout'
+    klass = RSYNC_EXIT.get(returncode, 'unknown')
+    if klass not in ('ok', 'vanished'):
+        for (text, refined, codes) in RSYNC_ERROR_TEXT:
+            if text in errors and (codes is None or returncode in codes):
+                return refined
+    return klass
+
+
+class CircuitBreaker(object):
+    """
+    Stops a dead host costing a connect timeout, and retries, every cycle.
+
+    After failures transfers in a row fail as unreachable (or time out)
+    the breaker opens; transfers to the host are then skipped, without
+    trying, for cooloff seconds, doubling each time it opens again up to
+    max_cooloff. After that it is half open: one transfer, the probe, is
+    let through to test the water while the rest are still skipped. If
+    the probe works the breaker closes, if it fails the breaker opens
+    again. A probe that is never heard of again (its transfer found
+    nothing to send, say) is given up on after cooloff seconds.
+    """
+
+    def __init__(self, failures=2, cooloff=300, max_cooloff=3600):
+        self.failures = failures
+        self.cooloff = cooloff
+        self.max_cooloff = max_cooloff
+        self.lock = threading.Lock()
+        self.count = 0
+        self.trips = 0
+        self.open_until = 0
+        # when the probe was let through, None if there isn't one out
+        self.probe = None
+
+    def allow(self, now):
+        """Whether to try. Returns the seconds left to wait, 0 to go ahead."""
+        with self.lock:
+            if not self.open_until:
+                return 0
+            if now < self.open_until:
+                return self.open_until - now
+            if self.probe is not None and now < self.probe + self.cooloff:
+                # one at a time
+                return self.probe + self.cooloff - now
+            self.probe = now
+            return 0
+
+    def abandon(self):
+        """The probe didn't try the host after all, let the next one."""
+        with self.lock:
+            self.probe = None
+
+    def success(self):
+        with self.lock:
+            self.count = 0
+            self.trips = 0
+            self.open_until = 0
+            self.probe = None
+
+    def failure(self, now):
+        """Note a failure. Returns the cooloff if that opened the breaker."""
+        with self.lock:
+            self.count += 1
+            if self.count < self.failures and self.probe is None:
+                return 0
+            wait = min(self.cooloff * 2 ** self.trips, self.max_cooloff)
+            self.trips += 1
+            self.open_until = now + wait
+            self.probe = None
+            return wait
+
+
+# one per remote host, shared by every section that sends to it
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_breaker(key, failures=2, cooloff=300):
+    with breakers_lock:
+        if key not in breakers:
+            breakers[key] = CircuitBreaker(failures, cooloff)
+        return breakers[key]
+
+
+def stat_count(value):
+    """Turn an rsync --stats figure, eg: '1,854,920 bytes', into an int."""
+    return int(value.split()[0].replace(',', ''))
+
+
+def stat_float(value):
+    """As stat_count, for the times, eg: '0.001 seconds'."""
+    return float(value.split()[0].replace(',', ''))
+
+
+def sum_stats(results):
+    """Add up the --stats of parallel runs."""
+    total = collections.OrderedDict()
+    for rsyncinfo in results:
+        for (name, value) in rsyncinfo.items():
+            try:
+                total[name] = total.get(name, 0) + stat_float(value)
+            except (ValueError, IndexError, AttributeError):
+                pass
+    return dict((name, "%s" % (int(n) if n == int(n) else n))
+                for (name, n) in total.items())
+
+
+# the --stats fields kept for each transfer; field, rsync's name, type
+STATS_FIELDS = (
+    ('files', 'Number of regular files transferred', stat_count),
+    ('files_total', 'Number of files', stat_count),
+    ('created', 'Number of created files', stat_count),
+    ('deleted', 'Number of deleted files', stat_count),
+    ('total_size', 'Total file size', stat_count),
+    ('transferred', 'Total transferred file size', stat_count),
+    ('literal', 'Literal data', stat_count),
+    ('matched', 'Matched data', stat_count),
+    ('flist_size', 'File list size', stat_count),
+    ('flist_build', 'File list generation time', stat_float),
+    ('flist_xfer', 'File list transfer time', stat_float),
+    ('sent', 'Total bytes sent', stat_count),
+    ('received', 'Total bytes received', stat_count),
+)
+
+# the phases of a job, as timed by Phases
+PHASES = ('prepare', 'connect', 'transfer', 'finish')
+
+# one transfer; when, where to, how it went, rsync's --stats, the seconds
+# spent in each phase, the CPU seconds rsync used and the compression
+TransferStats = collections.namedtuple(
+    'TransferStats',
+    ['dateTime', 'section', 'dest', 'outcome', 'ok', 'duration'] +
+    [field for (field, name, kind) in STATS_FIELDS] + ['speedup'] +
+    ['phase_%s' % phase for phase in PHASES] + ['cpu', 'compress'])
+
+
+class Phases(object):
+    """The wall clock time of each phase of a job."""
+
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.times = collections.OrderedDict()
+
+    def mark(self, name):
+        """The phase name ends now."""
+        now = time.time()
+        self.times[name] = self.times.get(name, 0) + now - self.last
+        self.last = now
+        return now
+
+
+def transfer_stats(job, outcome, rsyncinfo):
+    """The TransferStats for a job that has run."""
+    values = {}
+    for (field, name, kind) in STATS_FIELDS:
+        try:
+            values[field] = kind(rsyncinfo[name])
+        except (KeyError, ValueError, IndexError):
+            values[field] = 0
+    if not values['files'] and 'Number of files transferred' in rsyncinfo:
+        # rsync before 3.1
+        values['files'] = stat_count(rsyncinfo['Number of files transferred'])
+    if not values['sent'] and 'sent' in rsyncinfo:
+        values['sent'] = stat_count(rsyncinfo['sent'])
+        values['received'] = stat_count(rsyncinfo['received'])
+    wire = values['sent'] + values['received']
+    # worked out, rsync's own figure doesn't add up over parallel runs
+    speedup = float(values['total_size']) / wire if wire else None
+    phases = job.phases.times
+    try:
+        cpu = stat_float(rsyncinfo['Rsync CPU time'])
+    except (KeyError, ValueError, IndexError):
+        cpu = None
+    return TransferStats(cpu=cpu, compress=job.compress_choice,
+        dateTime=int(job.phases.start), section=job.section, dest=job.key,
+        outcome=outcome, ok=int(outcome in ('ok', 'vanished', 'skipped')),
+        duration=job.phases.last - job.phases.start, speedup=speedup,
+        **dict([('phase_%s' % phase, phases.get(phase, 0))
+                for phase in PHASES], **values))
+
+
+class Cycle(object):
+    """What RsyncJob.sync() works out, step by step, for one transfer."""
+
+    def __init__(self, cmd):
+        self.t1 = time.time()
+        # the options, sources and destination are added when it's sent
+        self.opts = list(cmd)
+        # the explicit list of files to send, None for everything
+        self.files_from = None
+        # db_ship's staged files, dated_dir's --link-dest, whether this
+        # has to be a full transfer, the tiers due
+        self.shipping = None
+        self.link_dest = None
+        self.force_full = False
+        self.due = None
+        # what GeneratedFiles handed over, the Manifest's scan and what
+        # went ahead in a bundle
+        self.generated = None
+        self.scan = None
+        self.packed = None
+
+
+class RsyncJob(object):
+    """
+    One rsync transfer, as built by Rsynct for a report cycle.
+
+    Everything needed to run the transfer is captured when the job is
+    built so it can be handed to the TransferWorker and run away from
+    the report thread. The key identifies the destination; jobs that
+    share a key are merged by the worker.
+    """
+
+    def __init__(self, key, cmd, sources, server, user, rsynclocalspec,
+                 rsyncremotespec, rsync_rem_dir, log_success=True,
+                 timeout=None, parallel=1, master=None, manifest=None,
+                 full_sync_interval=None, delete=False, generated=None,
+                 progress_interval=None, snapshots=None, retention=None,
+                 remote_shell=None, databases=None, db_pages=256,
+                 shipper=None, native_dest=None, retries=2, backoff=5,
+                 breaker_key=None, breaker=None, dirs=None, section=None,
+                 metrics=None, exporter=None, config_time=0, tiers=None,
+                 compress_choice=None, fanout=None, batch=None, packer=None,
+                 publisher=None, wdebug=0):
+        self.key = key
+        # cmd holds the options only, sources and destination are added
+        # as the transfer(s) are run
+        self.cmd = cmd
+        self.sources = sources
+        self.server = server
+        self.user = user
+        self.rsynclocalspec = rsynclocalspec
+        self.rsyncremotespec = rsyncremotespec
+        self.rsync_rem_dir = rsync_rem_dir
+        self.log_success = log_success
+        self.timeout = timeout
+        self.parallel = parallel
+        # the SshMaster whose socket cmd's remote shell uses
+        self.master = master
+        # the Manifest deciding whether there's anything to send
+        self.manifest = manifest
+        self.full_sync_interval = full_sync_interval
+        self.delete = delete
+        # or the GeneratedFiles collecting what the reports wrote
+        self.generated = generated
+        # how often to log --info=progress2 lines, if at all
+        self.progress_interval = progress_interval
+        # dated_dir Snapshots, with the (daily, weekly, monthly) to keep
+        self.snapshots = snapshots
+        self.retention = retention
+        # ssh command, ending with the [user@]host, for remote housekeeping
+        self.remote_shell = remote_shell
+        # (database, staged copy) pairs, to be copied before rsync runs
+        self.databases = databases
+        self.db_pages = db_pages
+        # or the SegmentShipper staging new archive records
+        self.shipper = shipper
+        # server = localhost and local_engine = native, LocalSync to here
+        self.native_dest = native_dest
+        # what to do when it fails, see RSYNC_POLICY
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_key = breaker_key
+        self.breaker = breaker
+        # the directories known to exist at the far end, None for local
+        self.dirs = dirs
+        # the report section, and where to keep a record of each run
+        self.section = section
+        self.metrics = metrics
+        # timing spans, for Prometheus or statsd, None when that's off
+        self.exporter = exporter
+        self.config_time = config_time
+        # the per path schedules, see Tiers
+        self.tiers = tiers
+        # the compression Compression chose, kept with the stats
+        self.compress_choice = compress_choice
+        # the section's other destinations, see FanOut; or, for one of
+        # those, the (batch file, options) to replay rather than rsync
+        self.fanout = fanout
+        self.batch = batch
+        # as the run left it, for the FanOut; the options to replay the
+        # batch it wrote with, and whether the far end now matches the
+        # sources
+        self.batch_opts = None
+        self.in_sync = False
+        # pack_small's Packer, the small changed files go in a bundle
+        self.packer = packer
+        # publish = atomic's Publisher, native_dest is copied to a new
+        # generation and swapped in
+        self.publisher = publisher
+        self.phases = None
+        self.wdebug = wdebug
+        # number of earlier requests this job has absorbed
+        self.merged = 0
+
+    def merge(self, older):
+        """Absorb a queued, not yet started, job for the same destination.
+
+        rsync works from the state of the tree when it runs, so the newer
+        job covers everything the older one would have sent.
+        """
+        self.merged += older.merged + 1
+
+    def run(self):
+        """Perform the actual upload, and keep a record of how it went."""
+        self.phases = Phases()
+        (outcome, rsyncinfo) = self.sync()
+        # for whoever ran it, see main()
+        self.rsyncinfo = rsyncinfo
+        self.record(outcome, rsyncinfo)
+        if self.fanout is not None:
+            self.fanout.run(self, outcome)
+        return outcome
+
+    def record(self, outcome, rsyncinfo):
+        """To the MetricsStore and the SpanExporter, if there are any."""
+        if self.metrics is None and self.exporter is None:
+            return
+        record = transfer_stats(self, outcome, rsyncinfo)
+        if self.metrics is not None:
+            try:
+                self.metrics.add(record)
+            except sqlite3.Error as e:
+                logdbg("can't record the transfer in %s: %s"
+                       % (self.metrics.path, e))
+        if self.exporter is not None:
+            self.exporter.export(record, self.spans(rsyncinfo),
+                                 itemized(rsyncinfo))
+
+    def spans(self, rsyncinfo):
+        """Where the time went; ours, then rsync's own account."""
+        spans = collections.OrderedDict([('config', self.config_time)])
+        spans.update(self.phases.times)
+        for (span, name) in (('parse', 'Output parse time'),
+                             ('rsync_flist_build', 'File list generation time'),
+                             ('rsync_flist_xfer', 'File list transfer time')):
+            if name in rsyncinfo:
+                spans[span] = stat_float(rsyncinfo[name])
+        return spans
+
+    def sync(self):
+        """
+        Send the files. Returns the outcome, an RSYNC_POLICY class or
+        skipped, and the --stats fields.
+
+        A cycle goes through the steps below in turn; each feature that
+        has a say in what is sent (db_backup, db_ship, dated_dir, tiers,
+        files_from = generated, skip_unchanged) has its own prepare step,
+        any of which can decide there's nothing to do. Then the far end
+        is made ready, the files sent and the cycle's state recorded.
+        """
+        cycle = Cycle(self.cmd)
+        if self.breaker is not None:
+            wait = self.breaker.allow(cycle.t1)
+            if wait:
+                # the host is down, don't even try
+                logdbg("%s is unreachable, skipped, next try in %0.0f seconds"
+                       % (self.breaker_key, wait))
+                return 'breaker', {}
+
+        if self.batch is not None:
+            return self.read_batch(cycle.t1)
+
+        for step in (self.prepare_databases, self.prepare_shipping,
+                     self.prepare_snapshot, self.prepare_tiers,
+                     self.prepare_generated, self.prepare_manifest):
+            stop = step(cycle)
+            if stop is not None:
+                if self.breaker is not None:
+                    # if this was to be the breaker's probe, it wasn't
+                    self.breaker.abandon()
+                return stop
+        self.prepare_options(cycle)
+        self.phases.mark('prepare')
+
+        if self.master is not None:
+            # health check, and restart, the shared connection
+            self.master.ensure()
+        if self.native_dest is None:
+            cycle.opts = self.make_dest(cycle.opts)
+        self.phases.mark('connect')
+
+        self.pack(cycle)
+        (rsync_message, rsyncinfo, ok, klass) = self.send(cycle)
+        self.phases.mark('transfer')
+        self.tell_breaker(ok, klass)
+        self.finish(cycle, ok)
+        self.phases.mark('finish')
+
+        if self.log_success:
+            self.log_transfer(rsync_message, cycle.t1)
+        return klass, rsyncinfo
+
+    def prepare_databases(self, cycle):
+        """db_backup; stage the copies, with a block size to match."""
+        if not self.databases:
+            return None
+        block_size = self.stage_databases()
+        if block_size is None:
+            return 'local_missing', {}
+        cycle.opts.append('--block-size=%s' % block_size)
+        return None
+
+    def prepare_shipping(self, cycle):
+        """db_ship; stage the new archive records, if there are any."""
+        if self.shipper is None:
+            return None
+        try:
+            cycle.shipping = self.shipper.prepare()
+        except (sqlite3.Error, IOError, OSError) as e:
+            logerr(":  ERR db_ship of %s failed, nothing sent: %s"
+                   % (self.shipper.db, e))
+            return 'local_missing', {}
+        if not cycle.shipping:
+            if self.log_success:
+                loginf(": no new archive records for %s, rsync skipped"
+                       % self.rsyncremotespec)
+            return 'skipped', {}
+        # db_ship knows exactly what it has staged
+        cycle.files_from = cycle.shipping
+        return None
+
+    def prepare_snapshot(self, cycle):
+        """dated_dir; link against the last snapshot. A new snapshot has
+        to be complete, not just what has changed."""
+        if self.snapshots is None:
+            return None
+        cycle.force_full = self.snapshots.today not in self.snapshots.dates
+        cycle.link_dest = self.snapshots.link_dest()
+        if cycle.link_dest is not None:
+            cycle.opts.append('--link-dest=%s' % cycle.link_dest)
+        return None
+
+    def prepare_tiers(self, cycle):
+        """The filters for the tiers that are due, if any are."""
+        if self.tiers is None:
+            return None
+        # a new snapshot needs them all
+        cycle.due = self.tiers.due(cycle.t1, cycle.force_full)
+        if not cycle.due:
+            if self.wdebug >= 2:
+                logdbg("no tiers due for %s" % self.rsyncremotespec)
+            return 'skipped', {}
+        cycle.opts.extend(self.tiers.filters(cycle.due))
+        if self.wdebug >= 2:
+            logdbg("tiers due: %s" % ", ".join(cycle.due))
+        return None
+
+    def prepare_generated(self, cycle):
+        """files_from = generated; just what the reports wrote, unless a
+        full sync is due."""
+        if self.generated is None or cycle.shipping is not None:
+            return None
+        t1 = cycle.t1
+        cycle.generated = self.generated.take(self.key)
+        last_full = self.generated.last_full.get(self.key)
+        full_due = cycle.force_full or last_full is None or (
+            self.full_sync_interval and
+            t1 - last_full >= self.full_sync_interval)
+        if not full_due:
+            # the temporary files the generators renamed into place have
+            # gone, as have any since deleted
+            present = [path for path in cycle.generated
+                       if os.path.lexists(path)]
+            if not present:
+                self.in_sync = True
+                if self.log_success:
+                    loginf(": no files generated since the last transfer"
+                           " to %s, rsync skipped" % self.rsyncremotespec)
+                return 'skipped', {}
+            cycle.files_from = relative_paths(sorted(present), self.sources[0])
+        if self.wdebug >= 2:
+            logdbg("generated: %s files, full sync %s"
+                   % (len(cycle.generated), cycle.files_from is None))
+        return None
+
+    def prepare_manifest(self, cycle):
+        """skip_unchanged; nothing at all if nothing has changed, else
+        just the changed files, unless a full sync is due."""
+        if self.manifest is None or self.generated is not None or \
+                cycle.shipping is not None:
+            return None
+        t1 = cycle.t1
+        cycle.scan = self.manifest.scan(self.sources)
+        (changed, deleted) = self.manifest.changes(cycle.scan)
+        full_due = cycle.force_full or (self.full_sync_interval and
+            t1 - self.manifest.last_full >= self.full_sync_interval)
+        if not full_due and not changed and (not deleted or not self.delete):
+            if deleted:
+                # nothing for the far end to do about them
+                self.manifest.commit(cycle.scan)
+            self.in_sync = True
+            if self.log_success:
+                loginf(": no changes since the last transfer to %s, rsync"
+                       " skipped (%0.3f seconds)" % (self.rsyncremotespec,
+                                                     time.time() - t1))
+            return 'skipped', {}
+        if not full_due and not deleted and len(self.sources) == 1:
+            # tell rsync exactly what to send, rather than have it compare
+            # the whole tree at both ends
+            cycle.files_from = relative_paths(changed, self.sources[0])
+        if self.wdebug >= 2:
+            logdbg("manifest: %s changed, %s deleted, full sync %s"
+                   % (len(changed), len(deleted), cycle.files_from is None))
+        return None
+
+    def prepare_options(self, cycle):
+        """What the exporter and the FanOut want of rsync."""
+        if self.exporter is not None and self.native_dest is None:
+            # what rsync did to each file, counted by RsyncOutput
+            cycle.opts.append('--itemize-changes')
+        if self.fanout is not None and self.fanout.batch is not None and \
+                self.native_dest is None and \
+                not (self.parallel > 1 and len(self.sources) > 1):
+            # record what this run does, for the other destinations
+            self.batch_opts = replay_options(cycle.opts)
+            cycle.opts.append('--write-batch=%s' % self.fanout.batch)
+
+    def pack(self, cycle):
+        """pack_small; the small changed files go ahead, as a bundle."""
+        if self.packer is None or not cycle.files_from or \
+                cycle.shipping is not None:
+            return
+        (cycle.files_from, small) = self.packer.split(self.sources[0],
+                                                      cycle.files_from)
+        if small:
+            cycle.packed = self.send_bundle(small)
+            if cycle.packed is None:
+                # the usual way then
+                cycle.files_from = cycle.files_from + small
+
+    def send(self, cycle):
+        """Run the transfer, whichever way this job does it. Returns as
+        transfer() does."""
+        opts = cycle.opts
+        packed = cycle.packed
+        if self.native_dest is not None:
+            (rsync_message, rsyncinfo, ok) = self.local_sync(cycle.files_from,
+                                                             cycle.link_dest)
+            return rsync_message, rsyncinfo, ok, 'ok' if ok else 'unknown'
+        if self.parallel > 1 and len(self.sources) > 1:
+            return self.send_parallel(opts)
+        if packed is not None and not cycle.files_from:
+            # nothing left for rsync
+            rsync_message = "packed %s files (%s) in %%0.2f seconds" % (
+                packed['Packed files'], packed['Packed file size'])
+            rsyncinfo = dict(packed)
+            rsyncinfo['Number of regular files transferred'] = \
+                packed['Packed files']
+            rsyncinfo['Total transferred file size'] = \
+                packed['Packed file size']
+            rsyncinfo['Total bytes sent'] = packed['Packed bundle size']
+            return rsync_message, rsyncinfo, True, 'ok'
+        if cycle.files_from is None:
+            return self.transfer(opts + self.sources + [self.rsyncremotespec])
+        with tempfile.NamedTemporaryFile('w', prefix='rsynct-',
+                                         suffix='.files') as listing:
+            listing.write("\n".join(cycle.files_from) + "\n")
+            listing.flush()
+            cmd = opts + ['--files-from=%s' % listing.name] + \
+                self.sources + [self.rsyncremotespec]
+            (rsync_message, rsyncinfo, ok, klass) = self.transfer(cmd)
+        if packed is not None:
+            rsync_message = rsync_message.replace(
+                " in %0.2f", ", packed %s more in %%0.2f" % packed['Packed files'])
+            rsyncinfo.update(packed)
+            try:
+                rsyncinfo['Total bytes sent'] = str(
+                    stat_count(rsyncinfo['Total bytes sent']) +
+                    stat_count(packed['Packed bundle size']))
+            except (KeyError, ValueError, IndexError):
+                pass
+        return rsync_message, rsyncinfo, ok, klass
+
+    def send_parallel(self, opts):
+        """Each source with its own rsync, at most parallel at a time, the
+        results rolled up into the one message."""
+        cmds = [opts + [src, self.rsyncremotespec] for src in self.sources]
+        workers = min(self.parallel, len(cmds))
+        if self.wdebug >= 2:
+            logdbg("splitting %s sources over %s rsync workers"
+                   % (len(cmds), workers))
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(self.transfer, cmds))
+        rsync_message = self.combine(results)
+        rsyncinfo = sum_stats([r[1] for r in results])
+        ok = not [r for r in results if not r[2]]
+        klass = [r[3] for r in results if not r[2]][0] if not ok else 'ok'
+        return rsync_message, rsyncinfo, ok, klass
+
+    def finish(self, cycle, ok):
+        """Record what the far end now has, for each feature that keeps
+        track."""
+        files_from = cycle.files_from
+        if not ok:
+            self.batch_opts = None
+        # everything was looked at, nothing held back
+        self.in_sync = ok and files_from is None and \
+            (cycle.due is None or not self.tiers.filters(cycle.due))
+        if ok and self.dirs is not None:
+            self.dirs.add(self.rsync_rem_dir)
+        if ok and cycle.due:
+            self.tiers.sent(cycle.due, cycle.t1)
+        if ok and cycle.shipping:
+            self.shipper.shipped(cycle.shipping)
+        if ok and self.snapshots is not None:
+            self.snapshots.add()
+            self.prune()
+        if ok and cycle.scan is not None:
+            # only now is the far end known to match the scan
+            self.manifest.commit(cycle.scan, full=files_from is None)
+        if self.generated is not None:
+            if not ok and cycle.generated:
+                # try them again next time
+                self.generated.restore(self.key, cycle.generated)
+            elif ok and files_from is None:
+                self.generated.last_full[self.key] = cycle.t1
+
+    def log_transfer(self, rsync_message, t1):
+        rsyncremotespec = self.rsyncremotespec
+        if self.wdebug == 0:
+            to = ''
+            rsyncremotespec = ''
+        else:
+            to = ' to '
+        if self.merged:
+            to = " (merged %s requests)%s" % (self.merged + 1, to)
+        t2 = time.time()
+        loginf(": %s" % rsync_message % (t2 - t1) + to + rsyncremotespec)
+
+    def send_bundle(self, small):
+        """
+        Pack small, a list of files, into a bundle and have the far end's
+        rsynct_receiver.py unpack it, copying that there first if need
+        be. Returns the stats for the bundle, or None if it couldn't be
+        sent and the files still need to be.
+        """
+        packer = self.packer
+        try:
+            (path, digest, packed, size) = rsynct_receiver.write_bundle(
+                self.sources[0], small, packer.staging)
+        except (IOError, OSError, tarfile.TarError) as e:
+            logerr(":  ERR can't pack the small files for %s: %s"
+                   % (self.rsyncremotespec, e))
+            return None
+        wire = os.path.getsize(path)
+        holding = self.rsync_rem_dir + rsynct_receiver.RECEIVER_DIR
+        receiver = "%s/rsynct_receiver.py" % holding
+        try:
+            due = packer.receiver_due()
+            if due is not None:
+                (rc, errors) = self.remote(
+                    "mkdir -p %s && cat > %s.tmp && mv -f %s.tmp %s" % (
+                        shlex.quote(holding), shlex.quote(receiver),
+                        shlex.quote(receiver), shlex.quote(receiver)),
+                    packer.receiver)
+                if rc != 0:
+                    logerr(":  ERR can't copy rsynct_receiver.py to %s (%s): %s"
+                           % (self.rsyncremotespec, rc, errors))
+                    return None
+                packer.receiver_sent(due)
+            (rc, errors) = self.remote("%s %s unpack %s %s" % (
+                RECEIVER_PYTHON, shlex.quote(receiver),
+                shlex.quote(self.rsync_rem_dir), digest), path)
+        finally:
+            os.unlink(path)
+        if rc != 0:
+            if rc == 127:
+                # there's no python; stop trying
+                packer.broken = True
+                logerr(":  ERR pack_small needs %s at %s, not packing"
+                       % (RECEIVER_PYTHON, self.server))
+            else:
+                # maybe the receiver went with the directory
+                packer.receiver_sent(None)
+                logerr(":  ERR bundle for %s wasn't unpacked (%s): %s"
+                       % (self.rsyncremotespec, rc, errors))
+            return None
+        if self.wdebug >= 2:
+            logdbg("packed %s files, %s bytes, into %s"
+                   % (len(packed), size, os.path.basename(path)))
+        return {'Packed files': str(len(packed)),
+                'Packed file size': "%s bytes" % size,
+                'Packed bundle size': "%s bytes" % wire}
+
+    def remote(self, command, stdin):
+        """Run command at the far end, the file stdin on its standard
+        input. Returns (exit code, what it said on stderr)."""
+        try:
+            with open(stdin, 'rb') as f:
+                proc = subprocess.run(self.remote_shell + [command], stdin=f,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE,
+                                      timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return -1, "timed out"
+        except (IOError, OSError) as e:
+            return -1, "%s" % e
+        return proc.returncode, proc.stderr.decode('utf-8', 'replace').strip()
+
+    def tell_breaker(self, ok, klass):
+        """Let the host's CircuitBreaker know how it went."""
+        if self.breaker is None:
+            return
+        if ok:
+            self.breaker.success()
+        elif RSYNC_POLICY[klass][1]:
+            cooloff = self.breaker.failure(time.time())
+            if cooloff:
+                logerr(":  ERR %s unreachable, no transfers to it for %s"
+                       " seconds" % (self.breaker_key, cooloff))
+
+    def read_batch(self, t1):
+        """
+        Replay the batch another destination's rsync wrote, rather than
+        work out the changes again. Locally rsync reads the file itself,
+        a remote rsync has it fed through ssh. Returns as sync() does.
+        """
+        (path, opts) = self.batch
+        # one that didn't apply won't on a second go, FanOut has a full
+        # rsync do it instead
+        self.retries = 0
+        self.phases.mark('prepare')
+        if self.master is not None:
+            self.master.ensure()
+        self.phases.mark('connect')
+        if self.remote_shell is None:
+            self.make_dest([])
+            cmd = ['rsync', '--read-batch=%s' % path] + opts + \
+                [self.rsync_rem_dir]
+            stdin = None
+        else:
+            remote = " ".join(
+                shlex.quote(arg) for arg in ['rsync', '--read-batch=-'] +
+                opts + [self.rsync_rem_dir])
+            if self.dirs is None or not self.dirs.known(self.rsync_rem_dir):
+                # on the same connection, as make_dest() has rsync do it
+                remote = "mkdir -p %s && %s" % (
+                    shlex.quote(self.rsync_rem_dir), remote)
+            cmd = self.remote_shell + [remote]
+            stdin = path
+        (rsync_message, rsyncinfo, ok, klass) = self.transfer(cmd, stdin)
+        self.phases.mark('transfer')
+        self.tell_breaker(ok, klass)
+        self.in_sync = ok
+        if ok and self.dirs is not None:
+            self.dirs.add(self.rsync_rem_dir)
+        self.phases.mark('finish')
+        if self.log_success:
+            loginf(": %s to %s, from the batch" % (
+                rsync_message % (time.time() - t1), self.rsyncremotespec))
+        return klass, rsyncinfo
+
+    def make_dest(self, opts):
+        """
+        See the destination directory exists before rsync needs it.
+
+        Returns opts, with the remote mkdir added if it is called for.
+        """
+        if self.remote_shell is None:
+            # local, a stat is all it takes. rsyncremotespec, it has been
+            # moved off / if need be
+            try:
+                os.makedirs(self.rsyncremotespec, exist_ok=True)
+            except OSError as e:
+                logdbg("mkdir %s: %s" % (self.rsyncremotespec, e))
+            return opts
+        if self.dirs is None or self.dirs.known(self.rsync_rem_dir):
+            return opts
+        rsync_path = mkdir_rsync_path(opts, self.rsync_rem_dir)
+        if rsync_path is None:
+            # one remote command, over the master if there is one
+            if self.make_dest_dir():
+                self.dirs.add(self.rsync_rem_dir)
+            return opts
+        if self.wdebug >= 2:
+            logdbg("%s not known to exist, creating it" % self.rsync_rem_dir)
+        return opts + [rsync_path]
+
+    def local_sync(self, files_from, link_dest):
+        """The LocalSync equivalent of transfer(), less its class."""
+        staged = None
+        dest = self.native_dest
+        delete = self.delete
+        if self.publisher is not None:
+            # a whole new tree, what's unchanged linked from the last
+            (link_dest, files_from, delete) = (self.publisher.current(),
+                                               None, False)
+        try:
+            if self.publisher is not None:
+                dest = staged = self.publisher.stage()
+            sync = LocalSync(self.sources, dest, delete, files_from,
+                             link_dest, max(self.parallel, 4))
+            rsyncinfo = sync.run()
+            if staged is not None:
+                self.publisher.publish(staged)
+        except (IOError, OSError) as e:
+            logerr(":  ERR local copy to %s failed: %s" % (dest, e))
+            if staged is not None:
+                self.publisher.discard(staged)
+            return "local copy failed after %0.2f seconds", {}, False
+        rsync_message = "copied %s files (%s) in %%0.2f seconds, native" % (
+            rsyncinfo['Number of regular files transferred'],
+            rsyncinfo['Total transferred file size'])
+        return rsync_message, rsyncinfo, True
+
+    def stage_databases(self):
+        """Take a consistent copy of each database into the staging area.
+
+        Returns the rsync block size to use, None if a copy failed.
+        """
+        block_size = None
+        for (db, staged) in self.databases:
+            t1 = time.time()
+            try:
+                (page_size, size) = sqlite_snapshot(db, staged, self.db_pages)
+            except (sqlite3.Error, IOError, OSError) as e:
+                logerr(":  ERR backup of %s failed, nothing sent: %s" % (db, e))
+                return None
+            if self.wdebug >= 2:
+                logdbg("staged %s (%s bytes) in %0.2f seconds"
+                       % (db, size, time.time() - t1))
+            block_size = max(block_size or 0, sqlite_block_size(page_size, size))
+        return block_size
+
+    def prune(self):
+        """Remove the snapshots the retention policy no longer wants.
+
+        All of them go in one pass; one rm over the ssh connection for a
+        remote destination.
+        """
+        expired = self.snapshots.expired(*self.retention)
+        if not expired:
+            return
+        paths = [self.snapshots.path_of(date) for date in expired]
+        # and the month and year directories, if that leaves them empty
+        parents = sorted(set(os.path.dirname(p) for p in paths))
+        parents += sorted(set(os.path.dirname(p) for p in parents))
+        if self.remote_shell is None:
+            for path in paths:
+                shutil.rmtree(path, ignore_errors=True)
+            for path in parents:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+            rc = 0
+        else:
+            script = "rm -rf -- %s; rmdir %s 2>/dev/null; true" % (
+                " ".join(shlex.quote(p) for p in paths),
+                " ".join(shlex.quote(p) for p in parents))
+            try:
+                rc = subprocess.call(self.remote_shell + [script],
+                                     stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL,
+                                     timeout=self.timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                rc = -1
+        if rc == 0:
+            self.snapshots.forget(expired)
+            if self.dirs is not None:
+                self.dirs.forget(paths)
+            loginf(": removed %s expired snapshots from %s"
+                   % (len(expired), self.rsyncremotespec))
+        else:
+            logerr(":  ERR removing expired snapshots from %s failed (%s),"
+                   " will try again" % (self.rsyncremotespec, rc))
+
+    @staticmethod
+    def combine(results):
+        """Roll the results of parallel runs up into one message."""
+        nfiles = nbytes = 0
+        failed = []
+        for (rsync_message, rsyncinfo, ok, klass) in results:
+            try:
+                if 'Number of regular files transferred' in rsyncinfo:
+                    N = rsyncinfo['Number of regular files transferred']
+                else:
+                    N = rsyncinfo['Number of files transferred']
+                nfiles += stat_count(N)
+                nbytes += stat_count(rsyncinfo['Total transferred file size'])
+            except (KeyError, ValueError):
+                failed.append(rsync_message % 0)
+        rsync_message = "rsync'd %s files (%s bytes) with %s parallel jobs" \
+                        " in %%0.2f seconds" % (format(nfiles, ','),
+                                                format(nbytes, ','),
+                                                len(results))
+        if failed:
+            rsync_message += ", %s failed (%s)" % (
+                len(failed), "; ".join(failed).replace('%', '%%'))
+        return rsync_message
+
+    def transfer(self, cmd, stdin=None):
+        """Run one rsync command, acting on the outcome as RSYNC_POLICY says.
+
+        Returns the message for the log, still to be given the elapsed
+        time, the --stats fields that were found, whether rsync succeeded
+        and the class of the outcome. stdin, a file, is fed to rsync.
+        """
+        attempt = 0
+        while True:
+            (output, returncode, timed_out) = self.rsync(cmd, stdin)
+            errors = output.error_text()
+            klass = classify(returncode, errors, timed_out)
+            (action, hint) = RSYNC_POLICY[klass][0:3:2]
+            if action == 'mkdir' and self.dirs is not None:
+                # it has gone since it was remembered; made again now, or
+                # by the next cycle if there are no retries left
+                self.dirs.forget([self.rsync_rem_dir])
+            if action == 'done' or attempt >= self.retries:
+                break
+            if action == 'retry':
+                # exponential backoff, 5, 10, 20... seconds by default
+                delay = self.backoff * 2 ** attempt
+                logdbg("rsync to %s: %s, retrying in %s seconds"
+                       % (self.rsyncremotespec, hint, delay))
+                time.sleep(delay)
+            elif action == 'mkdir':
+                if not self.make_dest_dir():
+                    break
+            else:
+                break
+            attempt += 1
+
+        rsyncinfo = output.stats
+        if action == 'done':
+            # get number of files and bytes transferred and produce an
+            # appropriate message
+            try:
+                if 'Number of regular files transferred' in rsyncinfo:
+                    N = rsyncinfo['Number of regular files transferred']
+                else:
+                    N = rsyncinfo['Number of files transferred']
+                Nbytes = rsyncinfo['Total transferred file size']
+                rsync_message = "rsync'd %s files (%s) in %%0.2f seconds" % (N, Nbytes)
+            except KeyError:
+                rsync_message = "rsync executed in %0.2f seconds"
+            if klass == 'vanished':
+                rsync_message += " (some files vanished as they were sent)"
+            return rsync_message, rsyncinfo, True, klass
+
+        # Tell them what went wrong, and what to look at
+        logerr(":  ERR rsync to %s failed, %s (exit code %s%s): %s"
+               % (self.rsyncremotespec, hint, returncode,
+                  ", after %s attempts" % (attempt + 1) if attempt else "",
+                  errors.replace("\n", ". ") or "no error output"))
+        if self.wdebug >= 1:
+            logdbg("rsync command was: %s" % " ".join(cmd))
+        rsync_message = "code %s, %s, rsync failed after %%0.2f seconds" % (
+            returncode, klass)
+        return rsync_message, rsyncinfo, False, klass
+
+    def rsync(self, cmd, stdin=None):
+        """Run rsync, with the file stdin on its standard input. Returns
+        its RsyncOutput, exit code and whether it was killed for exceeding
+        the timeout."""
+        wdebug = self.wdebug
+        infile = None
+        try:
+            # perform the actual rsync transfer...
+            if wdebug >= 2:
+                logdbg(" cmd is %s" % (" ".join(cmd)))
+            if stdin is not None:
+                infile = open(stdin, 'rb')
+            # in its own session so a timeout can take out rsync's ssh too
+            rsynccmd = subprocess.Popen(cmd, stdin=infile,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        start_new_session=True)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                logerr(": rsync does not appear to be installed on this system. (errno %d, \"%s\")" % (e.errno, e.strerror))
+            raise
+        finally:
+            if infile is not None:
+                # rsync has its own copy
+                infile.close()
+        # read it as it comes, rather than hold all of -v's file names
+        output = RsyncOutput(self.rsyncremotespec, self.progress_interval,
+                             timing=self.exporter is not None)
+        timed_out = output.follow(rsynccmd, self.timeout)
+        if output.cpu is not None:
+            output.stats['Rsync CPU time'] = "%0.3f seconds" % output.cpu
+        if output.parse_time is not None:
+            # along with the --stats, so they add up over parallel runs
+            output.stats['Output parse time'] = "%0.6f seconds" % output.parse_time
+            for (kind, n) in output.items.items():
+                output.stats['Itemized %s' % kind] = str(n)
+        if wdebug >= 2:
+            logdbg("rsync output: %s lines, exit code %s"
+                   % (output.nlines, rsynccmd.returncode))
+        return output, rsynccmd.returncode, timed_out
+
+    def make_dest_dir(self):
+        """Create the destination directory, for the missing_dir class.
+
+        Waits for it, so the retry that follows finds it in place.
+        """
+        loginf(": creating missing destination directory %s"
+               % self.rsync_rem_dir)
+        if self.remote_shell is None:
+            try:
+                os.makedirs(self.rsyncremotespec, exist_ok=True)
+                return True
+            except OSError as e:
+                logerr(":  ERR mkdir %s failed: %s" % (self.rsyncremotespec, e))
+                return False
+        try:
+            rc = subprocess.call(self.remote_shell + ["mkdir -p %s" %
+                                                      shlex.quote(self.rsync_rem_dir)],
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL,
+                                 timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            rc = -1
+        if rc != 0:
+            logerr(":  ERR remote mkdir -p %s failed (%s)" % (self.rsync_rem_dir, rc))
+        return rc == 0
+
+
+class TransferWorker(object):
+    """
+    Runs RsyncJobs in the background, away from the StdReport thread.
+
+    Each destination gets its own thread, started on demand, which exits
+    once there is nothing left queued for it. A destination therefore has
+    at most one job running and one waiting; anything submitted while a
+    job is waiting is merged into it, so a slow link can never build up
+    a backlog. The threads are not daemonic, wee_reports will wait for
+    the outstanding transfers (bounded by transfer_timeout) before it
+    exits.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.threads = {}
+
+    def submit(self, job):
+        """Queue job, merging it with any job waiting on the same key."""
+        with self.lock:
+            older = self.pending.get(job.key)
+            if older is not None:
+                job.merge(older)
+                logdbg("merged queued transfer to %s (%s requests)"
+                       % (job.key, job.merged + 1))
+            self.pending[job.key] = job
+            if job.key not in self.threads:
+                t = threading.Thread(target=self._drain, args=(job.key,),
+                                     name="rsynct-%s" % job.key)
+                self.threads[job.key] = t
+                t.start()
+            elif older is None:
+                logdbg("transfer to %s still running, queued" % job.key)
+
+    def _drain(self, key):
+        while True:
+            with self.lock:
+                job = self.pending.pop(key, None)
+                if job is None:
+                    del self.threads[key]
+                    return
+            try:
+                job.run()
+            except Exception as e:
+                logerr(": transfer to %s failed: %s" % (key, e))
+
+
+# the one worker shared by every RsyncTransfer section in this process
+transfer_worker = TransferWorker()
+
+
+class SshMaster(object):
+    """
+    A long lived, multiplexed, ssh connection to one user@server:port.
+
+    Every rsync to that host rides on the master's ControlPath socket so
+    the TCP and ssh handshakes are paid once, not once per report cycle.
+    ControlPersist makes an orphaned master (weewx killed outright) go
+    away by itself once idle. Nothing here depends on weewx, so it can be
+    exercised on its own against a local sshd, eg:
+        SshMaster('me', 'localhost', 2222).ensure()
+
+    The socket's directory, control_dir, has to belong to this user and
+    be closed to everyone else; another user could make it first and
+    leave a socket of their own there. If it isn't, the master isn't used
+    and every rsync connects directly. TransferPlan puts it in state_dir,
+    without one it is /tmp/rsynct-<uid>.
+    """
+
+    def __init__(self, user, server, port=None, ssh_options=None,
+                 persist=600, ssh='ssh', control_dir=None):
+        if user:
+            self.target = "%s@%s" % (user, server)
+        else:
+            self.target = server
+        self.port = port
+        self.ssh_options = ssh_options or []
+        self.persist = persist
+        self.ssh = ssh
+        if control_dir is None:
+            control_dir = os.path.join(tempfile.gettempdir(),
+                                       "rsynct-%s" % os.getuid())
+        # keep it short, unix socket paths are limited to ~100 characters
+        tag = hashlib.sha1(("%s:%s" % (self.target, port)).encode()).hexdigest()
+        self.control_dir = control_dir
+        self.control_path = os.path.join(control_dir, tag[:16])
+        self.lock = threading.Lock()
+        self.private = self.check_dir()
+
+    def check_dir(self):
+        """Create control_dir if need be, True if it is ours alone."""
+        if len(self.control_path) > 100:
+            logerr(": %s is too long for a socket, not using an ssh master"
+                   % self.control_path)
+            return False
+        try:
+            os.mkdir(self.control_dir, 0o700)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logerr(": can't create %s for the ssh master: %s"
+                   % (self.control_dir, e))
+            return False
+        st = os.lstat(self.control_dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or \
+                st.st_mode & 0o077:
+            logerr(": %s isn't a directory private to this user, not using"
+                   " an ssh master" % self.control_dir)
+            return False
+        return True
+
+    def ssh_args(self):
+        """The ssh options shared by the master and its clients."""
+        args = []
+        if self.port:
+            args.extend(['-p', str(self.port)])
+        if self.private:
+            args.extend(['-o', 'ControlPath=%s' % self.control_path])
+        args.extend(self.ssh_options)
+        return args
+
+    def rsh_args(self):
+        """The ssh command clients run, as a list.
+
+        ControlMaster=no means a missing master costs nothing more than a
+        normal, direct, connection.
+        """
+        args = [self.ssh] + self.ssh_args()
+        if self.private:
+            args.extend(['-o', 'ControlMaster=no'])
+        return args
+
+    def rsh(self):
+        """The remote shell string for rsync's -e option."""
+        return shell_join(self.rsh_args())
+
+    def _ctl(self, op, timeout=10):
+        cmd = [self.ssh] + self.ssh_args() + ['-O', op, self.target]
+        try:
+            return subprocess.call(cmd, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            return -1
+
+    def check(self):
+        """Health check, a local query of the master over its socket."""
+        return self.private and os.path.exists(self.control_path) and \
+            self._ctl('check') == 0
+
+    def start(self, timeout=30):
+        """Open the master connection. Returns True if it is up."""
+        # it may have been cleared away, and made again by someone else,
+        # since
+        if not self.private or not self.check_dir():
+            self.private = False
+            return False
+        if os.path.exists(self.control_path):
+            # left by a master that has died
+            os.unlink(self.control_path)
+        cmd = [self.ssh] + self.ssh_args() + [
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist=%s' % self.persist,
+            '-o', 'BatchMode=yes',
+            '-o', 'ServerAliveInterval=30',
+            '-f', '-N', self.target]
+        # -f leaves the master holding whatever it inherited, so use a
+        # file rather than a pipe for its errors
+        with tempfile.TemporaryFile() as err:
+            try:
+                rc = subprocess.call(cmd, stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.DEVNULL, stderr=err,
+                                     timeout=timeout)
+            except subprocess.TimeoutExpired:
+                rc = -1
+            err.seek(0)
+            errmsg = err.read().decode('utf-8', 'replace').strip()
+        if rc != 0:
+            logerr(": ssh master to %s failed (%s) %s, using direct connections"
+                   % (self.target, rc, errmsg))
+            return False
+        logdbg("ssh master to %s started, %s" % (self.target, self.control_path))
+        return True
+
+    def ensure(self):
+        """Make sure the master is up, (re)starting it if needed."""
+        with self.lock:
+            if self.check():
+                return True
+            return self.start()
+
+    def close(self):
+        """Shut the master down, if it's running."""
+        with self.lock:
+            if self.private and os.path.exists(self.control_path):
+                self._ctl('exit')
+                logdbg("ssh master to %s closed" % self.target)
+
+
+class SshMasterPool(object):
+    """The SshMasters for this process, one per (user, server, port)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.masters = {}
+
+    def get(self, user, server, port=None, ssh_options=None, persist=600,
+            control_dir=None):
+        key = (user, server, str(port))
+        with self.lock:
+            if key not in self.masters:
+                self.masters[key] = SshMaster(user, server, port,
+                                              ssh_options=ssh_options,
+                                              persist=persist,
+                                              control_dir=control_dir)
+            return self.masters[key]
+
+    def close_all(self):
+        with self.lock:
+            masters = list(self.masters.values())
+            self.masters = {}
+        for master in masters:
+            master.close()
+
+
+# masters are shared by every section that talks to the same host, and
+# are closed when weewx shuts down
+ssh_pool = SshMasterPool()
+atexit.register(ssh_pool.close_all)
+
+
+def shell_join(args):
+    """args as one string, quoted as a shell (and rsync's -e) splits it."""
+    return " ".join(shlex.quote(arg) for arg in args)
+
+
+def rsynct_state_dir(config_dict, skin_section):
+    """
+    Where to keep what needs remembering between cycles.
+
+    state_dir if given, otherwise alongside the weewx sqlite databases,
+    somewhere weewx can already write to.
+    """
+    path = skin_section.get('state_dir')
+    if path is None:
+        try:
+            path = os.path.join(config_dict.get('WEEWX_ROOT', ''),
+                                config_dict['DatabaseTypes']['SQLite']['SQLITE_ROOT'])
+        except KeyError:
+            path = tempfile.gettempdir()
+    return path
+
+
+def state_file(state_dir, kind, *keys):
+    """A file in state_dir, named for whatever keys identify it."""
+    tag = hashlib.sha1(repr(keys).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(state_dir, "rsynctransfer-%s.%s" % (tag, kind))
+
+
+def save_json(path, obj):
+    """Write obj as json, atomically, so a crash can't leave half a file."""
+    tmp = "%s.tmp" % path
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def rsynct_databases(config_dict, option):
+    """
+    The SQLite database files db_backup asks for.
+
+    true is the weewx archive, wx_binding; otherwise a list of bindings
+    and/or database paths.
+    """
+    if option is None or option is False or option == '':
+        return []
+    if not isinstance(option, list):
+        option = [option]
+    if len(option) == 1 and option[0].lower() in ('true', 'yes', 'false', 'no'):
+        if not to_bool(option[0]):
+            return []
+        option = ['wx_binding']
+    paths = []
+    for name in option:
+        if name in config_dict.get('DataBindings', {}):
+            database = config_dict['DataBindings'][name]['database']
+            db_dict = weewx.manager.get_database_dict_from_config(config_dict,
+                                                                 database)
+            name = os.path.join(config_dict.get('WEEWX_ROOT', ''),
+                                db_dict.get('SQLITE_ROOT', ''),
+                                db_dict['database_name'])
+        paths.append(name)
+    return paths
+
+
+def sqlite_snapshot(src, dst, pages=256, sleep=0.05):
+    """
+    Copy SQLite database src to dst with the online backup API.
+
+    The copy goes a few pages at a time, so a writer (weewx archiving a
+    record) is never kept waiting for long; if it does write, the backup
+    starts over and the copy is still consistent. It is made under a
+    temporary name and renamed into place. Returns the page size and size
+    of the copy.
+    """
+    staging = os.path.dirname(dst)
+    if not os.path.isdir(staging):
+        os.makedirs(staging)
+    tmp = "%s.tmp" % dst
+    source = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(src),
+                             uri=True, timeout=30)
+    try:
+        target = sqlite3.connect(tmp)
+        try:
+            source.backup(target, pages=pages, sleep=sleep)
+            page_size = target.execute("PRAGMA page_size").fetchone()[0]
+        finally:
+            target.close()
+    finally:
+        source.close()
+    os.replace(tmp, dst)
+    return page_size, os.path.getsize(dst)
+
+
+def sqlite_block_size(page_size, size):
+    """
+    An rsync --block-size that lines up with the database's pages.
+
+    A page if that keeps the checksum list to a reasonable length, else
+    the smallest multiple of a page that does, within rsync's limit.
+    """
+    pages = max(1, -(-size // (page_size * 65536)))
+    return min(page_size * pages, 131072)
+
+
+class SegmentShipper(object):
+    """
+    db_ship: send a database as a base copy, once, then as segments of
+    just the archive records added since; see rsynct_segments.
+
+    What has been exported (the newest dateTime) is remembered in
+    state_path as soon as a segment is written, so nothing is exported
+    twice. Staged files stay in the staging directory until they have
+    been sent, so nothing is lost to a failed transfer either.
+    """
+
+    def __init__(self, db, staging, state_path, table='archive', pages=256):
+        self.db = db
+        self.staging = staging
+        self.state_path = state_path
+        self.table = table
+        self.pages = pages
+
+    def prepare(self):
+        """Stage whatever is due. Returns the staged files still to send."""
+        try:
+            with open(self.state_path) as f:
+                exported = json.load(f)['exported']
+        except (IOError, OSError, ValueError, KeyError):
+            exported = None
+        if exported is None:
+            # the base; and the tool to rebuild from it goes with it
+            tmp = os.path.join(self.staging, '.base.sdb')
+            sqlite_snapshot(self.db, tmp, self.pages)
+            exported = rsynct_segments.base_last(tmp, self.table) or 0
+            os.replace(tmp, rsynct_segments.base_name(self.staging, exported))
+            shutil.copy(rsynct_segments.__file__.replace('.pyc', '.py'),
+                        self.staging)
+            loginf(": db_ship base copy of %s taken, records up to %s"
+                   % (self.db, exported))
+        else:
+            conn = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(self.db),
+                                   uri=True, timeout=30)
+            try:
+                segment = rsynct_segments.write_segment(conn, exported,
+                                                        self.staging, self.table)
+            finally:
+                conn.close()
+            if segment is not None:
+                (path, exported, rows) = segment
+                logdbg("db_ship segment %s, %s records" % (path, rows))
+        save_json(self.state_path, {'exported': exported})
+        return sorted(name for name in os.listdir(self.staging)
+                      if not name.startswith('.'))
+
+    def shipped(self, names):
+        """names have reached the far end, they needn't be kept here."""
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.staging, name))
+            except OSError:
+                pass
+
+
+# what runs rsynct_receiver.py at the far end
+RECEIVER_PYTHON = 'python3'
+
+
+class Packer(object):
+    """
+    pack_small: the changed files up to threshold bytes go in one bundle,
+    piped over ssh to rsynct_receiver.py at the far end and unpacked
+    there, rather than each costing rsync a round trip or two; see
+    rsynct_receiver. The rest go with rsync as usual.
+
+    The receiver is copied to the destination's RECEIVER_DIR the first
+    time, and again whenever it changes here; state_path remembers the
+    sha256 of the copy that's there. Bundles are built in staging and
+    removed once sent, or not.
+    """
+
+    def __init__(self, threshold, staging, state_path):
+        self.threshold = threshold
+        self.staging = staging
+        self.state_path = state_path
+        self.receiver = rsynct_receiver.__file__.replace('.pyc', '.py')
+        # no python at the far end, don't keep trying
+        self.broken = False
+        try:
+            with open(state_path) as f:
+                self.sent = json.load(f).get('receiver')
+        except (IOError, OSError, ValueError, AttributeError):
+            self.sent = None
+
+    def split(self, root, paths):
+        """paths into (for rsync, to pack)."""
+        if self.broken:
+            return paths, []
+        large = []
+        small = []
+        for rel in paths:
+            try:
+                st = os.lstat(os.path.join(root, rel))
+            except OSError:
+                large.append(rel)
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size <= self.threshold:
+                small.append(rel)
+            else:
+                large.append(rel)
+        return large, small
+
+    def receiver_due(self):
+        """The sha256 of the receiver here, if the far end's is out of
+        date, None otherwise."""
+        digest = rsynct_receiver.file_sha256(self.receiver)
+        return None if digest == self.sent else digest
+
+    def receiver_sent(self, digest):
+        self.sent = digest
+        save_json(self.state_path, {'receiver': digest})
+
+
+class Manifest(object):
+    """
+    The state of the source trees at the last successful transfer to one
+    destination; path, size, mtime and, optionally, a fast content hash.
+
+    A directory is only listed again if its mtime has changed, otherwise
+    the names remembered from last time are used. Every file is still
+    lstat'ed, a file rewritten in place doesn't touch its directory.
+    With use_hash, a file whose size or mtime has moved but whose content
+    hasn't (a report regenerated as it was) doesn't count as changed.
+    """
+
+    def __init__(self, path, use_hash=False):
+        self.path = path
+        self.use_hash = use_hash
+        self.files = {}
+        self.dirs = {}
+        self.last_full = 0
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            self.files = saved['files']
+            self.dirs = saved['dirs']
+            self.last_full = saved.get('last_full', 0)
+        except (IOError, OSError, ValueError, KeyError):
+            # first run, or unreadable, everything counts as changed
+            pass
+
+    def scan(self, sources):
+        """Walk sources. Returns the new (files, dirs) state."""
+        files = {}
+        dirs = {}
+        for src in sources:
+            stack = [src.rstrip(os.sep) or os.sep]
+            while stack:
+                d = stack.pop()
+                try:
+                    st = os.lstat(d)
+                except OSError:
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    files[d] = self._entry(d, st)
+                    continue
+                known = self.dirs.get(d)
+                if known is not None and known[0] == st.st_mtime_ns:
+                    names = known[1]
+                else:
+                    try:
+                        names = sorted(os.listdir(d))
+                    except OSError:
+                        continue
+                dirs[d] = [st.st_mtime_ns, names]
+                for name in names:
+                    p = os.path.join(d, name)
+                    try:
+                        st = os.lstat(p)
+                    except OSError:
+                        # gone since the listing was taken
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append(p)
+                    else:
+                        files[p] = self._entry(p, st)
+        return files, dirs
+
+    def _entry(self, path, st):
+        entry = [st.st_size, st.st_mtime_ns, None]
+        if self.use_hash and stat.S_ISREG(st.st_mode):
+            old = self.files.get(path)
+            if old is not None and old[0] == entry[0] and old[1] == entry[1]:
+                entry[2] = old[2]
+            else:
+                entry[2] = file_hash(path)
+        return entry
+
+    def changes(self, scan):
+        """The files changed and deleted between the saved state and scan."""
+        files = scan[0]
+        changed = []
+        for (path, entry) in files.items():
+            old = self.files.get(path)
+            if old is None:
+                changed.append(path)
+            elif old[0] != entry[0] or old[1] != entry[1]:
+                if not self.use_hash or old[2] is None or old[2] != entry[2]:
+                    changed.append(path)
+        deleted = [path for path in self.files if path not in files]
+        return sorted(changed), sorted(deleted)
+
+    def commit(self, scan, full=False):
+        """Adopt scan as the state the destination now holds."""
+        (self.files, self.dirs) = scan
+        if full:
+            self.last_full = time.time()
+        save_json(self.path, {'files': self.files, 'dirs': self.dirs,
+                              'last_full': self.last_full})
+
+
+def relative_paths(paths, source):
+    """paths, relative to source, as rsync's --files-from wants them."""
+    return [os.path.relpath(path, source) for path in paths]
+
+
+def file_hash(path):
+    """A fast content hash, None if the file can't be read."""
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
+
+
+# loaded manifests, kept between cycles rather than re-read each time
+manifests = {}
+manifests_lock = threading.Lock()
+
+
+def get_manifest(path, use_hash=False):
+    with manifests_lock:
+        if path not in manifests:
+            manifests[path] = Manifest(path, use_hash)
+        return manifests[path]
+
+
+class RemoteDirs(object):
+    """
+    The directories known to exist on one remote host.
+
+    rsync only creates the last component of its destination; a new
+    dated_dir, or a remote_root that isn't there yet, fails with code 11.
+    A destination not in here is created by the rsync run itself, with
+    mkdir -p ahead of the remote rsync over the same connection, so it
+    costs no round trip of its own. Once a transfer has worked the
+    directory is remembered, across restarts, and nothing extra is done
+    for it again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.dirs = set(json.load(f))
+        except (IOError, OSError, ValueError, TypeError):
+            self.dirs = set()
+
+    def known(self, path):
+        path = path.rstrip('/')
+        with self.lock:
+            return path in self.dirs
+
+    def add(self, path):
+        path = path.rstrip('/')
+        with self.lock:
+            if path in self.dirs:
+                return
+            self.dirs.add(path)
+            self.save()
+
+    def forget(self, paths):
+        paths = set(p.rstrip('/') for p in paths)
+        with self.lock:
+            # with anything below them
+            gone = set(d for d in self.dirs for p in paths
+                       if d == p or d.startswith(p + '/'))
+            if gone:
+                self.dirs -= gone
+                self.save()
+
+    def save(self):
+        try:
+            save_json(self.path, sorted(self.dirs))
+        except (IOError, OSError) as e:
+            logdbg("can't save %s: %s" % (self.path, e))
+
+
+remote_dirs = {}
+remote_dirs_lock = threading.Lock()
+
+
+def get_remote_dirs(path):
+    with remote_dirs_lock:
+        if path not in remote_dirs:
+            remote_dirs[path] = RemoteDirs(path)
+        return remote_dirs[path]
+
+
+def mkdir_rsync_path(cmd, directory):
+    """
+    Have the remote end make directory before it starts rsync.
+
+    rsync runs --rsync-path through the remote shell, so the mkdir rides
+    on the same ssh connection. None if rsync_options already has its own
+    --rsync-path.
+    """
+    for opt in cmd:
+        if opt.startswith('--rsync-path'):
+            return None
+    return "--rsync-path=mkdir -p %s && rsync" % shlex.quote(directory)
+
+
+class GeneratedFiles(object):
+    """
+    Collects the files the report engine writes, as it writes them.
+
+    weewx's generators don't say what they wrote, but everything they
+    write goes through open(), os.rename/os.replace or shutil.copyfile,
+    all of which raise audit events (python 3.8 on). One hook, installed
+    the first time a section asks for it, notes any path under a watched
+    root against each destination watching it. The hook is process wide
+    and can't be removed, so it does as little as possible for anything
+    else: one startswith() on the path.
+
+    Only what is written after the hook goes in is seen, so until a full
+    transfer has succeeded (last_full) every transfer is a full one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots = ()
+        self.watchers = {}
+        self.last_full = {}
+        self.installed = False
+
+    def watch(self, key, root):
+        """Start collecting, for key, what is written under root."""
+        root = os.path.join(os.path.abspath(root), '')
+        with self.lock:
+            if key in self.watchers:
+                return True
+            if not self.installed:
+                if not hasattr(sys, 'addaudithook'):
+                    logerr(":  ERR files_from = generated needs python 3.8"
+                           " or later, using full transfers")
+                    return False
+                sys.addaudithook(self._hook)
+                self.installed = True
+            self.watchers[key] = (root, set())
+            self.roots = tuple(set(w[0] for w in self.watchers.values()))
+        return True
+
+    def _hook(self, event, args):
+        if event == 'open':
+            path = args[0]
+            mode = args[1]
+            if mode is None:
+                # os.open(), go by the flags
+                if not args[2] & (os.O_WRONLY | os.O_RDWR):
+                    return
+            elif 'r' in mode and '+' not in mode:
+                return
+        elif event == 'os.rename' or event == 'shutil.copyfile':
+            # os.replace() also raises os.rename
+            path = args[1]
+        else:
+            return
+        if isinstance(path, str) and path.startswith(self.roots):
+            # under the lock, else a take() between finding the set and
+            # adding to it would lose the path
+            with self.lock:
+                for (root, paths) in self.watchers.values():
+                    if path.startswith(root):
+                        paths.add(path)
+
+    def take(self, key):
+        """What has been written for key since the last take."""
+        with self.lock:
+            (root, paths) = self.watchers[key]
+            self.watchers[key] = (root, set())
+        return paths
+
+    def restore(self, key, paths):
+        """Put back the paths of a transfer that failed."""
+        with self.lock:
+            self.watchers[key][1].update(paths)
+
+
+# the one collector for this process, it only does anything once a section
+# uses files_from = generated
+generated_files = GeneratedFiles()
+
+
+class Snapshots(object):
+    """
+    The dated_dir snapshots made at one destination, root/YYYY/MM/DD.
+
+    They are recorded here as they are made, so finding the one to link
+    against, or those to expire, doesn't need a trip to the far end.
+    """
+
+    def __init__(self, path, root, today):
+        self.path = path
+        self.root = root
+        self.today = today
+        try:
+            with open(path) as f:
+                self.dates = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.dates = []
+
+    def path_of(self, date):
+        return "%s/%s" % (self.root, date)
+
+    def link_dest(self):
+        """The snapshot before today's, for rsync's --link-dest."""
+        older = [d for d in self.dates if d < self.today]
+        if older:
+            return self.path_of(max(older))
+        return None
+
+    def add(self):
+        if self.today not in self.dates:
+            self.dates = sorted(self.dates + [self.today])
+            save_json(self.path, self.dates)
+
+    def forget(self, dates):
+        self.dates = [d for d in self.dates if d not in dates]
+        save_json(self.path, self.dates)
+
+    def expired(self, daily=None, weekly=None, monthly=None):
+        """The snapshots outside the retention policy.
+
+        Keep the newest daily snapshots, and the newest snapshot in each of
+        the last weekly weeks and monthly months. The newest is always kept.
+        With no policy at all nothing expires.
+        """
+        if not (daily or weekly or monthly):
+            return []
+        dates = sorted(self.dates, reverse=True)
+        keep = set(dates[:max(daily or 0, 1)])
+        for (n, bucket) in ((weekly, lambda d: d.isocalendar()[:2]),
+                            (monthly, lambda d: (d.year, d.month))):
+            if not n:
+                continue
+            seen = set()
+            for date in dates:
+                b = bucket(datetime.datetime.strptime(date, "%Y/%m/%d"))
+                if b not in seen:
+                    if len(seen) >= n:
+                        break
+                    seen.add(b)
+                    keep.add(date)
+        return [d for d in dates if d not in keep]
+
+
+class Publisher(object):
+    """
+    publish = atomic; a local destination that changes all at once.
+
+    Each cycle is copied into a new generation, a directory alongside the
+    destination (dest.rsynct/gen-<nanoseconds>), with the files unchanged
+    since the last one hard linked from it rather than copied. The
+    destination itself is a symlink to the newest generation, swapped
+    with a rename once the copy is complete; a web server, or anything
+    else reading it, sees the old tree or the new one, never a mixture
+    or half a file. The newest keep generations are kept, the one before
+    for whatever was still reading it at the swap.
+
+    The first time, a destination that is a plain directory is moved into
+    the generations, the only moment it doesn't exist.
+    """
+
+    def __init__(self, dest, keep=2):
+        self.dest = dest.rstrip(os.sep)
+        self.root = self.dest + '.rsynct'
+        self.keep = max(keep, 1)
+
+    def current(self):
+        """The generation published now, or the plain directory."""
+        if os.path.islink(self.dest):
+            return os.path.realpath(self.dest)
+        if os.path.isdir(self.dest):
+            return self.dest
+        return None
+
+    def stage(self):
+        """A new, empty, generation to copy into."""
+        staged = os.path.join(self.root, "gen-%020d" % time.time_ns())
+        os.makedirs(staged)
+        return staged
+
+    def discard(self, staged):
+        shutil.rmtree(staged, ignore_errors=True)
+
+    def publish(self, staged):
+        """Point the destination at staged, then prune."""
+        tmp = self.dest + '.rsynct-tmp'
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        # relative, so the whole drive can be mounted elsewhere
+        os.symlink(os.path.join(os.path.basename(self.root),
+                                os.path.basename(staged)), tmp)
+        if os.path.isdir(self.dest) and not os.path.islink(self.dest):
+            loginf(": publish = atomic, moving %s into %s, from now on it"
+                   " is a symlink" % (self.dest, self.root))
+            os.rename(self.dest, os.path.join(self.root, "gen-%020d" % 0))
+        os.replace(tmp, self.dest)
+        fd = os.open(os.path.dirname(self.dest) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.prune(staged)
+
+    def prune(self, current):
+        """Remove all but the newest keep generations up to current,
+        anything newer is a stage that never got published."""
+        gens = sorted(name for name in os.listdir(self.root)
+                      if name.startswith('gen-'))
+        name = os.path.basename(current)
+        older = [g for g in gens if g < name]
+        for g in older[:max(len(older) - self.keep + 1, 0)] + \
+                [g for g in gens if g > name]:
+            shutil.rmtree(os.path.join(self.root, g), ignore_errors=True)
+
+
+class Tiers(object):
+    """
+    Per path schedules within one section.
+
+    Each tier is a set of rsync include patterns and how often, at most,
+    what they match is sent; a tier without patterns takes whatever no
+    other tier does. A file belongs to the first tier that matches it.
+    Each cycle, the tiers that are due are sent together, in the one
+    rsync run, with filter rules that leave out the rest. When they all
+    are, no filters are needed at all. Excluded files are never deleted
+    at the far end, so delete is safe.
+
+    When each tier was last sent is kept in path, so a restart doesn't
+    send everything again.
+    """
+
+    def __init__(self, tiers, path):
+        # [(name, patterns or None, interval)]
+        self.tiers = tiers
+        self.path = path
+        try:
+            with open(path) as f:
+                self.last = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.last = {}
+
+    def due(self, now, everything=False):
+        """The names of the tiers due to be sent now."""
+        if everything:
+            return [name for (name, patterns, interval) in self.tiers]
+        due = []
+        for (name, patterns, interval) in self.tiers:
+            # a cycle that runs a little early mustn't wait a whole extra
+            # interval
+            slack = min(interval * 0.1, 60)
+            if now - self.last.get(name, 0) >= interval - slack:
+                due.append(name)
+        return due
+
+    def filters(self, due):
+        """The rsync filter options that send just the due tiers."""
+        if len(due) == len(self.tiers):
+            return []
+        rules = []
+        rest = None
+        for (name, patterns, interval) in self.tiers:
+            if patterns is None:
+                rest = name
+                continue
+            op = 'include' if name in due else 'exclude'
+            rules.extend(['--%s=%s' % (op, pattern) for pattern in patterns])
+        if rest not in due:
+            # nothing else; but look in every directory for what is due
+            rules.extend(['--include=*/', '--exclude=*', '--prune-empty-dirs'])
+        return rules
+
+    def sent(self, due, now):
+        for name in due:
+            self.last[name] = now
+        save_json(self.path, self.last)
+
+
+def option_int(section, name, default, bad):
+    """
+    An option that should be a whole number. One that isn't (5m, ssh) is
+    noted in bad, for TransferPlan.validate() to report, and default
+    used instead; rather than raise, every cycle, before it could be.
+    """
+    value = section.get(name, default)
+    try:
+        return to_int(value)
+    except (ValueError, TypeError):
+        bad.append("%s = %s isn't a whole number, using %s"
+                   % (name, value, default))
+        return default
+
+
+def rsynct_tiers(section, bad=None):
+    """
+    The [[tiers]] of an RsyncTransfer section, as Tiers wants them, eg:
+
+        [[tiers]]
+            [[[current]]]
+                include = index.html, *.json
+            [[[plots]]]
+                include = *.png
+                interval = 900
+            [[[everything_else]]]
+                interval = 3600
+
+    interval is in seconds, 0 (the default) is every cycle. An interval
+    that isn't a number is noted in bad, see option_int().
+    """
+    if bad is None:
+        bad = []
+    tiers = []
+    if not section:
+        return tiers
+    for (name, tier) in section.items():
+        if not isinstance(tier, dict):
+            continue
+        patterns = tier.get('include')
+        if isinstance(patterns, str):
+            patterns = patterns.split(',')
+        if patterns is not None:
+            patterns = [p.strip() for p in patterns if p.strip()] or None
+        found = []
+        interval = option_int(tier, 'interval', 0, found)
+        bad.extend("tier %s, %s" % (name, message) for message in found)
+        tiers.append((name, patterns, interval))
+    return tiers
+
+
+def replay_options(opts):
+    """
+    The options, from an rsync command, that the rsync replaying its
+    --write-batch needs too; less the program itself and what only the
+    sending side cares about (the remote shell and path, compression,
+    --link-dest). The filters stay, they keep --delete off excluded
+    files.
+    """
+    replay = []
+    skip = False
+    for opt in strip_compress(opts[1:]):
+        if skip:
+            skip = False
+        elif opt == '-e':
+            skip = True
+        elif not opt.startswith(('--rsync-path=', '--skip-compress=',
+                                 '--link-dest=', '--files-from=',
+                                 '--write-batch=', '--info=progress')):
+            replay.append(opt)
+    return replay
+
+
+class FanOut(object):
+    """
+    The other destinations ([[destinations]]) of a section, each a
+    TransferPlan of its own, sent to once the section's own destination,
+    the first, has been.
+
+    With a batch file, the first destination's rsync also writes what it
+    did there (--write-batch) and the others are brought up to date by
+    replaying that (--read-batch), all at once; the sources are scanned
+    and the changes worked out just the once. That only works for a
+    destination that matched the first one before the batch, so each
+    one's place in the chain of batches is kept in path: seq counts the
+    changes made to the first destination, and a destination at seq - 1
+    gets the new batch. One that missed a batch, or was never in step,
+    has a full rsync of its own instead, as does one whose replay fails
+    for any reason but being unreachable; once that works it's as the
+    first destination is and back in the chain at seq. Without a batch
+    file (native copies, parallel runs, dated_dir, db_ship), every
+    destination always gets its own rsync.
+    """
+
+    def __init__(self, plans, batch, path):
+        # [(name, TransferPlan)]
+        self.plans = plans
+        self.batch = batch
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.state = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.state = {}
+        self.state.setdefault('seq', 0)
+        self.state.setdefault('dests', {})
+
+    def run(self, first, outcome):
+        """Bring the others into line, after first, the section's RsyncJob,
+        has run, outcome being how that went."""
+        if not self.plans:
+            return
+        config_time = first.config_time
+        if self.batch is None:
+            self.run_all([plan.job(config_time) for (name, plan) in self.plans])
+            return
+        with self.lock:
+            dests = self.state['dests']
+            seq = self.state['seq']
+            replay = None
+            if first.batch_opts is not None and outcome in ('ok', 'vanished'):
+                # the first destination moved on, by what the batch holds
+                seq += 1
+                replay = (self.batch, first.batch_opts)
+            elif outcome != 'skipped':
+                # it may have changed, but not in any way that's recorded
+                seq += 1
+            self.state['seq'] = seq
+            work = []
+            for (name, plan) in self.plans:
+                applied = dests.get(plan.dest_key)
+                if replay is not None and applied == seq - 1:
+                    work.append((plan.job(config_time, batch=replay), plan))
+                elif replay is None and applied == seq:
+                    # the first destination hasn't changed, nor has this
+                    continue
+                else:
+                    if first.wdebug >= 2:
+                        logdbg("%s is out of step with the batches, full"
+                               " rsync" % plan.dest_key)
+                    work.append((plan.job(config_time), plan))
+            results = self.run_all([job for (job, plan) in work])
+            catch_up = []
+            for ((job, plan), outcome) in zip(work, results):
+                if job.batch is not None and not job.in_sync and \
+                        outcome not in ('unreachable', 'breaker'):
+                    # it wasn't as the batch expected, catch up now
+                    loginf(": batch didn't apply to %s, full rsync"
+                           % plan.dest_key)
+                    catch_up.append((plan.job(config_time), plan))
+            caught = dict(zip([plan.dest_key for (job, plan) in catch_up],
+                              self.run_all([job for (job, plan) in catch_up])))
+            for ((job, plan), outcome) in zip(work, results):
+                outcome = caught.get(plan.dest_key, outcome)
+                if outcome in ('ok', 'vanished', 'skipped'):
+                    # the batch, or its own rsync, brought it to where the
+                    # first is
+                    dests[plan.dest_key] = seq
+                else:
+                    dests.pop(plan.dest_key, None)
+            try:
+                save_json(self.path, self.state)
+            except (IOError, OSError) as e:
+                logerr(":  ERR can't save %s: %s" % (self.path, e))
+
+    def run_all(self, jobs):
+        """Run the jobs at once, returns their outcomes."""
+        with concurrent.futures.ThreadPoolExecutor(len(jobs) or 1) as pool:
+            return list(pool.map(RsyncJob.run, jobs))
+
+
+def rsynct_destinations(section):
+    """
+    The [[destinations]] of an RsyncTransfer section, [(name, options)],
+    eg:
+
+        [[destinations]]
+            [[[nas]]]
+                server = nas.local
+                remote_root = /volume1/weewx
+            [[[usb]]]
+                server = localhost
+                remote_root = /media/usb/weewx
+
+    Each takes server, user, port, remote_root and ssh_options, the rest
+    come from the section.
+    """
+    destinations = []
+    if not section:
+        return destinations
+    for (name, dest) in section.items():
+        if isinstance(dest, dict):
+            destinations.append((name, dict(dest)))
+    return destinations
+
+
+def itemized(rsyncinfo):
+    """The --itemize-changes counts RsyncOutput left in rsyncinfo."""
+    return dict((name[len('Itemized '):], stat_count(value))
+                for (name, value) in rsyncinfo.items()
+                if name.startswith('Itemized '))
+
+
+class SpanExporter(object):
+    """
+    Publishes each job's timing spans, and what it sent, to a
+    PromTextfile and/or a StatsdClient. Both are labelled with the report
+    section and destination. The sinks are shared, one per file and one
+    per statsd, by every section that names them; see get_exporter().
+    """
+
+    def __init__(self, textfile=None, statsd=None):
+        self.textfile = textfile
+        self.statsd = statsd
+
+    def export(self, record, spans, items):
+        labels = (('section', record.section), ('dest', record.dest))
+        values = [('rsynct_phase_seconds', labels + (('phase', span),), seconds)
+                  for (span, seconds) in spans.items()]
+        values += [('rsynct_duration_seconds', labels, record.duration),
+                   ('rsynct_last_run_timestamp_seconds', labels, record.dateTime),
+                   ('rsynct_last_success', labels, record.ok),
+                   ('rsynct_files_transferred', labels, record.files),
+                   ('rsynct_bytes_sent', labels, record.sent),
+                   ('rsynct_bytes_received', labels, record.received)]
+        values += [('rsynct_itemized_files', labels + (('kind', kind),), n)
+                   for (kind, n) in items.items()]
+        if self.textfile is not None:
+            self.textfile.update(labels, values)
+        if self.statsd is not None:
+            self.statsd.send(record, spans, items)
+
+
+class PromTextfile(object):
+    """
+    A Prometheus node_exporter textfile; the latest value of every series
+    from every section writing to it, rewritten whole, atomically, after
+    each job.
+    """
+
+    # name, type, help
+    METRICS = (
+        ('rsynct_phase_seconds', 'gauge', 'Seconds spent in each phase of the last transfer'),
+        ('rsynct_duration_seconds', 'gauge', 'Seconds the last transfer took'),
+        ('rsynct_last_run_timestamp_seconds', 'gauge', 'When the last transfer started'),
+        ('rsynct_last_success', 'gauge', '1 if the last transfer worked'),
+        ('rsynct_files_transferred', 'gauge', 'Files sent by the last transfer'),
+        ('rsynct_bytes_sent', 'gauge', 'Bytes sent by the last transfer'),
+        ('rsynct_bytes_received', 'gauge', 'Bytes received by the last transfer'),
+        ('rsynct_itemized_files', 'gauge', 'Files of the last transfer, by what rsync did'),
+    )
 
-import weewx
-import weewx.engine
-import weewx.manager
-import weewx.units
-from weewx.engine import StdService
-from weeutil.weeutil import to_int, to_bool
-from weewx.cheetahgenerator import SearchList
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (metric, labels) -> value
+        self.series = collections.OrderedDict()
 
-rsynct_version = "0.0.2"
+    def update(self, labels, values):
+        """values, [(metric, labels, value)], replace all the series
+        labelled labels had before."""
+        with self.lock:
+            for key in [key for key in self.series if key[1][:2] == labels]:
+                del self.series[key]
+            for (metric, series_labels, value) in values:
+                self.series[(metric, series_labels)] = value
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                logdbg("can't write %s: %s" % (self.path, e))
 
-# https://github.com/weewx/weewx/wiki/WeeWX-v4-and-logging
-try:
-    # Test for new-style weewx logging by trying to import weeutil.logger
-    import weeutil.logger
-    import logging
-    log = logging.getLogger(__name__)
+    def write(self):
+        lines = []
+        for (metric, kind, text) in self.METRICS:
+            series = [(labels, value) for ((name, labels), value)
+                      in self.series.items() if name == metric]
+            if not series:
+                continue
+            lines.append("# HELP %s %s" % (metric, text))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for (labels, value) in series:
+                lines.append("%s{%s} %s" % (metric, ",".join(
+                    '%s="%s"' % (k, prom_escape(v)) for (k, v) in labels), value))
+        # node_exporter mustn't see it half written
+        tmp = "%s.%s.tmp" % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+
+
+class StatsdClient(object):
+    """Sends each job's spans to statsd, over UDP, as timers and gauges."""
+
+    def __init__(self, address):
+        # (host, port)
+        self.address = address
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def send(self, record, spans, items):
+        prefix = "rsynct.%s.%s" % (statsd_name(record.section),
+                                   statsd_name(record.dest))
+        lines = ["%s.phase.%s:%0.3f|ms" % (prefix, span, seconds * 1000)
+                 for (span, seconds) in spans.items()]
+        lines += ["%s.duration:%0.3f|ms" % (prefix, record.duration * 1000),
+                  "%s.files:%s|g" % (prefix, record.files),
+                  "%s.bytes_sent:%s|g" % (prefix, record.sent),
+                  "%s.bytes_received:%s|g" % (prefix, record.received),
+                  "%s.success:%s|g" % (prefix, record.ok)]
+        lines += ["%s.itemized.%s:%s|g" % (prefix, kind, n)
+                  for (kind, n) in items.items()]
+        try:
+            with self.lock:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.sendto("\n".join(lines).encode('utf-8'), self.address)
+        except (OSError, socket.error) as e:
+            logdbg("can't send to statsd %s:%s: %s" % (self.address + (e,)))
+
+
+def prom_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# statsd's usual port
+STATSD_PORT = 8125
+
+
+def statsd_address(value):
+    """host[:port] as (host, port); ValueError if the port isn't one."""
+    (host, sep, port) = value.rpartition(':')
+    if not sep:
+        return value, STATSD_PORT
+    port = int(port)
+    if not 0 < port < 65536:
+        raise ValueError("port %s out of range" % port)
+    return host or 'localhost', port
+
+
+def statsd_name(value):
+    """value, made safe for a dotted statsd name."""
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', str(value)).strip('_')
+
+
+# one PromTextfile per path and one StatsdClient per (host, port), however
+# many sections use them
+textfiles = {}
+statsd_clients = {}
+exporters_lock = threading.Lock()
+
+
+def get_exporter(textfile=None, statsd=None):
+    """The SpanExporter for these sinks, None if there are none."""
+    address = None
+    if statsd:
+        try:
+            address = statsd_address(statsd)
+        except ValueError:
+            # validate() has said so
+            pass
+    if not textfile and address is None:
+        return None
+    with exporters_lock:
+        if textfile and textfile not in textfiles:
+            textfiles[textfile] = PromTextfile(textfile)
+        if address is not None and address not in statsd_clients:
+            statsd_clients[address] = StatsdClient(address)
+        return SpanExporter(textfiles.get(textfile),
+                            statsd_clients.get(address))
+
+
+METRICS_FILE = 'rsynctransfer-metrics.sdb'
+
+
+class MetricsStore(object):
+    """
+    A TransferStats record of every transfer, in a small SQLite database
+    in state_dir. Records older than days are dropped.
+    """
+
+    def __init__(self, path, days=90):
+        self.path = path
+        self.days = days
+        self.lock = threading.Lock()
+        self.pruned = 0
+        self.checked = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("CREATE TABLE IF NOT EXISTS transfers (%s)"
+                     % ", ".join(TransferStats._fields))
+        conn.execute("CREATE INDEX IF NOT EXISTS transfers_dateTime"
+                     " ON transfers (dateTime)")
+        if not self.checked:
+            # a table from an older version, without the newer fields
+            columns = [row[1] for row in
+                       conn.execute("PRAGMA table_info(transfers)")]
+            for field in TransferStats._fields:
+                if field not in columns:
+                    conn.execute("ALTER TABLE transfers ADD COLUMN %s" % field)
+            self.checked = True
+        return conn
+
+    def add(self, record):
+        with self.lock:
+            conn = self.connect()
+            try:
+                with conn:
+                    # by name; a table from an older version has the
+                    # newer fields in a different order
+                    conn.execute("INSERT INTO transfers (%s) VALUES (%s)"
+                                 % (", ".join(record._fields),
+                                    ", ".join("?" * len(record))), record)
+                    if self.days and record.dateTime - self.pruned > 3600:
+                        conn.execute("DELETE FROM transfers WHERE dateTime < ?",
+                                     (record.dateTime - self.days * 86400,))
+                        self.pruned = record.dateTime
+            finally:
+                conn.close()
+
+    def records(self, since, section=None, dest=None):
+        """The TransferStats since then, oldest first."""
+        if not os.path.exists(self.path):
+            return []
+        sql = "SELECT %s FROM transfers WHERE dateTime >= ?" % \
+              ", ".join(TransferStats._fields)
+        args = [since]
+        if section is not None:
+            sql += " AND section = ?"
+            args.append(section)
+        if dest is not None:
+            sql += " AND dest = ?"
+            args.append(dest)
+        conn = self.connect()
+        try:
+            return [TransferStats(*row) for row in
+                    conn.execute(sql + " ORDER BY dateTime", args)]
+        finally:
+            conn.close()
+
+
+metrics_stores = {}
+metrics_stores_lock = threading.Lock()
+
+
+def get_metrics(path, days=90):
+    with metrics_stores_lock:
+        if path not in metrics_stores:
+            metrics_stores[path] = MetricsStore(path, days)
+        return metrics_stores[path]
+
+
+def rsynct_metrics_path(config_dict, skin_section=None):
+    """
+    The MetricsStore database. In skin_section's state_dir if it has one,
+    otherwise in that of the first rsynctransfer report.
+    """
+    if not skin_section or skin_section.get('state_dir') is None:
+        skin_section = {}
+        for report in config_dict.get('StdReport', {}).values():
+            if isinstance(report, dict) and report.get('skin') == 'rsynctransfer':
+                skin_section = report
+                break
+    return os.path.join(rsynct_state_dir(config_dict, skin_section),
+                        METRICS_FILE)
+
+
+def percentile(values, pct):
+    """The nearest rank percentile, None if there are no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = -(-pct * len(values) // 100)
+    return values[max(rank - 1, 0)]
+
+
+class TransferHistory(object):
+    """
+    The transfers of the last few days, for templates. All transfers,
+    or those of one report section or destination, eg:
+
+        $rsynct.last.duration $rsynct.last.files $rsynct.last.outcome
+        $rsynct.p50 $rsynct.p95 $rsynct.throughput $rsynct.failures
+        #for ($day, $nbytes) in $rsynct.bytes_per_day
+        $rsynct.section('RsyncTransfer').days(30).p95
+
+    Durations are in seconds, throughput in bytes per second on the wire,
+    None where there is nothing to go on. Cycles that didn't run rsync
+    (nothing had changed, the host was known to be down) count towards
+    count and failures but not the timings.
+    """
+
+    def __init__(self, store, section=None, dest=None, ndays=7):
+        self.store = store
+        self.section_name = section
+        self.dest_key = dest
+        self.ndays = ndays
+        self._records = None
+
+    def section(self, name):
+        return TransferHistory(self.store, name, self.dest_key, self.ndays)
+
+    def dest(self, key):
+        return TransferHistory(self.store, self.section_name, key, self.ndays)
+
+    def days(self, ndays):
+        return TransferHistory(self.store, self.section_name, self.dest_key,
+                               ndays)
+
+    @property
+    def records(self):
+        if self._records is None:
+            try:
+                self._records = self.store.records(
+                    time.time() - self.ndays * 86400,
+                    self.section_name, self.dest_key)
+            except sqlite3.Error as e:
+                logdbg("can't read %s: %s" % (self.store.path, e))
+                self._records = []
+        return self._records
+
+    @property
+    def ran(self):
+        """The transfers that ran rsync, and worked."""
+        return [r for r in self.records
+                if r.ok and r.outcome not in ('skipped', 'breaker')]
+
+    @property
+    def last(self):
+        return self.records[-1] if self.records else None
+
+    @property
+    def count(self):
+        return len(self.records)
+
+    @property
+    def failures(self):
+        return len([r for r in self.records if not r.ok])
+
+    @property
+    def p50(self):
+        return percentile([r.duration for r in self.ran], 50)
+
+    @property
+    def p95(self):
+        return percentile([r.duration for r in self.ran], 95)
+
+    @property
+    def throughput(self):
+        seconds = sum(r.phase_transfer for r in self.ran)
+        if not seconds:
+            return None
+        return sum(r.sent + r.received for r in self.ran) / seconds
+
+    @property
+    def bytes_per_day(self):
+        """(midnight, bytes sent and received), oldest day first."""
+        days = collections.OrderedDict()
+        for r in self.records:
+            day = datetime.datetime.fromtimestamp(r.dateTime).replace(
+                hour=0, minute=0, second=0)
+            midnight = int(time.mktime(day.timetuple()))
+            days[midnight] = days.get(midnight, 0) + r.sent + r.received
+        return list(days.items())
+
+
+# rsync --version, parsed once; (version tuple, compression algorithms)
+rsync_caps = None
+rsync_caps_lock = threading.Lock()
+
+
+def rsync_capabilities():
+    """
+    The local rsync's version and the compression algorithms it has.
+    Before 3.2 there's no --compress-choice and only zlib.
+    """
+    global rsync_caps
+    with rsync_caps_lock:
+        if rsync_caps is not None:
+            return rsync_caps
+        version = (0,)
+        algorithms = []
+        try:
+            text = subprocess.check_output(['rsync', '--version'],
+                                           stderr=subprocess.STDOUT,
+                                           universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            text = ''
+        lines = text.splitlines()
+        match = re.search(r'version\s+(\d+(?:\.\d+)*)', text)
+        if match:
+            version = tuple(int(n) for n in match.group(1).split('.'))
+        for (i, line) in enumerate(lines):
+            if line.strip().startswith('Compress list:'):
+                # on the same line, or (3.2.x) the next
+                names = line.split(':', 1)[1].split() or \
+                    (lines[i + 1].split() if i + 1 < len(lines) else [])
+                algorithms = [name for name in names if name != 'none']
+        if not algorithms and version >= (2, 6):
+            algorithms = ['zlib']
+        rsync_caps = (version, algorithms)
+        return rsync_caps
+
+
+# rsync passes these over untouched, their contents are compressed already
+SKIP_COMPRESS = 'png/jpg/jpeg/gif/gz/tgz/zip/bz2/xz/zst/webp/mp4/woff2'
+
+
+class Compression(object):
+    """
+    Which compression, if any, to ask rsync for, from how recent transfers
+    to the same destination went (MetricsStore).
+
+    The compressed runs give the ratio (wire bytes / literal data) and
+    how fast rsync gets through data for each second of CPU; every run
+    gives the link's rate (wire bytes / transfer phase seconds). It's
+    worth compressing while ratio / rate + 1 / cpu_rate, the time per
+    byte compressed, is less than 1 / rate. A fast link gets a fast
+    algorithm, a slow one a stronger one. Without the history, the
+    default choice is made; after 'window' uncompressed runs the ratio is
+    forgotten and the next run is compressed, to see if it's still so.
+    An algorithm the far end turned down is left out for 'retry' seconds,
+    then tried again; its rsync may have been upgraded.
+    """
+
+    # bytes/s; above fast anything but lz4 costs more than it saves,
+    # above lan don't bother at all
+    FAST = 4 * 1024 * 1024
+    LAN = 40 * 1024 * 1024
+    # transfers smaller than this say little about the link
+    MIN_BYTES = 64 * 1024
+
+    def __init__(self, metrics, dest, days=7, window=20, retry=86400):
+        self.metrics = metrics
+        self.dest = dest
+        self.days = days
+        self.window = window
+        self.retry = retry
+
+    def history(self):
+        """The last 'window' transfers that sent enough to go by."""
+        if self.metrics is None:
+            return []
+        since = time.time() - self.days * 86400
+        try:
+            records = self.metrics.records(since, dest=self.dest)
+        except sqlite3.Error as e:
+            logerr(":  ERR compression history: %s" % e)
+            return []
+        return [r for r in records if r.ok and r.sent >= self.MIN_BYTES and
+                r.phase_transfer][-self.window:]
+
+    def failed(self):
+        """The algorithms whose last use, in the last 'retry' seconds,
+        failed as a configuration error; likely the far end's rsync
+        doesn't have them."""
+        last = {}
+        if self.metrics is not None:
+            since = time.time() - self.retry
+            try:
+                for r in self.metrics.records(since, dest=self.dest):
+                    if r.compress:
+                        last[r.compress.split('-')[0]] = r.outcome
+            except sqlite3.Error:
+                pass
+        return set(name for (name, outcome) in last.items()
+                   if outcome == 'config')
+
+    def choose(self):
+        """
+        (algorithm, level); algorithm None for no compression, 'any' to
+        leave it to rsync (plain --compress), level None for the default.
+        """
+        (version, algorithms) = rsync_capabilities()
+        if version < (3, 2):
+            # --compress, zlib, is all there is
+            algorithms = ['zlib']
+        failed = self.failed()
+        algorithms = [a for a in algorithms if a not in failed]
+        runs = self.history()
+        rates = sorted(r.sent / r.phase_transfer for r in runs)
+        rate = rates[len(rates) // 2] if rates else None
+        squeezed = [r for r in runs if r.compress and r.literal and r.cpu]
+        if squeezed:
+            ratio = sum(r.sent for r in squeezed) / float(
+                sum(r.literal for r in squeezed))
+            cpu_rate = sum(r.literal for r in squeezed) / sum(
+                r.cpu for r in squeezed)
+            if ratio > 0.9:
+                return None, None
+            if rate and ratio / rate + 1.0 / cpu_rate >= 1.0 / rate:
+                return None, None
+        if rate is not None and rate > self.LAN:
+            return None, None
+        fast = rate is not None and rate > self.FAST
+        for (name, level) in ((('lz4', None), ('zstd', 1), ('zlib', 1)) if fast
+                              else (('zstd', 3), ('zlib', 6))):
+            if name in algorithms:
+                return name, level
+        return 'any', None
+
+    def options(self):
+        """The rsync options, and a label for the stats (None if off)."""
+        (algorithm, level) = self.choose()
+        if algorithm is None:
+            return [], None
+        opts = ['--compress']
+        if algorithm != 'any' and rsync_capabilities()[0] >= (3, 2):
+            opts.append('--compress-choice=%s' % algorithm)
+        if level is not None:
+            opts.append('--compress-level=%s' % level)
+        label = algorithm if level is None else "%s-%s" % (algorithm, level)
+        return opts, label
+
+
+def rsynct_compress(value):
+    """The compress option; True, False (unset too), 'auto' or, if it's
+    none of those, as given (for validate() to complain about)."""
+    if value is None or value == '':
+        return False
+    if value == 'auto':
+        return 'auto'
+    try:
+        return to_bool(value)
+    except ValueError:
+        return value
+
+
+def strip_compress(opts):
+    """rsync_options less any compression; -z in a cluster of short
+    options, --compress and its friends."""
+    stripped = []
+    for opt in opts:
+        if re.match(r'^-[A-Za-z0-9]+$', opt) and 'z' in opt:
+            opt = opt.replace('z', '')
+            if opt == '-':
+                continue
+        elif opt == '--compress' or opt.startswith(('--compress-', '--zc=',
+                                                    '--zl=', '--old-compress',
+                                                    '--new-compress')):
+            continue
+        stripped.append(opt)
+    return stripped
+
+
+# what a [[destinations]] entry may set, the rest is the section's
+DEST_OPTIONS = ('server', 'user', 'port', 'remote_root', 'ssh_options')
+
+# the RsyncTransfer options, anything else in the section is reported by
+# TransferPlan.validate() as a likely typo
+PLAN_OPTIONS = set("""
+    server user port remote_root dated_dir rsync_options ssh_options compress
+    delete log_success background transfer_timeout parallel ssh_master
+    ssh_persist skip_unchanged manifest_hash full_sync_interval state_dir
+    files_from progress db_backup db_backup_pages db_ship db_ship_table
+    local_engine retries retry_backoff connect_timeout breaker_failures
+    breaker_cooloff metrics metrics_days prometheus_textfile statsd
+    keep_daily keep_weekly keep_monthly validate tiers skip_compress
+    destinations pack_small publish
+    skin enable report_timing HTML_ROOT self_report_name log_failure
+    """.split())
+
+
+class TransferPlan(object):
+    """
+    Everything about a report section's transfer that doesn't change from
+    cycle to cycle; the options, typed, the rsync argv and the resolved
+    destination. Built once, checked once, by get_plan(), and used by
+    every cycle until the configuration changes. job() makes the cycle's
+    RsyncJob from it.
+    """
+
+    def __init__(self, config_dict, skin_section, section='RsyncTransfer'):
+        _s = skin_section
+        self.section = section
+        self.options = set(_s.keys())
+        self.section_dict = _s
+        # the options that didn't parse, for validate()
+        self.bad_options = []
+        self.local_root = config_dict.get('StdReport', {}).get('HTML_ROOT') or ''
+        self.remote_root = _s.get('remote_root', self.local_root)
+        self.server = _s.get('server')
+        self.user = _s.get('user') or None
+        self.dated_dir = to_bool(_s.get('dated_dir', False))
+        self.port = self.option_int('port', 22)
+        # any number of options now, eg: -aR --exclude=*.tmp
+        self.rsync_opt = shlex.split(_s.get('rsync_options', '-a'))
+        self.ssh_options = shlex.split(_s.get('ssh_options', ''))
+        # false, leaving it to rsync_options, true or auto; chosen from the
+        # transfers so far, see Compression
+        self.compress = rsynct_compress(_s.get('compress'))
+        # only when compressing is asked for here, or it is set
+        self.skip_compress = _s.get('skip_compress',
+                                    SKIP_COMPRESS if self.compress else None)
+        if isinstance(self.skip_compress, list):
+            self.skip_compress = "/".join(self.skip_compress)
+        self.delete = to_bool(_s.get('delete', False))
+        self.log_success = to_bool(_s.get('log_success', True))
+        # run the transfer in the background worker, and for how long at most
+        self.background = to_bool(_s.get('background', True))
+        self.transfer_timeout = self.option_int('transfer_timeout', 300)
+        # how many of the local_root directories may be sent at once
+        self.parallel = self.option_int('parallel', 1)
+        # share one ssh connection per host, kept open between cycles
+        self.ssh_master = to_bool(_s.get('ssh_master', True))
+        self.ssh_persist = self.option_int('ssh_persist', 600)
+        # skip the rsync altogether when the sources are unchanged
+        self.skip_unchanged = to_bool(_s.get('skip_unchanged', False))
+        self.manifest_hash = to_bool(_s.get('manifest_hash', False))
+        self.full_sync_interval = self.option_int('full_sync_interval', 86400)
+        self.state_dir = rsynct_state_dir(config_dict, _s)
+        # send only what the report engine wrote, rather than the whole tree
+        self.files_from = _s.get('files_from')
+        # log rsync's --info=progress2 every so many seconds
+        self.progress = self.option_int('progress', 0)
+        # SQLite databases to send as consistent, online backup API, copies
+        self.databases = rsynct_databases(config_dict, _s.get('db_backup', False))
+        self.db_pages = self.option_int('db_backup_pages', 256)
+        # or ship just the records added since the last cycle
+        self.db_ship = rsynct_databases(config_dict, _s.get('db_ship', False))
+        self.db_ship_table = _s.get('db_ship_table', 'archive')
+        # rsync, or LocalSync, for server = localhost
+        self.local_engine = _s.get('local_engine', 'rsync')
+        # what to do when rsync fails, see RSYNC_POLICY
+        self.retries = self.option_int('retries', 2)
+        self.retry_backoff = self.option_int('retry_backoff', 5)
+        self.connect_timeout = self.option_int('connect_timeout', 10)
+        self.breaker_failures = self.option_int('breaker_failures', 2)
+        self.breaker_cooloff = self.option_int('breaker_cooloff', 300)
+        # keep a record of each transfer, for RsynctStats
+        self.metrics = to_bool(_s.get('metrics', True))
+        self.metrics_days = self.option_int('metrics_days', 90)
+        # timing spans for each job, to Prometheus and/or statsd
+        self.prometheus_textfile = _s.get('prometheus_textfile')
+        self.statsd = _s.get('statsd')
+        # how many dated_dir snapshots to keep, None keeps them all
+        self.retention = (self.option_int('keep_daily', None),
+                          self.option_int('keep_weekly', None),
+                          self.option_int('keep_monthly', None))
+        # per path schedules, see Tiers
+        self.tier_spec = rsynct_tiers(_s.get('tiers'), self.bad_options)
+        # check the far end too, with rsync --dry-run, when the plan is made
+        self.validate_mode = _s.get('validate', 'local')
+        # bundle the changed files up to this size, see Packer
+        self.pack_small = self.option_int('pack_small', 0) or 0
+        # inplace, or atomic to swap in each complete copy, see Publisher
+        self.publish = _s.get('publish', 'inplace')
+        # more places to send the same files, see FanOut
+        self.destinations = rsynct_destinations(_s.get('destinations'))
+        # weewx's debug; 1 logs the failed commands, 2 everything
+        self.wdebug = option_int(config_dict, 'debug',
+                                 getattr(weewx, 'debug', 0), self.bad_options)
+        self.resolve()
+        self.fanout = self.fan_out(config_dict, _s)
+
+    def option_int(self, name, default):
+        """The section's option name, see option_int()."""
+        return option_int(self.section_dict, name, default, self.bad_options)
+
+    def resolve(self):
+        """Work out the destination, the sources and the rsync argv."""
+        wdebug = self.wdebug
+        self.localhost = self.server == 'localhost'
+        if self.localhost:
+            # and attempt to prevent disasters!
+            if self.remote_root.rstrip(os.sep) == '':
+                self.dest_root = '/tmp/%s' % self.server
+            else:
+                self.dest_root = self.remote_root.rstrip(os.sep)
+            self.host = None
+            # the destination, less any date, identifies it from cycle to
+            # cycle
+            self.dest_key = self.dest_root
+        else:
+            self.dest_root = self.remote_root.rstrip(os.sep) or os.sep
+            # construct string for remote ssh, or the same account (user)
+            # as weewx
+            self.host = "%s@%s" % (self.user, self.server) if self.user \
+                else self.server
+            self.dest_key = "%s:%s" % (self.host, self.remote_root)
+
+        # the ssh command rsync is to use; fail fast on a dead host, rather
+        # than wait on the kernel's timeout
+        self.ssh_args = ['-o', 'ConnectTimeout=%s' % self.connect_timeout] + \
+            self.ssh_options
+        self.master = None
+        rsh_args = ['ssh', '-p', str(self.port)] + self.ssh_args
+        if not self.localhost and self.ssh_master:
+            # reuse one multiplexed connection per host across cycles
+            self.master = ssh_pool.get(self.user, self.server, self.port,
+                                       ssh_options=self.ssh_args,
+                                       persist=self.ssh_persist,
+                                       control_dir=os.path.join(
+                                           self.state_dir, 'rsynct-ssh'))
+            rsh_args = self.master.rsh_args()
+        # for commands run at the far end; pruning, creating a missing
+        # destination
+        self.remote_shell = None
+        if not self.localhost:
+            self.remote_shell = rsh_args + [self.host]
+
+        # construct the command argument; rsync options as supplied, some
+        # stats on the transfer, then the rest. With compress = auto it's
+        # the job's to choose, so rsync_options' -z goes.
+        rsync_opt = self.rsync_opt
+        if self.compress == 'auto' and not self.localhost:
+            rsync_opt = strip_compress(rsync_opt)
+        cmd = ['rsync'] + rsync_opt + ['--stats']
+        if self.progress:
+            cmd.append('--info=progress2')
+        # Remove files remotely when they're removed locally
+        if self.delete:
+            cmd.append('--delete')
+        if not self.localhost:
+            if self.compress is True:
+                cmd.append('--compress')
+            if self.skip_compress:
+                cmd.append('--skip-compress=%s' % self.skip_compress)
+            cmd.extend(['-e', shell_join(rsh_args)])
+
+        # Multiple, space separated, local directories are sent as they
+        # were entered. A single directory keeps the original 'transfer to
+        # remote web server' behaviour; with a trailing slash so only the
+        # directory's contents are copied (rsync copies the directory
+        # itself otherwise).
+        src_dir = self.local_root.split()
+        if len(src_dir) > 1:
+            self.sources = src_dir
+            # used when reporting a missing source
+            self.rsynclocalspec = self.local_root
+        else:
+            self.rsynclocalspec = os.path.join(self.local_root, '')
+            self.sources = [self.rsynclocalspec]
+        if wdebug >= 2:
+            logdbg("sources %s" % self.sources)
+
+        self.staged = None
+        self.shipper = None
+        if self.db_ship:
+            # a base once, then segments of new records, never deleted
+            self.staging = state_file(self.state_dir, 'segments', self.dest_key)
+            self.shipper = SegmentShipper(self.db_ship[0], self.staging,
+                                          state_file(self.state_dir, 'shipped',
+                                                     self.dest_key),
+                                          self.db_ship_table, self.db_pages)
+            self.rsynclocalspec = self.staging + os.sep
+            self.sources = [self.rsynclocalspec]
+            cmd = [opt for opt in cmd if opt != '--delete']
+        elif self.databases:
+            # send consistent copies of the databases, staged by the job,
+            # rather than the live files
+            self.staging = state_file(self.state_dir, 'staging', self.dest_key)
+            self.staged = [(db, os.path.join(self.staging, os.path.basename(db)))
+                           for db in self.databases]
+            self.rsynclocalspec = self.staging + os.sep
+            self.sources = [self.rsynclocalspec]
+            # rsync skips its delta algorithm for local copies otherwise
+            cmd.append('--no-whole-file')
 
-    def logdbg(msg):
-        log.debug(msg)
+        # Separate rsync runs per source only match a single run if no
+        # source merges its contents into the destination; with delete
+        # each run would remove what the others had sent.
+        self.parallel_runs = self.parallel
+        if self.parallel > 1 and self.delete and \
+                [src for src in self.sources if src.endswith(os.sep)]:
+            self.parallel_runs = 1
 
-    def loginf(msg):
-        log.info(msg)
+        self.tiers = None
+        if self.tier_spec and not (self.db_ship or self.databases):
+            self.tiers = Tiers(self.tier_spec, state_file(self.state_dir,
+                                                          'tiers',
+                                                          self.dest_key))
 
-    def logerr(msg):
-        log.error(msg)
+        self.packer = None
+        if self.pack_small > 0 and not self.localhost and \
+                not (self.db_ship or self.databases) and \
+                self.tiers is None and not self.dated_dir and \
+                len(self.sources) == 1:
+            self.packer = Packer(self.pack_small,
+                                 state_file(self.state_dir, 'bundles',
+                                            self.dest_key),
+                                 state_file(self.state_dir, 'receiver',
+                                            self.dest_key))
+            # the receiver lives at the far end, out of delete's way
+            cmd.append('--exclude=/%s/' % rsynct_receiver.RECEIVER_DIR)
 
-except ImportError:
-    # Old-style weewx logging
-    import syslog
+        # rsync_options beyond those LocalSync does anyway need rsync, as
+        # do the tiers' filters
+        self.native = self.localhost and self.local_engine == 'native' and \
+            native_options(cmd) and self.tiers is None
+        self.cmd = cmd
 
-    def logmsg(level, msg):
-        syslog.syslog(level, 'rsynctransfer: %s:' % msg)
+        self.publisher = None
+        if self.publish == 'atomic' and self.native and not self.dated_dir:
+            self.publisher = Publisher(self.dest_root)
 
-    def logdbg(msg):
-        logmsg(syslog.LOG_DEBUG, msg)
+    def fan_out(self, config_dict, skin_section):
+        """The FanOut to the [[destinations]], a plan for each."""
+        self.batch_reason = None
+        if self.native:
+            self.batch_reason = "local_engine = native"
+        elif self.parallel_runs > 1 and len(self.sources) > 1:
+            self.batch_reason = "parallel"
+        elif self.dated_dir:
+            self.batch_reason = "dated_dir"
+        elif self.db_ship:
+            self.batch_reason = "db_ship"
+        elif self.packer is not None:
+            self.batch_reason = "pack_small"
+        plans = []
+        for (name, options) in self.destinations:
+            section = dict((key, value) for (key, value) in skin_section.items()
+                           if key != 'destinations')
+            section.update((key, value) for (key, value) in options.items()
+                           if key in DEST_OPTIONS)
+            if self.batch_reason is None:
+                # a catch up has to be a full sync, not just the changes
+                # it would have had since its own last one
+                for key in ('files_from', 'skip_unchanged', 'tiers'):
+                    section.pop(key, None)
+            plans.append((name, TransferPlan(config_dict, section,
+                                             self.section)))
+        batch = None
+        if self.batch_reason is None:
+            batch = state_file(self.state_dir, 'batch', self.dest_key)
+        return FanOut(plans, batch, state_file(self.state_dir, 'fanout',
+                                               self.dest_key))
+
+    def validate(self):
+        """
+        Look for what would make the transfer fail, or not do as asked.
+
+        Returns a list of (fatal, message); fatal ones mean there's no
+        point trying at all.
+        """
+        problems = []
+
+        def problem(message, fatal=False):
+            problems.append((fatal, message))
+
+        if not self.server:
+            problem("no server given", True)
+        if not self.local_root:
+            problem("no HTML_ROOT to send from", True)
+        for src in self.local_root.split():
+            if not os.path.exists(src):
+                problem("local_root %s doesn't exist (yet?)" % src)
+        for name in sorted(self.options - PLAN_OPTIONS):
+            problem("unknown option %s, a typo?" % name)
+        for message in self.bad_options:
+            problem(message)
+        if self.localhost and self.remote_root.rstrip(os.sep) == '':
+            problem("won't write over /, sending to %s instead" % self.dest_root)
+        if not self.native and not shutil.which('rsync'):
+            problem("rsync isn't installed", True)
+        if not self.localhost and not shutil.which('ssh'):
+            problem("ssh isn't installed", True)
+        if self.local_engine not in ('rsync', 'native'):
+            problem("local_engine = %s isn't rsync or native" % self.local_engine)
+        elif self.local_engine == 'native' and not self.localhost:
+            problem("local_engine = native only applies to server = localhost")
+        elif self.local_engine == 'native' and not self.native:
+            problem("local_engine = native can't do rsync_options %s, using"
+                    " rsync" % " ".join(self.rsync_opt))
+        if self.files_from not in (None, 'generated'):
+            problem("files_from = %s isn't generated" % self.files_from)
+        elif self.files_from and len(self.sources) > 1:
+            problem("files_from = generated needs a single local_root"
+                    " directory, using full transfers")
+        if self.db_ship and self.databases:
+            problem("db_ship and db_backup both set, using db_ship")
+        if len(self.db_ship) > 1:
+            problem("db_ship takes one database, only %s is shipped"
+                    % self.db_ship[0])
+        if self.tier_spec and (self.db_ship or self.databases):
+            problem("tiers don't apply to db_backup or db_ship, ignored")
+        elif self.tier_spec and (self.skip_unchanged or self.files_from):
+            # they'd count what the tiers left out as sent
+            problem("tiers and skip_unchanged or files_from don't mix,"
+                    " using tiers")
+        if len([t for t in self.tier_spec if t[1] is None]) > 1:
+            problem("more than one tier without include patterns, only the"
+                    " first gets anything")
+        if self.parallel_runs != self.parallel:
+            problem("parallel = %s ignored, delete with a source ending in %s"
+                    " would remove the other sources' files"
+                    % (self.parallel, os.sep))
+        if [keep for keep in self.retention if keep is not None] and \
+                not self.dated_dir:
+            problem("keep_daily/weekly/monthly only apply with dated_dir")
+        if not os.access(self.state_dir, os.W_OK):
+            problem("can't write to state_dir %s" % self.state_dir)
+        if self.transfer_timeout is not None and self.transfer_timeout <= 0:
+            problem("transfer_timeout = %s, transfers would be killed at"
+                    " once" % self.transfer_timeout, True)
+        if self.validate_mode not in ('local', 'remote'):
+            problem("validate = %s isn't local or remote" % self.validate_mode)
+        if self.compress not in (True, False, 'auto'):
+            problem("compress = %s isn't true, false or auto, using false"
+                    % self.compress)
+        elif self.localhost and self.compress:
+            problem("compress doesn't apply to server = localhost, not used")
+        elif self.compress == 'auto' and not self.metrics and \
+                not self.localhost:
+            problem("compress = auto without metrics has no history to go"
+                    " by, always compressing")
+        if self.pack_small > 0 and self.packer is None:
+            if self.localhost:
+                problem("pack_small only helps over a network, not used for"
+                        " server = localhost")
+            else:
+                problem("pack_small doesn't apply with db_backup, db_ship,"
+                        " tiers, dated_dir or several local_root directories,"
+                        " not used")
+        if self.statsd:
+            try:
+                statsd_address(self.statsd)
+            except ValueError:
+                problem("statsd = %s isn't host or host:port, not sending"
+                        " to statsd" % self.statsd)
+        if self.publish not in ('inplace', 'atomic'):
+            problem("publish = %s isn't inplace or atomic" % self.publish)
+        elif self.publish == 'atomic' and self.publisher is None:
+            problem("publish = atomic needs server = localhost, local_engine"
+                    " = native and no dated_dir, copying in place")
+        elif self.publish == 'atomic' and not self.delete:
+            problem("publish = atomic copies the sources afresh each time,"
+                    " files removed from them go, as with delete = true")
+        problems.extend(self.validate_destinations(problems))
+        return problems
+
+    def validate_destinations(self, problems):
+        """validate() for each of the [[destinations]]; one that can't
+        work is dropped, rather than the whole section."""
+        found = []
+        seen = set(message for (fatal, message) in problems)
+        keys = set([self.dest_key])
+        for (name, options) in self.destinations:
+            for option in sorted(set(options) - set(DEST_OPTIONS)):
+                found.append((False, "destination %s: %s can't be set per"
+                              " destination, ignored" % (name, option)))
+        for (name, plan) in list(self.fanout.plans):
+            fatal = False
+            for (is_fatal, message) in plan.validate():
+                fatal = fatal or is_fatal
+                if message not in seen:
+                    found.append((False, "destination %s: %s%s" % (
+                        name, message, ", skipped" if is_fatal else "")))
+            if plan.dest_key in keys:
+                found.append((False, "destination %s: %s is already sent to,"
+                              " skipped" % (name, plan.dest_key)))
+                fatal = True
+            keys.add(plan.dest_key)
+            if fatal:
+                self.fanout.plans.remove((name, plan))
+        if self.fanout.plans and self.fanout.batch is None:
+            found.append((False, "with %s, each destination gets its own"
+                          " rsync rather than a shared batch"
+                          % self.batch_reason))
+        return found
+
+    def dry_run(self):
+        """
+        rsync --dry-run to the destination; is it there and will it have
+        us? Returns (class, what that means, rsync's errors).
+        """
+        if self.native:
+            return 'ok', 'ok', ''
+        if self.master is not None:
+            self.master.ensure()
+        if self.localhost:
+            dest = self.dest_root
+        else:
+            dest = "%s:%s" % (self.host, self.dest_root)
+        probe = RsyncJob(self.dest_key, self.cmd, self.sources, self.server,
+                         self.user, self.rsynclocalspec, dest, self.dest_root,
+                         timeout=self.transfer_timeout, wdebug=self.wdebug)
+        (output, returncode, timed_out) = probe.rsync(
+            self.cmd + ['--dry-run'] + self.sources + [dest])
+        errors = output.error_text()
+        klass = classify(returncode, errors, timed_out)
+        return klass, RSYNC_POLICY[klass][2], errors
+
+    def job(self, config_time=0, batch=None):
+        """The RsyncJob for this cycle, batch is for FanOut."""
+        wdebug = self.wdebug
+        # If true, create the remote directory with a date structure
+        # eg: <path to backup directory>/2017/02/12/var/lib/weewx...
+        snapshot_date = None
+        date_dir_str = ''
+        if self.dated_dir:
+            snapshot_date = time.strftime("%Y/%m/%d")
+            date_dir_str = "/%s/" % snapshot_date
+        rsync_rem_dir = self.dest_root + (date_dir_str or os.sep)
+        if self.localhost:
+            rsyncremotespec = rsync_rem_dir
+        else:
+            rsyncremotespec = "%s:%s%s" % (self.host, self.remote_root,
+                                           date_dir_str)
+        if wdebug >= 2:
+            logdbg("timestamp used for rsyncremotespec  - %s" % date_dir_str)
+
+        if self.shipper is not None and not os.path.isdir(self.staging):
+            os.makedirs(self.staging)
+
+        manifest = None
+        if (self.skip_unchanged or self.packer is not None) and \
+                self.tiers is None:
+            manifest = get_manifest(state_file(self.state_dir, 'manifest',
+                                               self.sources, self.dest_key),
+                                    self.manifest_hash)
+
+        generated = None
+        if self.files_from == 'generated' and len(self.sources) == 1 and \
+                self.tiers is None and \
+                generated_files.watch(self.dest_key, self.sources[0]):
+            generated = generated_files
+
+        breaker = None
+        dirs = None
+        if not self.localhost:
+            breaker = get_breaker(self.host, self.breaker_failures,
+                                  self.breaker_cooloff)
+            dirs = get_remote_dirs(state_file(self.state_dir, 'dirs',
+                                              self.host, self.port))
+
+        snapshots = None
+        if self.dated_dir:
+            # each day's directory is hard linked against the last one
+            snapshots = Snapshots(state_file(self.state_dir, 'snapshots',
+                                             self.dest_key),
+                                  self.dest_root, snapshot_date)
+
+        metrics = None
+        if self.metrics:
+            metrics = get_metrics(os.path.join(self.state_dir, METRICS_FILE),
+                                  self.metrics_days)
+
+        cmd = self.cmd
+        compress_choice = None
+        if self.compress is True and not self.localhost:
+            compress_choice = 'any'
+        elif self.compress == 'auto' and not self.localhost:
+            (opts, compress_choice) = Compression(metrics,
+                                                  self.dest_key).options()
+            cmd = cmd + opts
+            if wdebug >= 2:
+                logdbg("compression for %s: %s" % (self.dest_key,
+                                                   compress_choice or 'none'))
+
+        return RsyncJob(self.dest_key, cmd, self.sources, self.server,
+                        self.user, self.rsynclocalspec, rsyncremotespec,
+                        rsync_rem_dir, log_success=self.log_success,
+                        timeout=self.transfer_timeout,
+                        parallel=self.parallel_runs, master=self.master,
+                        manifest=manifest,
+                        full_sync_interval=self.full_sync_interval,
+                        delete=self.delete, generated=generated,
+                        progress_interval=self.progress, snapshots=snapshots,
+                        retention=self.retention,
+                        remote_shell=self.remote_shell,
+                        databases=self.staged, db_pages=self.db_pages,
+                        shipper=self.shipper,
+                        native_dest=rsync_rem_dir if self.native else None,
+                        retries=self.retries, backoff=self.retry_backoff,
+                        breaker_key=self.host, breaker=breaker, dirs=dirs,
+                        section=self.section, metrics=metrics,
+                        exporter=get_exporter(self.prometheus_textfile,
+                                              self.statsd),
+                        config_time=config_time, tiers=self.tiers,
+                        compress_choice=compress_choice,
+                        fanout=self.fanout if self.fanout.plans else None,
+                        batch=batch, packer=self.packer,
+                        publisher=self.publisher, wdebug=wdebug)
+
+
+def plan_fingerprint(config_dict, skin_section):
+    """What a TransferPlan depends on, hashed; the section and the parts
+    of weewx.conf it reads."""
+    keys = [skin_section, config_dict.get('StdReport', {}).get('HTML_ROOT'),
+            config_dict.get('WEEWX_ROOT'), config_dict.get('debug')] + \
+        [config_dict.get(name) for name in ('DatabaseTypes', 'Databases',
+                                            'DataBindings')]
+    return hashlib.sha1(json.dumps(keys, sort_keys=True, default=str)
+                        .encode('utf-8')).hexdigest()
+
+
+# one per report section, (fingerprint, plan)
+plans = {}
+plans_lock = threading.Lock()
 
-    def loginf(msg):
-        logmsg(syslog.LOG_INFO, msg)
 
-    def logerr(msg):
-        logmsg(syslog.LOG_ERR, msg)
+def get_plan(config_dict, skin_section, section='RsyncTransfer'):
+    """
+    The TransferPlan for a report section, made and checked the first
+    time, and again only if its configuration has changed.
+    """
+    fingerprint = plan_fingerprint(config_dict, skin_section)
+    with plans_lock:
+        cached = plans.get(section)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+    plan = TransferPlan(config_dict, skin_section, section)
+    plan.problems = plan.validate()
+    plan.fatal = [message for (fatal, message) in plan.problems if fatal]
+    for (fatal, message) in plan.problems:
+        logerr(":  ERR [%s] %s" % (section, message))
+    if plan.validate_mode == 'remote' and not plan.fatal:
+        (klass, hint, errors) = plan.dry_run()
+        if klass not in ('ok', 'vanished'):
+            logerr(":  ERR [%s] rsync --dry-run to %s failed, %s: %s"
+                   % (section, plan.dest_key, hint, errors.replace("\n", ". ")))
+    if cached is not None:
+        loginf(": [%s] configuration changed, transfer plan rebuilt" % section)
+    with plans_lock:
+        plans[section] = (fingerprint, plan)
+    return plan
 
 
 class Rsynct(SearchList):
@@ -80,6 +3908,8 @@ class Rsynct(SearchList):
 
     def __init__(self, generator):
 
+        # how long it takes to get from here to a job, the config span
+        t0 = time.time()
         SearchList.__init__(self, generator)
         """Initialize an instance of RsyncUpload.
 
@@ -87,7 +3917,7 @@ class Rsynct(SearchList):
 
         HTML_ROOT: The default value for remote_root as read from weewx.conf.
         To use another destination, specify it as HTML_ROOT = /path/to/files
-        in weewx.conf
+        in weewx.conf, or give remote_root = /path/at/the/far/end here
 
         All other config variables - stanzas. Can exist in either weewx.conf or
         in an appropriately named skin file. They are...
@@ -106,9 +3936,97 @@ class Rsynct(SearchList):
 
         dated_dir: Optional structure for remote tree eg: 2017/02/02 rolling
         over as required. this end builds those directories as required.
+        Each day's snapshot is hard linked (rsync --link-dest) against the
+        previous one, so unchanged files take no space and aren't sent.
+
+        db_backup: true to send a consistent copy of the weewx archive
+        database (wx_binding), or a list of bindings or database paths. Each
+        is copied with SQLite's online backup API, db_backup_pages pages at a
+        time so weewx is never locked out for long, into a staging directory
+        in state_dir. The staged copies are what rsync sends, in place of
+        local_root, with a block size that lines up with the database pages
+        so only the changed pages cross the wire. [Optional. Default is
+        False]
+
+        db_backup_pages: pages copied per step of the backup. [Optional.
+        Default is 256]
+
+        db_ship: like db_backup, for one database, but sends a base copy
+        once and then, each cycle, only the db_ship_table (archive) records
+        added since the last, as compressed, checksummed, segment files. The
+        far end keeps them all; rsynct_segments.py, sent along with the
+        base, verifies them, rebuilds the database (restore) or folds them
+        into a new base (compact). [Optional. Default is False]
+
+        local_engine: with server = localhost, native copies the files here,
+        comparing size and mtime and copying with the kernel's
+        copy_file_range/sendfile on a few threads, rather than forking
+        rsync. rsync_options other than those implied (-a, -v, -O, -z and
+        the like) need rsync, as does -D; devices, sockets and fifos are
+        left out of a native copy. Where both are on a filesystem that can
+        (btrfs, XFS, ...), files are cloned, copy on write, rather than
+        copied. [Optional. Default is rsync]
+
+        publish: with server = localhost and local_engine = native, atomic
+        copies each cycle into a new directory alongside the destination
+        (remote_root.rsynct/), the unchanged files hard linked from the
+        last, and makes remote_root a symlink to it, swapped in one rename
+        once it's complete. Whatever reads it, a web server say, never
+        sees half an update. The previous copy is kept too. Not with
+        dated_dir. See Publisher. [Optional. Default is inplace]
+
+        keep_daily, keep_weekly, keep_monthly: with dated_dir, keep the
+        newest snapshot of each of the last N days, weeks and months, the
+        rest are removed after a successful transfer. [Optional. Default
+        is to keep them all]
 
-        rsync_option: Added to allow addition of -R, ( --relative use relative
-        path name. Others may be included but that's untested. No spaces allowed
+        rsync_options: Added to allow addition of -R, ( --relative use relative
+        path name. Any number of options, space separated, quoted as for a
+        shell if need be. [Optional. Default is -a]
+
+        port: the ssh port. [Optional. Default is 22]
+
+        ssh_options: more options for ssh, eg: -i /home/weewx/.ssh/id_rsync
+        -o StrictHostKeyChecking=accept-new [Optional]
+
+        log_success: log each transfer. [Optional. Default is True]
+
+        tiers: per path schedules within the section, a [[tiers]]
+        subsection of [[[name]]] tiers, each with include (rsync patterns)
+        and interval (seconds, at most that often; 0 is every cycle). A
+        tier without include takes everything the others don't. The
+        tiers that are due each cycle are sent in one rsync run, eg:
+        index.html every cycle, plots every 15 minutes, the rest hourly.
+        Not used with db_backup or db_ship, and used instead of
+        skip_unchanged and files_from. See Tiers. [Optional]
+
+        pack_small: a size in bytes. Changed files up to that size are
+        packed into one bundle, named for its sha256, piped over ssh and
+        unpacked at the far end by rsynct_receiver.py (copied to
+        remote_root/.rsynct the first time), all of them or none. Larger
+        files go with rsync as usual. Over a link with a long round trip
+        that saves rsync's per file exchanges. Uses the manifest
+        skip_unchanged keeps to find what changed, and python3 at the far
+        end. Not for localhost, db_backup, db_ship, tiers, dated_dir or
+        several local_root directories. [Optional. Default is 0, off]
+
+        destinations: more places to send the same files to, a
+        [[destinations]] subsection of [[[name]]] entries, each with its
+        own server, user, port, remote_root and ssh_options; everything
+        else is the section's. The section's own destination goes first
+        and its rsync records what it did (--write-batch), the others
+        replay that (--read-batch), all at once, so the sources are only
+        scanned, and the changes worked out, the once. A destination that
+        misses a batch, or that a batch doesn't apply to, gets a full
+        rsync of its own to catch up. Not with local_engine = native,
+        parallel, dated_dir or db_ship, where each just gets its own
+        rsync. See FanOut. [Optional]
+
+        validate: the options are checked when first read, and whenever
+        they change, and any problems logged then rather than left to a
+        failed transfer. remote also has rsync --dry-run to the
+        destination at that point, to check it can be reached and written
+        to. [Optional. Default is local]
 
         report_timing: See the weewx documentation for the full description on
         this addition. There are many options eg:-
@@ -117,407 +4035,302 @@ class Rsynct(SearchList):
         delete: delete remote files that don't match with local files. Use
         with caution.  [Optional.  Default is False.]
 
+        compress: false leaves it to rsync_options, as they are. true has
+        rsync compress (-z). auto chooses for each transfer from how the
+        recent ones to that destination went (metrics); off when the data
+        doesn't squeeze or the link outruns the CPU, lz4 (or a low zstd
+        level) on a quick link and zstd on a slow one, where the local
+        rsync (3.2+) has them. An algorithm the far end turned down isn't
+        asked for again for a day. -z in rsync_options is dropped for auto.
+        Not used for server = localhost. See Compression. [Optional.
+        Default is false]
+
+        skip_compress: '/' separated suffixes rsync sends as they are, for
+        files compressed already. [Optional. With compress true or auto,
+        the default is png, jpg, gz, zip and the like, see SKIP_COMPRESS;
+        otherwise unset]
+
         self_report_name: always defaults to the [[section]] name used in
         weewx.conf
-                #local_root=local_root,
-                #remote_root=self.skin_dict['path'],
-                #server=self.skin_dict['server'],
-                #user=self.skin_dict.get('user'),
-                #port=self.skin_dict.get('port'),
-                # Glenn McKechnie
-                #rsync_opt=self.skin_dict.get('rsync_options'),
-                #ssh_options=self.skin_dict.get('ssh_options'),
-                compress=to_bool(self.skin_dict.get('compress', False)),
-                delete=to_bool(self.skin_dict.get('delete', False)),
-
-        server=None
-        dated_dir=None
-        user=None
-        delete=False
-        date_dir=False
-        port=None
-        rsync_opt=None
-        ssh_options=None
-        compress=False
-        log_success=True
-        "=========="============"
-        3.9.2
-        rsynctransfer: dict fetch:  Bool values for delete = (False,) and compress is (True,):
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer: timestamp used for rsyncremotespec  - :
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer:  state of delete = <type 'tuple'> and compress is <type 'tuple'>:
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer:  Bool values for delete = (False,) and compress is (True,):
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer: cmddelT = ['rsync', '-a', '-Ovz', '--stats']:
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer: cmddelA = ['rsync', '-a', '-Ovz', '--stats', '--delete']:
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer: cmdcompT = ['rsync', '-a', '-Ovz', '--stats', '--delete']:
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer: cmdcompA = ['rsync', '-a', '-Ovz', '--stats', '--delete', '--compress']:
-        Apr 28 14:19:09 masterofpis wee_reports[20823]: rsynctransfer:  cmd is ['rsync', '-a', '-Ovz', '--stats', '--delete', '--compress', '-e ssh -p 22', '/var/www/html/weewx/', 'pinochio@192.168.1.62:/var/www/html/weewx']:
-        Apr 28 14:19:10 masterofpis wee_reports[20823]: rsynctransfer: : rsync'd 126 files (1,854,920 bytes) in 0.50 s
-        """
 
-        self.rsynct_version = rsynct_version
-        # get our rsynctransfer config dictionary
-        #loginf("RSYNCTRANSFER: sys.argv[2] - %s" % sys.argv[1])
-        #config_dict = configobj.ConfigObj(file_error=True, encoding='utf-8')
-        #rsync_config_dict = config_dict.get('rsynctransfer', {})
+        background: hand the transfer to a background worker and return
+        straight away, so a slow or hung link doesn't hold up the report
+        cycle. Requests for a destination that is still busy are merged
+        into one run. [Optional. Default is True.]
 
+        transfer_timeout: seconds an rsync run may take before it is killed.
+        [Optional. Default is 300]
 
-        # are we enabled?
-        #self.enable = rsync_config_dict.get('enable', True)
+        parallel: when local_root holds several directories, send each with
+        its own rsync, up to this many at once. [Optional. Default is 1, a
+        single rsync for them all]
 
-        #self.local_root  = os.path.normpath(local_root)
-        #self.local_root  = rsync_config_dict.get('localroot')
-        _s = self.generator.skin_dict['RsyncTransfer']
+        ssh_master: keep one multiplexed ssh connection (ControlMaster) open
+        per user, server and port, and run every rsync over it. It is health
+        checked each cycle and closed when weewx shuts down. Its socket is
+        kept in state_dir/rsynct-ssh, which must be private to weewx's
+        user. [Optional. Default is True]
 
-        self.local_root  = self.generator.config_dict['StdReport'].get('HTML_ROOT')
-
-        self.remote_root = self.local_root,
-        self.server      = _s.get('server'),
-        self.user        = _s.get('user'),
-        dated_dir        = to_bool(_s.get('dated_dir', 'False')),
-        self.port        = _s.get('port',22),
-        self.rsync_opt   = _s.get('rsync_options','-a'),
-        self.ssh_options = _s.get('ssh_options', " "),
-        # NO commas else to_bool / bool exercise fails (False, == True)
-        self.compress    = to_bool(_s.get('compress', False))
-        self.delete      = to_bool(_s.get('delete', False))
-        #self.compress    = _s.get('compress', False)
-        #self.delete      = _s.get('delete', False)
-        # FIXME  DO NEXT !!!
-        #self.y      = to_bool(_s.get('delete', 'y')),
-        #self.n      = to_bool(_s.get('delete', 'n')),
-        self.log_success = _s.get('log_success'),
-        #return
-        #self.compress    = bool(False)
-        #self.delete      = bool(True)
-        #self.compress    = to_bool(''.join([str(elem) for (elem) in self.compress]))
-        #  self.compress    = to_bool(''.join(map(str,self.compress)))
-        # self.delete      = to_bool(''.join(map(str,self.delete)))
-        ##loginf("dict fetch:  Bool values for delete = %s and compress is %s" % (self.delete, self.compress))
-
-        wdebug = 2
-        if wdebug >= 2:
-            print("USER = %s" % self.user)
-            print (self.generator.skin_dict.get('dated_dir', False)),
-            print("dated _dir = %s : type(dated dir) = %s" % (dated_dir, type(dated_dir)))
-            print("PORT = %s" % self.port)
-            print("RSYNC OPT = %s" % self.rsync_opt)
-            print("ssh_options %s" % self.ssh_options)
+        ssh_persist: seconds an idle master stays open, this also clears up
+        after a weewx that didn't get to shut down. [Optional. Default is
+        600]
 
+        skip_unchanged: keep a manifest of the local_root trees as they were
+        at the last successful transfer. If nothing has changed rsync isn't
+        run at all, otherwise (single directory, nothing deleted) rsync is
+        given the exact list of changed files. [Optional. Default is False]
 
-        """
-        Perform the actual upload.
+        manifest_hash: also hash files whose size or mtime has changed, so
+        regenerated but identical files aren't sent. [Optional. Default is
+        False]
+
+        full_sync_interval: seconds between full rsync runs when
+        skip_unchanged is in use, to catch anything changed at the far end.
+        [Optional. Default is 86400]
+
+        files_from: set to generated to send only the files the report
+        engine has written since the last transfer, as an explicit list,
+        rather than have rsync compare the whole tree. Files deleted
+        locally are dealt with by the full transfer every
+        full_sync_interval. Needs a single local_root directory.
+        [Optional. Default is unset, no list]
+
+        progress: log rsync's overall progress (--info=progress2, rsync 3.1
+        or later) every this many seconds while a transfer runs. [Optional.
+        Default is 0, no progress]
+
+        retries: how many more times to try a transfer that failed for a
+        reason that may pass; a partial transfer, a transient error. A
+        server that can't be reached isn't retried, that is left to the
+        breaker (breaker_failures, breaker_cooloff) below. A missing
+        destination directory is created then tried again straight away.
+        Failures that won't fix themselves (authentication, read-only or
+        full destination, bad options) are logged, with what to look at,
+        and not retried. [Optional. Default is 2]
+
+        retry_backoff: seconds before the first retry, doubled for each one
+        after. [Optional. Default is 5]
+
+        connect_timeout: seconds ssh waits for the server to answer.
+        [Optional. Default is 10]
+
+        breaker_failures: after this many report cycles in a row can't
+        reach a server, stop trying it for breaker_cooloff seconds, then
+        try once, with the others to it waiting on how that goes; the wait
+        doubles, to an hour at most, for as long as it stays down.
+        [Optional. Default is 2]
+
+        breaker_cooloff: [Optional. Default is 300]
+
+        metrics: keep a record of each transfer; rsync's --stats and the time
+        taken by each phase, in rsynctransfer-metrics.sdb in state_dir.
+        Add RsynctStats to a skin's search_list_extensions to use them in
+        its templates, as $rsynct. [Optional. Default is True]
+
+        metrics_days: how long to keep them. [Optional. Default is 90]
 
-        Check for rsync error codes and log the obvious ones
+        prometheus_textfile: write the time spent in each phase of the last
+        transfer (config, prepare, connect, transfer, finish, our parsing of
+        rsync's output and rsync's own file list times), with what was
+        sent, to this file for node_exporter's textfile collector, eg:
+        /var/lib/prometheus/node-exporter/rsynctransfer.prom. Adds
+        --itemize-changes to count what rsync did to each file. connect
+        is the ssh_master's health check, or restart, and the creation of
+        a local destination; without ssh_master, rsync's own ssh connects
+        within transfer and connect is next to nothing. Sections may share
+        the file, each has its own series. [Optional. Default is unset,
+        none of this is done]
+
+        statsd: host:port, send the same to statsd over UDP. The port
+        defaults to 8125.
+        [Optional. Default is unset]
+
+        state_dir: where the extension keeps its state between cycles.
+        [Optional. Default is the weewx SQLITE_ROOT directory]
         """
 
-        t1 = time.time()
-        # With multiple configs available, prefix with the skin or label name
-        # for log clarity
-        # Do we have spaces in this string? If so we'll have multiple directories
-        # Set up for later tests
-        src_dir = self.local_root.split()
-        src_len = len(src_dir)
-        #logdbg("WEEWX.DEBUG: %s" % wdebug)
-        if wdebug >= 2:
-            logdbg("local root string length: %s" % src_len)
+        self.rsynct_version = rsynct_version
 
-        # If true, create the remote directory with a date structure
-        # eg: <path to backup directory>/2017/02/12/var/lib/weewx...
-        if dated_dir:
-            print("true")
-            date_dir_str = time.strftime("/%Y/%m/%d/")
-            date_dir_str = ''
+        # the options, argv and destination are worked out, and checked,
+        # once; then reused every cycle until the configuration changes
+        _s = self.generator.skin_dict['RsyncTransfer']
+        self.plan = get_plan(self.generator.config_dict, _s,
+                             self.generator.skin_dict.get('REPORT_NAME',
+                                                          'RsyncTransfer'))
+        if self.plan.fatal:
+            logdbg("transfer not attempted: %s" % "; ".join(self.plan.fatal))
+            return
+
+        job = self.plan.job(config_time=time.time() - t0)
+        if self.plan.background:
+            # hand it off and let the report cycle carry on
+            transfer_worker.submit(job)
         else:
-            print("none")
-            date_dir_str = ''
-        if wdebug >= 2:
-            logdbg("timestamp used for rsyncremotespec  - %s" % date_dir_str)
+            job.run()
 
-        # allow local transfers
-        if self.server == 'localhost':
-            rsyncremotespec = "%s%s" % (self.remote_root, date_dir_str)
-            rsync_rem_dir = "%s%s" % (self.remote_root, date_dir_str)
-            self.user = ''
-            if wdebug >= 2:
-                logdbg("self.remote_root is %s and rsync_rem_dir is %s" %  (self.remote_root, rsync_rem_dir))
-            # and attempt to prevent disasters!
-            if self.remote_root == '/':
-                rsyncremotespec = '/tmp/%s/' % (self.server)
-                err_mes = ":  ERR Attempting to write files to %s redirecting to %s ! FIXME !" %  (self.remote_root, rsyncremotespec)
-                logerr("%s" %  (err_mes))
 
-        else:
-            # construct string for remote ssh
-            if self.user is not None and len(self.user) > 0:
-                #loginf("%s@%s:%s%s" % (self.user[0], self.server[0], self.remote_root[0], date_dir_str))
-                print("as tuples:", self.user,self.server,self.remote_root, date_dir_str)
-                print("as strings:", self.user[0],self.server[0],self.remote_root[0], date_dir_str)
-                rsyncremotespec = "%s@%s:%s%s" % (self.user[0], self.server[0], self.remote_root[0], date_dir_str)
-                #loginf("%s@%s:%s%s" % (self.user[0], self.server[0], self.remote_root[0], date_dir_str))
-                rsync_rem_dir = "%s%s" % (self.remote_root, date_dir_str)
-            else:
-                # ?? same account (user) as weewx
-                rsyncremotespec = "%s:%s%s" % (self.server, self.remote_root, date_dir_str)
-                rsync_rem_dir = "%s%s" % (self.remote_root, date_dir_str)
-        # A chance to add rsync options eg -R (no spaces allowed)
-        if self.rsync_opt is not None and len(self.rsync_opt) > 0:
-            rsyncoptstring = "%s" % (self.rsync_opt)
-        else:
-            rsyncoptstring = ""
-        # haven't used nor tested this (-p 222) ???
-        if self.port is not None and len(self.port) > 0:
-            rsyncsshstring = "ssh -p %s" % (self.port)
-        else:
-            rsyncsshstring = "ssh"
+class RsynctStats(SearchList):
+    """
+    The record of rsynctransfer's transfers, as $rsynct, for any skin's
+    templates. Add it to the skin's skin.conf:
 
-        # nor tested this ???
-        if self.ssh_options is not None and len(self.ssh_options) > 0:
-            #print(self.ssh_options)
-            # TypeError: Can't convert 'tuple' object to str implicitly
-            # rsyncsshstring = rsyncsshstring + " " + self.ssh_options
-            pass
+        [CheetahGenerator]
+            search_list_extensions = user.rsynctransfer.RsynctStats
 
-        # construct the command argument
-        cmd = ['rsync']
+    See TransferHistory for what it offers. The records are read from the
+    state_dir of the rsynctransfer report, or from [RsynctStats] state_dir
+    in the skin.conf if it isn't the default.
+    """
 
-        # add rsync options as supplied, but add them now (before ssh str)
-        if self.rsync_opt:
-            cmd.extend(["%s" % rsyncoptstring])
+    def __init__(self, generator):
+        SearchList.__init__(self, generator)
+        self.path = rsynct_metrics_path(generator.config_dict,
+                                        generator.skin_dict.get('RsynctStats'))
 
-        # provide some stats on the transfer
-        cmd.extend(["--stats"])
+    def get_extension_list(self, timespan, db_lookup):
+        return [{'rsynct': TransferHistory(get_metrics(self.path))}]
 
-        # Remove files remotely when they're removed locally
-        #logdbg(" state of delete = %s and compress is %s" % (type(self.delete), type(self.compress)))
-        #logdbg(" Bool values for delete = %s and compress is %s" % (self.delete, self.compress))
-        if self.delete:
-            cmd.extend(["--delete"])
-        if self.compress:
-            cmd.extend(["--compress"])
-
-        # Are we operating locally? If so tweak the cmd
-        if self.server != 'localhost':
-            cmd.extend(["-e %s" % rsyncsshstring])
-
-        # If src_lentest shows we have multiple, space separated local
-        # directories, seperate them out and add them back as individual stanzas
-        # If we don't do this, rsync will complain about non existant files
-        if src_len > 1:
-            if wdebug >= 2:
-                logdbg("original local root string: %s" % self.local_root)
-                logdbg("local root string length: %s" % src_len)
-                logdbg("src_dir: %s" % src_dir)
-            for step in range(src_len):
-                # we don't want to force os.sep if we have multiple dirs use them as entered
-                #if src_dir[step].endswith(os.sep):
-                multi_loc = src_dir[step]
-                if wdebug >= 2:
-                    logdbg("multi_loc = %s" % multi_loc)
-                cmd.extend([multi_loc])
-        else:
-            # Keep original 'transfer to remote web server' behaviour - append
-            # a slash to ensure only directories contents are copied.
-            # If the source path ends with a slash, rsync interprets that as a
-            # request to copy all the directory's *contents*, whereas if it
-            # doesn't, it copies the entire directory.
-            # For a single directory copy, we want the former (backwards
-            # compatabile); so make it end  with a slash.
-            #
-            # of note : self.local_root  = os.path.normpath(local_root)
-            # stanza used at the start (above) strips the last slash off ?????
-            # seems redundant when we reinsert it anyway?
-            # tested without and seems to make no difference - assuming no major
-            # typos by user - we'll give them the benefit.
-            # Removing this to allow multi path to work - original +os.sep
-            # makes it redundant 2017/02/15 Glenn.McKechnie
-            if self.local_root.endswith(os.sep):
-                rsynclocalspec = self.local_root
-                cmd.extend([rsynclocalspec])
-                if wdebug >= 2:
-                    logdbg("rsynclocalspec ends with %s" % rsynclocalspec)
-            else:
-                rsynclocalspec = self.local_root + os.sep
-                cmd.extend([rsynclocalspec])
-                if wdebug >= 2:
-                    logdbg("rsynclocalspec + os.sep %s" % rsynclocalspec)
-        cmd.extend([rsyncremotespec])
 
-        try:
-            # perform the actual rsync transfer...
-            if wdebug >= 2:
-                #loginf("cmd = %s %s %s %s %s %s %s %s %s" % (cmd[0],cmd[1],cmd[2],cmd[3],cmd[4],cmd[5],cmd[6],cmd[7],cmd[8]))
-                logdbg(" cmd is %s" % (" ".join(cmd)))
-                pass
-            #print ("cmd = ", cmd[0],cmd[1],cmd[2],cmd[3],cmd[4],cmd[5],cmd[6],cmd[7],cmd[8],)
-            rsynccmd = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            stdout = rsynccmd.communicate()[0]
-            stroutput = stdout.decode("utf-8").strip()
-            #print("stroutput is %s", stroutput)
-        except OSError as e:
-            #print "EXCEPTION"
-            if e.errno == errno.ENOENT:
-                logerr(": rsync does not appear to be installed on this system. (errno %d, \"%s\")" % (e.errno, e.strerror))
-            raise
+def rsynct_skin_dict(config_dict, section):
+    """
+    The skin_dict weewx would hand the report section; its skin's
+    skin.conf, [StdReport] [[Defaults]], then the section itself from
+    weewx.conf, each overriding the last.
+    """
+    std_report = config_dict.get('StdReport', {})
+    report = std_report[section]
+    skin_dict = configobj.ConfigObj()
+    skin_conf = os.path.join(config_dict.get('WEEWX_ROOT', os.sep),
+                             std_report.get('SKIN_ROOT', 'skins'),
+                             report.get('skin', 'rsynctransfer'), 'skin.conf')
+    if os.path.exists(skin_conf):
+        skin_dict.merge(configobj.ConfigObj(skin_conf, file_error=True))
+    if 'Defaults' in std_report:
+        skin_dict.merge(std_report['Defaults'])
+    skin_dict.merge(report)
+    skin_dict['REPORT_NAME'] = section
+    return skin_dict
 
-        # we have some output from rsync so generate an appropriate message
-        if stroutput.find('rsync error:') < 0:
-            # no rsync error message so parse rsync --stats results
-            rsyncinfo = {}
-            for line in iter(stroutput.splitlines()):
-                if line.find(':') >= 0:
-                    (n, v) = line.split(':', 1)
-                    rsyncinfo[n.strip()] = v.strip()
-            # get number of files and bytes transferred and produce an
-            # appropriate message
-            try:
-                if 'Number of regular files transferred' in rsyncinfo:
-                    N = rsyncinfo['Number of regular files transferred']
-                else:
-                    N = rsyncinfo['Number of files transferred']
 
-                Nbytes = rsyncinfo['Total transferred file size']
-                if N is not None and Nbytes is not None:
-                    rsync_message = "rsync'd %s files (%s) in %%0.2f seconds" % (N, Nbytes)
-                else:
-                    rsync_message = "rsync executed in %0.2f seconds"
-            except:
-                rsync_message = "rsync :exception raised: executed in %0.2f seconds"
-        else:
-            # suspect we have an rsync error so tidy stroutput
-            # and display a message
-            stroutput = stroutput.replace("\n", ". ")
-            stroutput = stroutput.replace("\r", "")
-            # Attempt to catch a few errors that may occur and deal with them
-            # see man rsync for EXIT VALUES
-            rsync_message = "rsync command failed after %0.2f seconds (set 'wdebug = 1'),"
-            if "code 1)" in stroutput:
-                if wdebug >= 1:
-                    logdbg(": rsync code 1 - %s" % stroutput)
-                rsync_message = "syntax error in rsync command - set debug = 1 - ! FIX ME !"
-                loginf(":  ERR %s " % (rsync_message))
-                rsync_message = "code 1, syntax error, failed rsync executed in %0.2f seconds"
-
-            elif ("code 23" and "Read-only file system") in stroutput:
-                # read-only file system
-                # sadly, won't be detected until after first succesful transfer
-                # but it's useful then!
-                if wdebug >= 1:
-                    logdbg(": rsync code 23 - %s" % stroutput)
-                loginf(":  ERR Read only file system ! FIX ME !")
-                rsync_message = "code 23, read-only, rsync failed executed in %0.2f seconds"
-            elif ("code 23" and "link_stat") in stroutput:
-                # likely to be that a local path doesn't exist - possible typo?
-                if wdebug >= 1:
-                    logdbg(": rsync code 23 found %s" % stroutput)
-                rsync_message = "rsync code 23 : is %s correct? ! FIXME !" % (rsynclocalspec)
-                loginf(":  ERR %s " % rsync_message)
-                rsync_message = "code 23, link_stat, rsync failed executed in %0.2f seconds"
-
-            elif "code 11" in stroutput:
-                # directory structure at remote end is missing - needs creating
-                # on this pass. Should be Ok on next pass.
-                if wdebug >= 1:
-                    logdbg(": rsync code 11 - %s" % stroutput)
-                rsync_message = "rsync code 11 found Creating %s as a fix?" % (rsync_rem_dir)
-                loginf(": %s"  % rsync_message)
-                # laborious but apparently necessary, the only way the command will run!?
-                # build the ssh command - n.b:  spaces cause wobblies!
-                if self.server == 'localhost':
-                    cmd = ['mkdir']
-                    cmd.extend(['-p'])
-                    cmd.extend(["%s" % rsyncremotespec])
-                    if wdebug >= 2:
-                        logdbg("mkdircmd %s" % cmd)
-                    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    rsync_message = "code 11, rsync mkdir cmd executed in % 0.2f seconds"
-                else:
-                    cmd = ['ssh']
-                    cmd.extend(["%s@%s" % (self.user, self.server)])
-                    mkdirstr = "mkdir -p"
-                    cmd.extend([mkdirstr])
-                    cmd.extend([rsync_rem_dir])
-                    if wdebug >= 2:
-                        logdbg("sshcmd %s" % cmd)
-                    subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    rsyncremotespec = rsync_rem_dir
-                    rsync_message = "code 11, rsync mkdir cmd executed in % 0.2f seconds"
-                rsync_message = "rsync executed in %0.2f seconds, built destination (remote) directories"
-            elif ("code 12") and ("Permission denied") in stroutput:
-                if wdebug >= 1:
-                    logdbg(": rsync code 12 - %s" % stroutput)
-                rsync_message = "Permission error in rsync command, probably remote authentication ! FIX ME !"
-                loginf(":  ERR %s " % (rsync_message))
-                rsync_message = "code 12, rsync failed, executed in % 0.2f seconds"
-            elif ("code 12") and ("No route to host") in stroutput:
-                if wdebug >= 1:
-                    logdbg(": rsync code 12 - %s" % stroutput)
-                rsync_message = "No route to host error in rsync command ! FIX ME !"
-                loginf(":  ERR %s " % (rsync_message))
-                rsync_message = "code 12, rsync failed, executed in % 0.2f seconds"
-            else:
-                logerr("ERROR: : [%s] reported this error: %s" % (cmd, stroutput))
+def run_result(job, outcome, number):
+    """One run, as main() reports it."""
+    record = transfer_stats(job, outcome, job.rsyncinfo)._asdict()
+    result = collections.OrderedDict([('run', number)])
+    result['outcome'] = outcome
+    result['ok'] = bool(record.pop('ok'))
+    result['hint'] = RSYNC_POLICY.get(outcome, (None, None, outcome))[2]
+    result['duration'] = record.pop('duration')
+    result['phases'] = dict((phase, record.pop('phase_%s' % phase))
+                            for phase in PHASES)
+    for field in ('dateTime', 'section', 'dest', 'outcome'):
+        record.pop(field)
+    result['stats'] = record
+    result['rsync'] = job.rsyncinfo
+    return result
 
-        if self.log_success:
-            if wdebug == 0:
-                to = ''
-                rsyncremotespec = ''
-            else:
-                to = ' to '
-            t2= time.time()
-            loginf(": %s" % rsync_message % (t2-t1) + to + rsyncremotespec)
 
+def main(argv=None):
+    """
+    Run a report section's transfer outside weewx, print how it went as
+    JSON. Exits 0 if every run worked, 1 if any failed and 2 if the
+    section can't be run at all.
+    """
+    import argparse
 
-if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='rsynctransfer',
+        description="Run an rsynctransfer report section's transfer, as"
+        " weewx would, and print the outcome as JSON.",
+        epilog="eg: PYTHONPATH=/usr/share/weewx python3 -m"
+        " user.rsynctransfer /etc/weewx/weewx.conf --repeat 5")
+    parser.add_argument('config', help="weewx.conf")
+    parser.add_argument('--section', default='RsyncTransfer',
+                        help="the [StdReport] section [RsyncTransfer]")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="check the plan and rsync --dry-run to the"
+                        " destination, nothing is sent")
+    parser.add_argument('--repeat', type=int, default=1, metavar='N',
+                        help="run the transfer N times [1]")
+    parser.add_argument('--interval', type=float, default=0, metavar='SECONDS',
+                        help="between repeats [0]")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="cProfile the runs, stats dumped to FILE")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="debug logging, to stderr")
+    args = parser.parse_args(argv)
 
-    # To run this manually it's best to construct a minimalist, renamed
-    # weewx.conf file, with (possibly) modified skin files, and run that
-    # to test this script with :-
-    #
-    # wee_reports /etc/weewx/weewx-test.conf
-    #
-    # The report_timing stanza is ignored when testing with wee_reports -
-    # everything else will be actioned on though.
-    #
-    # Running this directly returns an error
-    #$ PYTHONPATH=/usr/share/weewx python /usr/share/weewx/weeutil/rsynctransfer.py
-    #   Traceback (most recent call last):
-    #  File "/usr/share/weewx/weeutil/rsynctransfer.py", line 23, in <module>
-    #    import weewx.engine
-    #  File "/usr/share/weewx/weewx/engine.py", line 26, in <module>
-    #    import weewx.accum
-    #  File "/usr/share/weewx/weewx/accum.py", line 12, in <module>
-    #    from weewx.units import ListOfDicts
-    #  File "/usr/share/weewx/weewx/units.py", line 15, in <module>
-    #    import weeutil.weeutil
-    #ImportError: No module named weeutil
-
-    import weewx
-    import configobj
-
-    wdebug = 2
-    syslog.openlog('rsynctransfer', syslog.LOG_PID|syslog.LOG_CONS)
-    syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
-
-    if len(sys.argv) < 2:
-        #print Usage: rsynctransfer.py path-to-configuration-file [path-to-be-rsync'd]
-        sys.exit(weewx.CMD_ERROR)
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="rsynctransfer: %(message)s")
 
     try:
-        config_dict = configobj.ConfigObj(sys.argv[1], file_error=True)
-    except IOError:
-        #print "Unable to open configuration file ", sys.argv[1]
-        raise
+        config_dict = configobj.ConfigObj(args.config, file_error=True)
+        skin_dict = rsynct_skin_dict(config_dict, args.section)
+        skin_section = skin_dict['RsyncTransfer']
+        if args.verbose:
+            config_dict['debug'] = 2
+    except (IOError, configobj.ConfigObjError) as e:
+        print(json.dumps({'error': "can't read %s: %s" % (args.config, e)}))
+        return 2
+    except KeyError as e:
+        print(json.dumps({'error': "no %s in %s" % (e, args.config)}))
+        return 2
 
-    if len(sys.argv) == 2:
-        try:
-            rsync_dir = os.path.join(config_dict['WEEWX_ROOT'],
-                                     config_dict['StdReport']['HTML_ROOT'])
-        except KeyError:
-            #print "No HTML_ROOT in configuration dictionary."
-            sys.exit(1)
+    t0 = time.time()
+    plan = get_plan(config_dict, skin_section, args.section)
+    # the plan is only made the once, it's part of the first run
+    config_time = time.time() - t0
+    report = collections.OrderedDict()
+    report['section'] = args.section
+    report['dest'] = plan.dest_key
+    report['cmd'] = plan.cmd
+    report['problems'] = [collections.OrderedDict([('fatal', fatal),
+                                                   ('message', message)])
+                          for (fatal, message) in plan.problems]
+    if plan.fatal:
+        print(json.dumps(report, indent=1))
+        return 2
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    runs = []
+    if args.dry_run:
+        t1 = time.time()
+        (klass, hint, errors) = plan.dry_run()
+        runs.append(collections.OrderedDict([
+            ('run', 1), ('outcome', klass), ('ok', klass in ('ok', 'vanished')),
+            ('hint', hint), ('duration', time.time() - t1),
+            ('errors', errors)]))
     else:
-        rsync_dir = sys.argv[2]
+        for number in range(1, max(args.repeat, 1) + 1):
+            if number > 1 and args.interval:
+                time.sleep(args.interval)
+            job = plan.job(config_time=config_time if number == 1 else 0)
+            outcome = job.run()
+            runs.append(run_result(job, outcome, number))
+
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+            'cumulative').print_stats(15)
 
-    rsync_transfer = Rsynct(rsync_dir, **config_dict['StdReport']['RSYNC'])
-    #rsynctransfer()
+    report['runs'] = runs
+    durations = [run['duration'] for run in runs]
+    report['summary'] = collections.OrderedDict([
+        ('runs', len(runs)),
+        ('ok', len([run for run in runs if run['ok']])),
+        ('p50', percentile(durations, 50)),
+        ('p95', percentile(durations, 95)),
+        ('max', max(durations) if durations else None)])
+    print(json.dumps(report, indent=1, default=str))
+    return 0 if report['summary']['ok'] == len(runs) else 1
 
+
+if __name__ == '__main__':
+    sys.exit(main())
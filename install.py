@@ -41,7 +41,9 @@ class rsynctransferInstaller(ExtensionInstaller):
                         'skin': 'rsynctransfer'
                    }}},
             files=[('bin/user',
-                    ['bin/user/rsynctransfer.py']),
+                    ['bin/user/rsynctransfer.py',
+                     'bin/user/rsynct_segments.py',
+                     'bin/user/rsynct_receiver.py']),
                    ('skins/rsynctransfer',
                     ['skins/rsynctransfer/skin.conf']),
                   ]
@@ -0,0 +1,245 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""
+The tests run from the source tree, python3 -m pytest tests.
+
+rsynctransfer only needs of weewx its logging, to_int/to_bool and
+SearchList to be importable, so where weewx (or configobj) isn't
+installed, the few names it uses are stood in for here. With weewx
+installed, eg: PYTHONPATH=/usr/share/weewx, the real ones are used.
+
+rsync and ssh are never run; the fake_rsync fixture puts a script of
+that name on the PATH which records its arguments, prints a --stats
+block and exits as told, and an ssh that can't connect. The ssh master test needs an sshd to talk to,
+RSYNCT_TEST_SSH=user@host[:port], with keys set up; it is skipped
+without one.
+"""
+
+import json
+import os
+import stat
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+
+
+def stub_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    if '.' in name:
+        (parent, child) = name.rsplit('.', 1)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def to_int(x):
+    """weeutil.weeutil.to_int"""
+    if isinstance(x, str) and x.lower() == 'none':
+        x = None
+    try:
+        return int(x) if x is not None else None
+    except ValueError:
+        return int(float(x))
+
+
+def to_bool(value):
+    """weeutil.weeutil.to_bool"""
+    try:
+        if value.lower() in ['true', 'yes']:
+            return True
+        elif value.lower() in ['false', 'no']:
+            return False
+    except AttributeError:
+        pass
+    try:
+        return bool(int(value))
+    except (ValueError, TypeError):
+        pass
+    raise ValueError("Unknown boolean specifier: '%s'." % value)
+
+
+class SearchList(object):
+    """weewx.cheetahgenerator.SearchList"""
+
+    def __init__(self, generator):
+        self.generator = generator
+
+
+def get_database_dict_from_config(config_dict, database):
+    """weewx.manager.get_database_dict_from_config, SQLite only"""
+    db_dict = dict(config_dict['Databases'][database])
+    db_dict.update(config_dict['DatabaseTypes'][db_dict.pop('database_type')])
+    return db_dict
+
+
+try:
+    import weewx.cheetahgenerator  # noqa: F401
+except ImportError:
+    stub_module('weewx', debug=0, CMD_ERROR=2)
+    stub_module('weewx.engine')
+    stub_module('weewx.units')
+    stub_module('weewx.manager',
+                get_database_dict_from_config=get_database_dict_from_config)
+    stub_module('weewx.cheetahgenerator', SearchList=SearchList)
+    stub_module('weeutil')
+    stub_module('weeutil.weeutil', to_int=to_int, to_bool=to_bool)
+
+try:
+    import configobj  # noqa: F401
+except ImportError:
+    class ConfigObj(dict):
+        """Just enough; the tests hand it dicts, not files."""
+
+        def __init__(self, infile=None, **kwargs):
+            dict.__init__(self, infile if isinstance(infile, dict) else {})
+
+        def merge(self, other):
+            self.update(other)
+
+    stub_module('configobj', ConfigObj=ConfigObj, ConfigObjError=Exception)
+
+
+FAKE_RSYNC = r'''#!%(python)s
+import json, os, sys
+argv = sys.argv[1:]
+if argv == ['--version']:
+    print("rsync  version 3.2.7  protocol version 31")
+    print("Compress list:")
+    print("    %(compress)s")
+    sys.exit(0)
+with open(%(log)r, 'a') as f:
+    f.write(json.dumps(argv) + "\n")
+for arg in argv:
+    if arg.startswith('--write-batch='):
+        open(arg.split('=', 1)[1], 'w').close()
+if '--itemize-changes' in argv:
+    print(">f.st...... index.html")
+    print(">f+++++++++ new/a.html")
+    print("*deleting   old.html")
+print("""
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 2
+Number of deleted files: 0
+Number of regular files transferred: 5
+Total file size: 12,345,678 bytes
+Total transferred file size: 12,345 bytes
+Literal data: 1,234 bytes
+Matched data: 11,111 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 2,345
+Total bytes received: 123
+
+sent 2,345 bytes  received 123 bytes  4,936.00 bytes/sec
+total size is 12,345,678  speedup is 5,002.30""")
+fail = os.environ.get('FAKE_RSYNC_FAIL', '')
+if fail and (not os.environ.get('FAKE_RSYNC_MATCH') or
+             os.environ['FAKE_RSYNC_MATCH'] in ' '.join(argv)):
+    (code, _, text) = fail.partition(':')
+    sys.stderr.write("rsync error: %%s\n" %% text)
+    sys.exit(int(code))
+'''
+
+
+class FakeRsync(object):
+    """The fake rsync's record of how it was run."""
+
+    def __init__(self, bindir, log):
+        self.bindir = bindir
+        self.log = log
+
+    def calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def fail(self, monkeypatch, code, text='', match=None):
+        """Have the runs whose arguments contain match exit with code."""
+        monkeypatch.setenv('FAKE_RSYNC_FAIL', "%s:%s" % (code, text))
+        if match is not None:
+            monkeypatch.setenv('FAKE_RSYNC_MATCH', match)
+
+
+@pytest.fixture
+def fake_rsync(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    log = str(tmp_path / 'rsync.log')
+    path = bindir / 'rsync'
+    path.write_text(FAKE_RSYNC % {'python': sys.executable, 'log': log,
+                                  'compress': 'zstd lz4 zlibx zlib none'})
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    # and no host is ever reached
+    ssh = bindir / 'ssh'
+    ssh.write_text("#!/bin/sh\necho 'ssh: connect to host: Connection"
+                   " refused' >&2\nexit 255\n")
+    ssh.chmod(ssh.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.delenv('FAKE_RSYNC_FAIL', raising=False)
+    monkeypatch.delenv('FAKE_RSYNC_MATCH', raising=False)
+    # nothing carried over from another test
+    import user.rsynctransfer as rsynctransfer
+    monkeypatch.setattr(rsynctransfer, 'rsync_caps', None)
+    for name in ('breakers', 'manifests', 'remote_dirs', 'textfiles',
+                 'statsd_clients', 'metrics_stores', 'plans'):
+        monkeypatch.setattr(rsynctransfer, name, {})
+    monkeypatch.setattr(rsynctransfer, 'ssh_pool',
+                        rsynctransfer.SshMasterPool())
+    monkeypatch.setattr(rsynctransfer, 'generated_files',
+                        rsynctransfer.GeneratedFiles())
+    return FakeRsync(str(bindir), log)
+
+
+@pytest.fixture
+def make_plan(tmp_path, fake_rsync):
+    """
+    Makes the TransferPlan for a section, from its options, sending
+    tmp_path/html, a few files, to tmp_path/dest by the fake rsync.
+    """
+    import user.rsynctransfer as rsynctransfer
+    html = tmp_path / 'html'
+    (html / 'sub').mkdir(parents=True)
+    for name in ('index.html', 'week.html', 'sub/daytemp.png'):
+        (html / name).write_text(name)
+    state = tmp_path / 'state'
+    state.mkdir()
+
+    def make_plan(config_dict=None, **options):
+        section = {'server': 'localhost', 'remote_root': str(tmp_path / 'dest'),
+                   'state_dir': str(state), 'log_success': 'false'}
+        section.update(options)
+        config = {'StdReport': {'HTML_ROOT': str(html)}}
+        config.update(config_dict or {})
+        return rsynctransfer.TransferPlan(config, section)
+    return make_plan
+
+
+@pytest.fixture
+def listing():
+    """
+    Has a job keep the --files-from list rsync is given in job.listing,
+    None for everything; the file has gone by the time the job has run.
+    """
+    def listing(job):
+        rsync = job.rsync
+        job.listing = None
+
+        def wrapper(cmd, stdin=None):
+            for arg in cmd:
+                if arg.startswith('--files-from='):
+                    with open(arg.split('=', 1)[1]) as f:
+                        job.listing = f.read().split()
+            return rsync(cmd, stdin)
+        job.rsync = wrapper
+        return job
+    return listing
@@ -0,0 +1,100 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import time
+
+import pytest
+
+import user.rsynctransfer as rsynctransfer
+
+
+@pytest.mark.parametrize('opts, expected', [
+    (['-aOvz'], ['-aOv']),
+    (['-z'], []),
+    (['-a', '--compress', '--zc=zstd', '--compress-level=3'], ['-a']),
+    (['-a', '--exclude=*.zip'], ['-a', '--exclude=*.zip']),
+])
+def test_strip_compress(opts, expected):
+    assert rsynctransfer.strip_compress(opts) == expected
+
+
+def remote(make_plan, **options):
+    return make_plan(server='example.org', ssh_master='false',
+                     rsync_options='-az', **options)
+
+
+def test_compress_unset(make_plan, fake_rsync):
+    # rsync_options are left as they are
+    plan = remote(make_plan)
+    assert plan.compress is False
+    cmd = plan.job().cmd
+    assert '-az' in cmd
+    assert not [opt for opt in cmd if opt.startswith('--compress') or
+                opt.startswith('--skip-compress')]
+
+
+def test_compress_true(make_plan, fake_rsync):
+    job = remote(make_plan, compress='true').job()
+    assert '-az' in job.cmd and '--compress' in job.cmd
+    assert '--skip-compress=%s' % rsynctransfer.SKIP_COMPRESS in job.cmd
+    assert job.compress_choice == 'any'
+
+
+def test_compress_auto(make_plan, fake_rsync):
+    job = remote(make_plan, compress='auto', skip_compress='gz').job()
+    # -z goes, the choice is the job's; with no history, a slow link
+    assert '-a' in job.cmd and '-az' not in job.cmd
+    assert job.cmd[-3:] == ['--compress', '--compress-choice=zstd',
+                            '--compress-level=3']
+    assert '--skip-compress=gz' in job.cmd
+    assert job.compress_choice == 'zstd-3'
+
+
+def test_compress_localhost(make_plan, fake_rsync):
+    plan = make_plan(compress='auto', rsync_options='-az')
+    assert '-az' in plan.job().cmd
+    assert ("compress doesn't apply to server = localhost, not used"
+            in [message for (fatal, message) in plan.validate()])
+
+
+def record(age, **values):
+    fields = dict((field, 0) for field in rsynctransfer.TransferStats._fields)
+    fields.update(dateTime=int(time.time() - age), section='RsyncTransfer',
+                  dest='dest', outcome='ok', ok=1, cpu=None, speedup=None,
+                  compress=None)
+    fields.update(values)
+    return rsynctransfer.TransferStats(**fields)
+
+
+def test_choose(fake_rsync, tmp_path):
+    store = rsynctransfer.MetricsStore(str(tmp_path / 'metrics.sdb'))
+    compression = rsynctransfer.Compression(store, 'dest')
+    assert compression.choose() == ('zstd', 3)
+    # a fast link, squeezing well at little CPU
+    for n in range(3):
+        store.add(record(60, sent=10 ** 7, literal=4 * 10 ** 7,
+                         phase_transfer=1.0, cpu=0.1, compress='lz4'))
+    assert compression.choose() == ('lz4', None)
+    # data that doesn't squeeze isn't worth it
+    for n in range(20):
+        store.add(record(30, sent=10 ** 7, literal=10 ** 7,
+                         phase_transfer=1.0, cpu=0.1, compress='lz4'))
+    assert compression.choose() == (None, None)
+    assert compression.options() == ([], None)
+
+
+def test_refused_algorithm_retried(fake_rsync, tmp_path):
+    store = rsynctransfer.MetricsStore(str(tmp_path / 'metrics.sdb'))
+    compression = rsynctransfer.Compression(store, 'dest')
+    store.add(record(2 * 86400, outcome='config', ok=0, compress='zstd-3'))
+    # that was long enough ago to try again
+    assert compression.failed() == set()
+    assert compression.choose() == ('zstd', 3)
+    store.add(record(60, outcome='config', ok=0, compress='zstd-3'))
+    assert compression.failed() == set(['zstd'])
+    assert compression.choose() == ('zlib', 6)
+    # it worked, after all
+    store.add(record(30, compress='zstd-3'))
+    assert compression.failed() == set()
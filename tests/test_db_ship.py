@@ -0,0 +1,47 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+import sqlite3
+
+import user.rsynct_segments as rsynct_segments
+
+
+def make_db(path, start, n):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS archive"
+                 " (dateTime INTEGER PRIMARY KEY, outTemp REAL)")
+    conn.executemany("INSERT INTO archive VALUES (?, ?)",
+                     [(start + i * 300, i / 10.0) for i in range(n)])
+    conn.commit()
+    conn.close()
+
+
+def test_db_ship(make_plan, fake_rsync, listing, tmp_path):
+    db = str(tmp_path / 'weewx.sdb')
+    make_db(db, 1000, 10)
+    plan = make_plan(db_ship=db)
+    assert [message for (fatal, message) in plan.validate()] == []
+    job = listing(plan.job())
+    assert job.run() == 'ok'
+    assert job.listing == [
+        os.path.basename(rsynct_segments.base_name('', 1000 + 9 * 300)),
+        'rsynct_segments.py']
+    # sent, so no longer staged
+    assert os.listdir(plan.staging) == []
+    assert plan.job().run() == 'skipped'
+    make_db(db, 1000 + 10 * 300, 5)
+    job = listing(plan.job())
+    assert job.run() == 'ok'
+    assert job.listing == ['seg-%010d-%010d.jsonl.gz' % (4000, 5200)]
+    assert '--delete' not in fake_rsync.calls()[-1]
+
+
+def test_db_ship_one_database(make_plan, tmp_path):
+    dbs = [str(tmp_path / name) for name in ('weewx.sdb', 'other.sdb')]
+    plan = make_plan(db_ship=dbs)
+    assert plan.shipper.db == dbs[0]
+    assert (False, "db_ship takes one database, only %s is shipped"
+            % dbs[0]) in plan.validate()
@@ -0,0 +1,106 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import pytest
+
+import user.rsynctransfer as rsynctransfer
+
+
+@pytest.mark.parametrize('returncode, errors, expected', [
+    (0, '', 'ok'),
+    (24, 'file has vanished: "/x"', 'vanished'),
+    (255, 'ssh: connect to host x port 22: Connection refused', 'unreachable'),
+    (255, 'Permission denied (publickey).', 'auth'),
+    (255, 'Host key verification failed.', 'auth'),
+    # a local file that can't be read isn't an ssh problem
+    (23, 'rsync: send_files failed to open "/x": Permission denied (13)',
+     'partial'),
+    (23, 'rsync: mkdir "/a/b" failed: No such file or directory', 'missing_dir'),
+    (11, 'rsync: write failed: No space left on device (28)', 'disk_full'),
+    (23, 'rsync: link_stat "/x" failed: No such file or directory',
+     'local_missing'),
+    (1, 'rsync: mkdir is not an option', 'config'),
+    (99, '', 'unknown'),
+])
+def test_classify(returncode, errors, expected):
+    assert rsynctransfer.classify(returncode, errors) == expected
+
+
+def test_classify_timeout():
+    assert rsynctransfer.classify(255, 'Permission denied', True) == 'timeout'
+
+
+def test_unreachable_not_retried():
+    (action, breaker, hint) = rsynctransfer.RSYNC_POLICY['unreachable']
+    assert action == 'fail' and breaker
+
+
+def test_breaker_half_open():
+    breaker = rsynctransfer.CircuitBreaker(failures=2, cooloff=100)
+    assert breaker.allow(0) == 0
+    assert breaker.failure(0) == 0
+    assert breaker.failure(10) == 100
+    assert breaker.allow(50) == 60
+    # one probe, the rest wait on it
+    assert breaker.allow(110) == 0
+    assert breaker.allow(111) > 0
+    # it failed, so the breaker opens again, for longer
+    assert breaker.failure(120) == 200
+    assert breaker.allow(200) == 120
+    assert breaker.allow(320) == 0
+    breaker.success()
+    assert breaker.allow(321) == 0
+    assert breaker.allow(322) == 0
+
+
+def test_breaker_lost_probe():
+    breaker = rsynctransfer.CircuitBreaker(failures=1, cooloff=100)
+    assert breaker.failure(0) == 100
+    assert breaker.allow(100) == 0
+    assert breaker.allow(150) == 50
+    # never heard of again
+    assert breaker.allow(200) == 0
+    breaker.abandon()
+    assert breaker.allow(201) == 0
+
+
+UNREACHABLE = 'ssh: connect to host example.org port 22: Connection refused'
+
+
+def test_job_breaker(make_plan, fake_rsync, monkeypatch):
+    plan = make_plan(server='example.org', ssh_master='false',
+                     breaker_failures='2', breaker_cooloff='100')
+    fake_rsync.fail(monkeypatch, 255, UNREACHABLE)
+    # not retried within the cycle
+    assert plan.job().run() == 'unreachable'
+    assert len(fake_rsync.calls()) == 1
+    assert plan.job().run() == 'unreachable'
+    assert plan.job().run() == 'breaker'
+    assert len(fake_rsync.calls()) == 2
+    # the cooloff is over; one probe goes ahead, the next waits on it
+    breaker = rsynctransfer.get_breaker('example.org')
+    breaker.open_until -= 100
+    (probe, waiting) = (plan.job(), plan.job())
+    running = []
+    probe_rsync = probe.rsync
+
+    def rsync(cmd, stdin=None):
+        running.append(waiting.run())
+        return probe_rsync(cmd, stdin)
+    probe.rsync = rsync
+    monkeypatch.delenv('FAKE_RSYNC_FAIL')
+    assert probe.run() == 'ok'
+    assert running == ['breaker']
+    assert plan.job().run() == 'ok'
+
+
+def test_job_retries(make_plan, fake_rsync, monkeypatch):
+    plan = make_plan(retries='2', retry_backoff='0')
+    fake_rsync.fail(monkeypatch, 23, 'some files could not be transferred')
+    assert plan.job().run() == 'partial'
+    assert len(fake_rsync.calls()) == 3
+    fake_rsync.fail(monkeypatch, 1, 'rsync: --bogus: unknown option')
+    assert plan.job().run() == 'config'
+    assert len(fake_rsync.calls()) == 4
@@ -0,0 +1,68 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import socket
+
+import pytest
+
+import user.rsynctransfer as rsynctransfer
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('myhost', ('myhost', 8125)),
+    ('myhost:9125', ('myhost', 9125)),
+    (':9125', ('localhost', 9125)),
+])
+def test_statsd_address(value, expected):
+    assert rsynctransfer.statsd_address(value) == expected
+
+
+def test_statsd_address_bad():
+    with pytest.raises(ValueError):
+        rsynctransfer.statsd_address('myhost:statsd')
+
+
+def test_textfile_shared(make_plan, fake_rsync, tmp_path):
+    textfile = str(tmp_path / 'rsynct.prom')
+    plans = [make_plan(remote_root=str(tmp_path / name),
+                       prometheus_textfile=textfile)
+             for name in ('a', 'b')]
+    plans.append(make_plan(remote_root=str(tmp_path / 'c'),
+                           prometheus_textfile=textfile,
+                           statsd='localhost:9'))
+    for plan in plans:
+        assert plan.job().run() == 'ok'
+    with open(textfile) as f:
+        text = f.read()
+    for name in ('a', 'b', 'c'):
+        assert 'rsynct_last_success{section="RsyncTransfer",dest="%s"} 1' \
+            % (tmp_path / name) in text
+    assert text.count('# TYPE rsynct_duration_seconds gauge') == 1
+    assert 'rsynct_phase_seconds{section="RsyncTransfer",dest="%s",' \
+        'phase="connect"}' % (tmp_path / 'a') in text
+    assert 'rsynct_itemized_files{section="RsyncTransfer",dest="%s",' \
+        'kind="created"} 1' % (tmp_path / 'a') in text
+    # rsync was asked what it did to each file
+    assert '--itemize-changes' in fake_rsync.calls()[0]
+
+
+def test_statsd(make_plan, fake_rsync):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(10)
+    try:
+        plan = make_plan(statsd='127.0.0.1:%s' % sock.getsockname()[1])
+        assert plan.job().run() == 'ok'
+        lines = sock.recv(65536).decode('utf-8').split("\n")
+    finally:
+        sock.close()
+    assert 'rsynct.RsyncTransfer.%s.files:5|g' % rsynctransfer.statsd_name(
+        plan.dest_key) in lines
+    assert [line for line in lines if '.phase.transfer:' in line]
+
+
+def test_no_exporter():
+    assert rsynctransfer.get_exporter(None, None) is None
+    assert rsynctransfer.get_exporter(None, 'myhost:statsd') is None
@@ -0,0 +1,81 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+import shutil
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_replay_options():
+    opts = ['rsync', '-az', '--stats', '--delete', '-e', 'ssh -p 22',
+            '--link-dest=/old', '--exclude=*.tmp', '--write-batch=/b']
+    assert rsynctransfer.replay_options(opts) == [
+        '-a', '--stats', '--delete', '--exclude=*.tmp']
+
+
+def fan_out(make_plan, tmp_path, **options):
+    """A section sending to tmp_path/dest, then nas and usb."""
+    return make_plan(destinations={
+        'nas': {'server': 'localhost', 'remote_root': str(tmp_path / 'nas')},
+        'usb': {'server': 'localhost', 'remote_root': str(tmp_path / 'usb')}},
+        **options)
+
+
+def cycle(plan, fake_rsync):
+    """Run the section's job, what each other destination got."""
+    done = len(fake_rsync.calls())
+    assert plan.job().run() == 'ok'
+    got = {}
+    for call in fake_rsync.calls()[done + 1:]:
+        dest = os.path.basename(call[-1].rstrip(os.sep))
+        got[dest] = 'batch' if call[0].startswith('--read-batch=') \
+            else 'full'
+    return got
+
+
+def test_fanout_replays(make_plan, fake_rsync, tmp_path):
+    plan = fan_out(make_plan, tmp_path)
+    assert plan.fanout.batch is not None
+    assert cycle(plan, fake_rsync) == {'nas': 'full', 'usb': 'full'}
+    assert '--write-batch=%s' % plan.fanout.batch in fake_rsync.calls()[0]
+    assert cycle(plan, fake_rsync) == {'nas': 'batch', 'usb': 'batch'}
+    assert plan.fanout.state['dests'] == dict(
+        (other.dest_key, 2) for (name, other) in plan.fanout.plans)
+    # a destination that has gone is made again for the replay
+    shutil.rmtree(str(tmp_path / 'nas'))
+    assert cycle(plan, fake_rsync) == {'nas': 'batch', 'usb': 'batch'}
+    assert os.path.isdir(str(tmp_path / 'nas'))
+
+
+def test_fanout_catch_up(make_plan, fake_rsync, tmp_path, monkeypatch):
+    plan = fan_out(make_plan, tmp_path)
+    cycle(plan, fake_rsync)
+    fake_rsync.fail(monkeypatch, 23, 'some files were not transferred',
+                    match='--read-batch')
+    done = len(fake_rsync.calls())
+    assert plan.job().run() == 'ok'
+    calls = fake_rsync.calls()[done + 1:]
+    # both replays failed, and both caught up with a full rsync
+    assert [call[0].startswith('--read-batch=') for call in calls] == [
+        True, True, False, False]
+    monkeypatch.delenv('FAKE_RSYNC_FAIL')
+    # back in the chain
+    assert cycle(plan, fake_rsync) == {'nas': 'batch', 'usb': 'batch'}
+
+
+def test_fanout_rechained_after_partial_first(make_plan, fake_rsync,
+                                              tmp_path, monkeypatch):
+    # the first destination is sent only the changes; the others, caught
+    # up in full, are as it is and follow its next batch
+    plan = fan_out(make_plan, tmp_path, skip_unchanged='true')
+    assert cycle(plan, fake_rsync) == {'nas': 'full', 'usb': 'full'}
+    (tmp_path / 'html' / 'index.html').write_text('changed')
+    fake_rsync.fail(monkeypatch, 23, 'some files were not transferred',
+                    match='--read-batch')
+    assert cycle(plan, fake_rsync) == {'nas': 'full', 'usb': 'full'}
+    monkeypatch.delenv('FAKE_RSYNC_FAIL')
+    (tmp_path / 'html' / 'week.html').write_text('changed')
+    assert cycle(plan, fake_rsync) == {'nas': 'batch', 'usb': 'batch'}
@@ -0,0 +1,82 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+import threading
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_files_from_generated(make_plan, fake_rsync, listing, tmp_path):
+    html = tmp_path / 'html'
+    plan = make_plan(files_from='generated')
+    # the first is a full transfer, nothing has been seen yet
+    job = listing(plan.job())
+    assert job.run() == 'ok'
+    assert job.listing is None
+    assert plan.job().run() == 'skipped'
+    with open(str(html / 'sub' / 'new.png'), 'w') as f:
+        f.write('new')
+    # as the generators do; the temporary file has gone by the transfer
+    with open(str(html / 'week.html.tmp'), 'w') as f:
+        f.write('week')
+    os.replace(str(html / 'week.html.tmp'), str(html / 'week.html'))
+    job = listing(plan.job())
+    assert job.run() == 'ok'
+    assert job.listing == ['sub/new.png', 'week.html']
+    assert len(fake_rsync.calls()) == 2
+
+
+def test_files_from_generated_failure_resent(make_plan, fake_rsync, listing,
+                                             tmp_path, monkeypatch):
+    html = tmp_path / 'html'
+    plan = make_plan(files_from='generated', retries='0')
+    assert plan.job().run() == 'ok'
+    (html / 'index.html').write_text('changed')
+    fake_rsync.fail(monkeypatch, 23, 'some files were not transferred')
+    assert plan.job().run() == 'partial'
+    monkeypatch.delenv('FAKE_RSYNC_FAIL')
+    (html / 'week.html').write_text('changed')
+    job = listing(plan.job())
+    assert job.run() == 'ok'
+    assert job.listing == ['index.html', 'week.html']
+
+
+class Held(dict):
+    """The watchers, the first look at which is held up, once read,
+    until told to go on."""
+
+    def __init__(self, watchers):
+        dict.__init__(self, watchers)
+        self.looking = threading.Event()
+        self.go_on = threading.Event()
+
+    def values(self):
+        values = list(dict.values(self))
+        if not self.looking.is_set():
+            self.looking.set()
+            self.go_on.wait(10)
+        return values
+
+
+def test_generated_take_during_write(tmp_path):
+    generated = rsynctransfer.GeneratedFiles()
+    assert generated.watch('dest', str(tmp_path))
+    generated.watchers = Held(generated.watchers)
+    path = str(tmp_path / 'index.html')
+    writer = threading.Thread(target=lambda: open(path, 'w').close())
+    writer.start()
+    # the hook is part way through noting the file when the job takes
+    # what has been written
+    assert generated.watchers.looking.wait(10)
+    taken = []
+    taker = threading.Thread(
+        target=lambda: taken.extend(generated.take('dest')))
+    taker.start()
+    taker.join(0.2)
+    generated.watchers.go_on.set()
+    writer.join(10)
+    taker.join(10)
+    assert taken + list(generated.take('dest')) == [path]
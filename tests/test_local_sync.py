@@ -0,0 +1,91 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+import types
+
+import pytest
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_local_sync_sources_share_dest(tmp_path):
+    # two sources ending in /, with delete, mustn't remove each other's
+    # files
+    for (name, files) in (('a', ['x', 'sub/y']), ('b', ['z'])):
+        for f in files:
+            path = tmp_path / name / f
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(f)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    (dest / 'stale').write_text('old')
+    sources = [str(tmp_path / 'a') + os.sep, str(tmp_path / 'b') + os.sep]
+    info = rsynctransfer.LocalSync(sources, str(dest), delete=True).run()
+    assert info['Number of deleted files'] == '1'
+    assert sorted(os.listdir(str(dest))) == ['sub', 'x', 'z']
+    info = rsynctransfer.LocalSync(sources, str(dest), delete=True).run()
+    assert info['Number of regular files transferred'] == '0'
+    assert info['Number of deleted files'] == '0'
+
+
+def test_local_sync_directories(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'sub' / 'a.html').write_text('a')
+    os.chmod(str(src / 'sub'), 0o750)
+    os.utime(str(src / 'sub'), (1000000, 1000000))
+    dest = tmp_path / 'dest'
+    for files_from in (None, ['sub/a.html']):
+        rsynctransfer.LocalSync([str(src) + os.sep], str(dest),
+                                files_from=files_from).run()
+        st = os.stat(str(dest / 'sub'))
+        assert oct(st.st_mode & 0o777) == oct(0o750)
+        assert st.st_mtime == 1000000
+        os.utime(str(dest / 'sub'), None)
+
+
+def test_local_sync_stale_tmp(tmp_path, monkeypatch):
+    src = tmp_path / 'src'
+    src.mkdir()
+    os.symlink('index.html', str(src / 'link'))
+    (src / 'index.html').write_text('new')
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    elsewhere = tmp_path / 'elsewhere'
+    elsewhere.write_text('not to be touched')
+    sync = rsynctransfer.LocalSync([str(src) + os.sep], str(dest))
+    # as an interrupted run would have left them
+    monkeypatch.setattr(rsynctransfer, 'threading',
+                        types.SimpleNamespace(get_ident=lambda: 42))
+    for name in ('link', 'index.html'):
+        os.symlink(str(elsewhere), str(dest / ('.%s.42' % name)))
+    sync.run()
+    assert os.readlink(str(dest / 'link')) == 'index.html'
+    assert (dest / 'index.html').read_text() == 'new'
+    assert elsewhere.read_text() == 'not to be touched'
+    assert sorted(os.listdir(str(dest))) == ['index.html', 'link']
+
+
+@pytest.mark.parametrize('opts, native', [
+    (['-a'], True),
+    (['-aOvz', '--delete'], True),
+    (['-aD'], False),
+    (['-a', '--exclude=*.tmp'], False),
+])
+def test_native_options(opts, native):
+    assert rsynctransfer.native_options(['rsync'] + opts + ['--stats']) == native
+
+
+def test_native_job(make_plan, fake_rsync, tmp_path):
+    plan = make_plan(local_engine='native', delete='true')
+    assert plan.native
+    job = plan.job()
+    assert job.run() == 'ok'
+    assert job.rsyncinfo['Number of regular files transferred'] == '3'
+    assert (tmp_path / 'dest' / 'sub' / 'daytemp.png').read_text() == \
+        'sub/daytemp.png'
+    assert fake_rsync.calls() == []
+    assert not make_plan(local_engine='native', rsync_options='-aD').native
@@ -0,0 +1,61 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_manifest_changes(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    for name in ('a.html', 'b.html', 'sub/c.png'):
+        (src / name).write_text(name)
+    manifest = rsynctransfer.Manifest(str(tmp_path / 'manifest'))
+    scan = manifest.scan([str(src)])
+    (changed, deleted) = manifest.changes(scan)
+    assert len(changed) == 3 and deleted == []
+    manifest.commit(scan)
+
+    manifest = rsynctransfer.Manifest(str(tmp_path / 'manifest'))
+    assert manifest.changes(manifest.scan([str(src)])) == ([], [])
+    (src / 'a.html').write_text('longer than it was')
+    (src / 'sub' / 'c.png').unlink()
+    (changed, deleted) = manifest.changes(manifest.scan([str(src)]))
+    assert changed == [str(src / 'a.html')]
+    assert deleted == [str(src / 'sub' / 'c.png')]
+
+
+def test_manifest_hash_ignores_rewrites(tmp_path):
+    path = tmp_path / 'index.html'
+    path.write_text('same')
+    manifest = rsynctransfer.Manifest(str(tmp_path / 'manifest'), True)
+    manifest.commit(manifest.scan([str(path)]))
+    os.utime(str(path), (1, 1))
+    assert manifest.changes(manifest.scan([str(path)])) == ([], [])
+
+
+def test_skip_unchanged(make_plan, fake_rsync, listing, tmp_path):
+    plan = make_plan(skip_unchanged='true')
+    job = listing(plan.job())
+    assert job.run() == 'ok'
+    assert job.listing is None
+    # nothing changed, no rsync
+    assert plan.job().run() == 'skipped'
+    assert len(fake_rsync.calls()) == 1
+    (tmp_path / 'html' / 'index.html').write_text('changed')
+    job = listing(plan.job())
+    assert job.run() == 'ok'
+    assert job.listing == ['index.html']
+
+
+def test_skip_unchanged_failure_resent(make_plan, fake_rsync, monkeypatch):
+    plan = make_plan(skip_unchanged='true', retries='0')
+    fake_rsync.fail(monkeypatch, 23, 'some files were not transferred')
+    assert plan.job().run() == 'partial'
+    monkeypatch.delenv('FAKE_RSYNC_FAIL')
+    # the far end isn't known to match, so it all goes again
+    assert plan.job().run() == 'ok'
+    assert len(fake_rsync.calls()) == 2
@@ -0,0 +1,71 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+import sqlite3
+import time
+
+import user.rsynctransfer as rsynctransfer
+
+
+def record(**values):
+    """A TransferStats, zeros but for values."""
+    fields = dict((field, 0) for field in rsynctransfer.TransferStats._fields)
+    fields.update(section='RsyncTransfer', dest='example.org:/www',
+                  outcome='ok', ok=1, compress=None, cpu=None, speedup=None)
+    fields.update(values)
+    return rsynctransfer.TransferStats(**fields)
+
+
+def test_metrics_store(tmp_path):
+    store = rsynctransfer.MetricsStore(str(tmp_path / 'metrics.sdb'), days=1)
+    now = int(time.time())
+    store.add(record(dateTime=now - 3 * 86400, duration=9.0))
+    # that one is pruned as this one goes in
+    store.add(record(dateTime=now - 60, duration=1.5, sent=1000))
+    store.add(record(dateTime=now, dest='other', outcome='unreachable', ok=0))
+    records = store.records(0)
+    assert [(r.duration, r.sent) for r in records] == [(1.5, 1000), (0, 0)]
+    assert [r.outcome for r in store.records(0, dest='other')] == [
+        'unreachable']
+    assert store.records(now + 1) == []
+
+
+def test_metrics_store_older_table(tmp_path):
+    # as an earlier version, without the newer fields, made it
+    path = str(tmp_path / 'metrics.sdb')
+    fields = ['dateTime', 'section', 'dest', 'outcome', 'ok', 'duration',
+              'files', 'sent']
+    now = int(time.time())
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE transfers (%s)" % ", ".join(fields))
+    conn.execute("INSERT INTO transfers VALUES (?, 's', 'd', 'ok', 1, 2.0,"
+                 " 3, 4)", (now - 60,))
+    conn.commit()
+    conn.close()
+    store = rsynctransfer.MetricsStore(path)
+    store.add(record(dateTime=now, files=5, sent=6, cpu=0.5, compress='zstd-3'))
+    [old, new] = store.records(0)
+    assert (old.files, old.sent, old.cpu) == (3, 4, None)
+    assert (new.files, new.sent, new.cpu, new.compress) == (5, 6, 0.5,
+                                                           'zstd-3')
+
+
+def test_job_recorded(make_plan, fake_rsync, tmp_path):
+    plan = make_plan(skip_unchanged='true')
+    assert plan.job().run() == 'ok'
+    assert plan.job().run() == 'skipped'
+    store = rsynctransfer.get_metrics(os.path.join(plan.state_dir,
+                                                   rsynctransfer.METRICS_FILE))
+    [sent, skipped] = store.records(0)
+    assert (sent.outcome, sent.files, sent.sent, sent.received) == (
+        'ok', 5, 2345, 123)
+    assert sent.phase_transfer > 0 and sent.duration >= sent.phase_transfer
+    assert (skipped.outcome, skipped.ok, skipped.files) == ('skipped', 1, 0)
+    history = rsynctransfer.TransferHistory(store)
+    assert history.count == 2 and history.failures == 0
+    assert history.ran == [sent]
+    assert history.last == skipped
+    assert history.section('Other').count == 0
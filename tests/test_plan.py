@@ -0,0 +1,73 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import user.rsynctransfer as rsynctransfer
+
+
+def test_option_int():
+    bad = []
+    assert rsynctransfer.option_int({'port': '2222'}, 'port', 22, bad) == 2222
+    assert rsynctransfer.option_int({}, 'port', 22, bad) == 22
+    assert rsynctransfer.option_int({'port': 'ssh'}, 'port', 22, bad) == 22
+    assert len(bad) == 1
+
+
+def test_ssh_options_quoted(tmp_path):
+    plan = rsynctransfer.TransferPlan(
+        {'StdReport': {'HTML_ROOT': str(tmp_path)}},
+        {'server': 'example.org', 'ssh_master': 'false',
+         'state_dir': str(tmp_path),
+         'ssh_options': '-o "ProxyCommand=ssh -W %h:%p bastion"'})
+    assert 'ProxyCommand=ssh -W %h:%p bastion' in plan.remote_shell
+    rsh = plan.cmd[plan.cmd.index('-e') + 1]
+    assert "'ProxyCommand=ssh -W %h:%p bastion'" in rsh
+
+
+def messages(plan):
+    return [message for (fatal, message) in plan.validate()]
+
+
+def test_validate_clean(make_plan):
+    assert messages(make_plan()) == []
+    assert messages(make_plan(server='example.org')) == []
+
+
+def test_validate(make_plan, tmp_path):
+    plan = make_plan(server=None, porrt='22', parallel='two',
+                     transfer_timeout='0')
+    problems = plan.validate()
+    assert (True, "no server given") in problems
+    assert (True, "transfer_timeout = 0, transfers would be killed at"
+            " once") in problems
+    assert (False, "unknown option porrt, a typo?") in problems
+    assert [message for (fatal, message) in problems
+            if message.startswith('parallel = two')]
+    assert plan.parallel == 1
+
+
+def test_validate_destination(make_plan, tmp_path):
+    plan = make_plan(destinations={
+        'same': {'remote_root': str(tmp_path / 'dest')},
+        'usb': {'remote_root': str(tmp_path / 'usb'), 'delete': 'true'}})
+    assert messages(plan) == [
+        "destination usb: delete can't be set per destination, ignored",
+        "destination same: %s is already sent to, skipped"
+        % (tmp_path / 'dest')]
+    assert [name for (name, p) in plan.fanout.plans] == ['usb']
+
+
+def test_get_plan(make_plan, fake_rsync, tmp_path):
+    config = {'StdReport': {'HTML_ROOT': str(tmp_path / 'html')}}
+    section = {'server': 'localhost', 'remote_root': str(tmp_path / 'dest'),
+               'state_dir': str(tmp_path / 'state')}
+    plan = rsynctransfer.get_plan(config, section)
+    assert plan.fatal == [] and plan.problems == []
+    # made once, until the configuration changes
+    assert rsynctransfer.get_plan(config, dict(section)) is plan
+    section['delete'] = 'true'
+    rebuilt = rsynctransfer.get_plan(config, section)
+    assert rebuilt is not plan and rebuilt.delete
+    assert rsynctransfer.get_plan(dict(config, debug='2'), section) \
+        is not rebuilt
@@ -0,0 +1,52 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_publisher(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a.html').write_text('a')
+    (src / 'b.html').write_text('b')
+    dest = str(tmp_path / 'dest')
+    publisher = rsynctransfer.Publisher(dest, keep=2)
+    inodes = []
+    for n in range(3):
+        staged = publisher.stage()
+        rsynctransfer.LocalSync([str(src) + os.sep], staged,
+                                link_dest=publisher.current()).run()
+        publisher.publish(staged)
+        assert os.path.islink(dest)
+        assert os.path.realpath(dest) == staged
+        inodes.append(os.stat(os.path.join(dest, 'a.html')).st_ino)
+    # unchanged, so hard linked from one generation to the next
+    assert len(set(inodes)) == 1
+    assert len(os.listdir(publisher.root)) == 2
+
+
+def test_publish_atomic(make_plan, fake_rsync, tmp_path):
+    plan = make_plan(local_engine='native', publish='atomic')
+    assert plan.native and plan.publisher is not None
+    dest = str(tmp_path / 'dest')
+    job = plan.job()
+    assert job.run() == 'ok'
+    assert os.path.islink(dest)
+    first = os.path.realpath(dest)
+    with open(os.path.join(dest, 'sub', 'daytemp.png')) as f:
+        assert f.read() == 'sub/daytemp.png'
+    (tmp_path / 'html' / 'index.html').write_text('changed')
+    (tmp_path / 'html' / 'week.html').unlink()
+    assert plan.job().run() == 'ok'
+    # a new tree, swapped in whole
+    assert os.path.realpath(dest) != first
+    assert sorted(os.listdir(dest)) == ['index.html', 'sub']
+    with open(os.path.join(dest, 'index.html')) as f:
+        assert f.read() == 'changed'
+    # the last one is still there, as it was
+    assert sorted(os.listdir(first)) == ['index.html', 'sub', 'week.html']
+    assert fake_rsync.calls() == []
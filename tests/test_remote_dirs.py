@@ -0,0 +1,44 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import user.rsynctransfer as rsynctransfer
+
+
+def rsync_paths(call):
+    return [arg for arg in call if arg.startswith('--rsync-path=')]
+
+
+def test_remote_dir_made_once(make_plan, fake_rsync, monkeypatch):
+    plan = make_plan(server='example.org', remote_root='/var/www/weewx',
+                     ssh_master='false')
+    assert plan.job().run() == 'ok'
+    assert plan.job().run() == 'ok'
+    (first, second) = fake_rsync.calls()
+    assert rsync_paths(first) == [
+        "--rsync-path=mkdir -p /var/www/weewx/ && rsync"]
+    assert rsync_paths(second) == []
+    # remembered from one plan to the next
+    plan = make_plan(server='example.org', remote_root='/var/www/weewx',
+                     ssh_master='false', delete='true')
+    assert plan.job().run() == 'ok'
+    assert rsync_paths(fake_rsync.calls()[-1]) == []
+
+
+def test_remote_dir_forgotten_when_missing(make_plan, fake_rsync,
+                                           monkeypatch):
+    plan = make_plan(server='example.org', remote_root='/var/www/weewx',
+                     ssh_master='false', retries='0')
+    assert plan.job().run() == 'ok'
+    fake_rsync.fail(monkeypatch, 3, 'rsync: change_dir#3 "/var/www/weewx"'
+                    ' failed: No such file or directory (2)')
+    assert plan.job().run() == 'missing_dir'
+    monkeypatch.delenv('FAKE_RSYNC_FAIL')
+    assert plan.job().run() == 'ok'
+    assert rsync_paths(fake_rsync.calls()[-1]) != []
+
+
+def test_mkdir_rsync_path_own():
+    assert rsynctransfer.mkdir_rsync_path(
+        ['rsync', '--rsync-path=sudo rsync'], '/x') is None
@@ -0,0 +1,86 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import subprocess
+import sys
+
+import user.rsynctransfer as rsynctransfer
+
+STATS = """
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of regular files transferred: 5
+Total transferred file size: 12,345 bytes
+Total bytes sent: 2,345
+
+sent 2,345 bytes  received 123 bytes  4,936.00 bytes/sec
+total size is 12,345,678  speedup is 5,002.30
+"""
+
+
+def follow(script, timeout=10, **kwargs):
+    """An RsyncOutput that has followed python running script."""
+    proc = subprocess.Popen([sys.executable, '-c', script],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            start_new_session=True)
+    output = rsynctransfer.RsyncOutput('test', **kwargs)
+    timed_out = output.follow(proc, timeout)
+    return output, proc.returncode, timed_out
+
+
+def test_stats():
+    (output, returncode, timed_out) = follow(
+        "import sys\n"
+        "for n in range(100000): print('file' + str(n) + '.html')\n"
+        "sys.stdout.write(%r)\n"
+        "sys.exit(23)" % STATS)
+    assert (returncode, timed_out) == (23, False)
+    assert output.nlines == 100000 + len(STATS.splitlines())
+    assert output.stats == {
+        'Number of files': '1,234 (reg: 1,000, dir: 234)',
+        'Number of regular files transferred': '5',
+        'Total transferred file size': '12,345 bytes',
+        'Total bytes sent': '2,345',
+        'sent': '2,345', 'received': '123', 'rate': '4,936.00',
+        'total size': '12,345,678', 'speedup': '5,002.30'}
+    assert output.cpu is not None
+
+
+def test_errors_bounded():
+    (output, returncode, timed_out) = follow(
+        "import sys\n"
+        "for n in range(1000): sys.stderr.write('error %s\\n' % n)\n"
+        "sys.stderr.write('x' * 100000)")
+    errors = output.error_text().split("\n")
+    assert len(errors) == rsynctransfer.RsyncOutput.MAX_ERRORS
+    assert errors[:2] == ['error 0', 'error 1']
+    # the last, unterminated, line cut short
+    assert errors[-1] == 'x' * rsynctransfer.RsyncOutput.MAX_LINE
+    assert errors[-2] == 'error 999'
+
+
+def test_itemized_and_progress():
+    (output, returncode, timed_out) = follow(
+        "import sys\n"
+        "sys.stdout.write('  1,000  10%%  1.00MB/s  0:00:01\\r')\n"
+        "print('>f.st...... index.html')\n"
+        "print('>f+++++++++ new/a.html')\n"
+        "print('cd+++++++++ new/')\n"
+        "print('hf+++++++++ b.html => a.html')\n"
+        "print('.f...p..... c.html')\n"
+        "print('*deleting   old.html')\n"
+        "sys.stdout.write(%r)" % STATS, timing=True)
+    assert output.items == {'updated': 1, 'created': 3, 'attributes': 1,
+                            'deleted': 1}
+    assert output.progress == '1,000  10%  1.00MB/s  0:00:01'
+    assert output.parse_time > 0
+
+
+def test_timeout():
+    (output, returncode, timed_out) = follow(
+        "import time\n"
+        "print('started', flush=True)\n"
+        "time.sleep(60)", timeout=0.5)
+    assert timed_out and returncode < 0
+    assert output.nlines == 1
@@ -0,0 +1,111 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import io
+import os
+import tarfile
+
+import pytest
+
+import user.rsynct_receiver as rsynct_receiver
+
+
+def make_files(root, names):
+    for name in names:
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write("contents of %s\n" % name)
+
+
+def test_bundle_round_trip(tmp_path):
+    src = str(tmp_path / 'src')
+    dest = str(tmp_path / 'dest')
+    names = ['index.html', 'NOAA/NOAA-2024.txt', 'js/app.js']
+    make_files(src, names)
+    (path, digest, packed, size) = rsynct_receiver.write_bundle(
+        src, names + ['gone.html'], str(tmp_path / 'bundles'))
+    assert sorted(packed) == sorted(names)
+    assert os.path.basename(path) == "bundle-%s.tar.gz" % digest
+    with open(path, 'rb') as f:
+        assert rsynct_receiver.receive(f, dest, digest) == 3
+    for name in names:
+        with open(os.path.join(dest, name)) as f:
+            assert f.read() == "contents of %s\n" % name
+
+
+def test_bundle_is_deterministic(tmp_path):
+    make_files(str(tmp_path), ['a.html', 'b.html'])
+    first = rsynct_receiver.write_bundle(str(tmp_path), ['a.html', 'b.html'],
+                                         str(tmp_path / 'one'))
+    second = rsynct_receiver.write_bundle(str(tmp_path), ['b.html', 'a.html'],
+                                          str(tmp_path / 'two'))
+    assert first[1] == second[1]
+
+
+def test_damaged_bundle_changes_nothing(tmp_path):
+    make_files(str(tmp_path / 'src'), ['a.html'])
+    (path, digest, packed, size) = rsynct_receiver.write_bundle(
+        str(tmp_path / 'src'), ['a.html'], str(tmp_path))
+    with open(path, 'r+b') as f:
+        f.seek(size // 2)
+        f.write(b'\xff\xff')
+    dest = str(tmp_path / 'dest')
+    os.makedirs(dest)
+    with pytest.raises(rsynct_receiver.BundleError):
+        rsynct_receiver.unpack(path, dest, digest)
+    assert os.listdir(dest) == []
+
+
+def bundle_of(path, members):
+    with tarfile.open(path, 'w:gz') as tar:
+        for (name, data) in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+@pytest.mark.parametrize('name', ['../escape', '/etc/passwd', '.rsynct/x'])
+def test_outside_destination_refused(tmp_path, name):
+    path = str(tmp_path / 'bad.tar.gz')
+    bundle_of(path, [('ok.html', b'fine'), (name, b'bad')])
+    dest = str(tmp_path / 'dest')
+    os.makedirs(dest)
+    with pytest.raises(rsynct_receiver.BundleError):
+        rsynct_receiver.unpack(path, dest)
+    # all or nothing, the good file isn't left behind either
+    assert os.listdir(dest) == []
+
+
+def test_unpack_cut_short_is_finished(tmp_path, monkeypatch):
+    dest = str(tmp_path / 'dest')
+    make_files(dest, ['a.html', 'b.html'])
+    path = str(tmp_path / 'new.tar.gz')
+    bundle_of(path, [('a.html', b'new a'), ('b.html', b'new b')])
+    replace = os.replace
+    renamed = []
+
+    def crash(src, dst):
+        # as if the power went after the first file was in place
+        if dst.endswith('.html') and renamed:
+            raise OSError("cut short")
+        renamed.append(dst)
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', crash)
+    with pytest.raises(OSError):
+        rsynct_receiver.unpack(path, dest)
+    monkeypatch.setattr(os, 'replace', replace)
+    with open(os.path.join(dest, 'b.html')) as f:
+        assert f.read() == "contents of b.html\n"
+    # the next unpack, of anything, finishes the last one first
+    other = str(tmp_path / 'other.tar.gz')
+    bundle_of(other, [('c.html', b'new c')])
+    assert rsynct_receiver.unpack(other, dest) == 1
+    for name in ('a', 'b', 'c'):
+        with open(os.path.join(dest, name + '.html')) as f:
+            assert f.read() == 'new ' + name
+    assert sorted(os.listdir(dest)) == [
+        rsynct_receiver.RECEIVER_DIR, 'a.html', 'b.html', 'c.html']
+    assert os.listdir(os.path.join(dest, rsynct_receiver.RECEIVER_DIR)) == []
@@ -0,0 +1,69 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import gzip
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import user.rsynct_segments as rsynct_segments
+
+
+def make_db(path, start, n):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS archive"
+                 " (dateTime INTEGER PRIMARY KEY, outTemp REAL)")
+    conn.executemany("INSERT INTO archive VALUES (?, ?)",
+                     [(start + i * 300, i / 10.0) for i in range(n)])
+    conn.commit()
+    return conn
+
+
+def rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT * FROM archive ORDER BY dateTime").fetchall()
+    finally:
+        conn.close()
+
+
+def test_round_trip(tmp_path):
+    db = str(tmp_path / 'weewx.sdb')
+    ship = str(tmp_path / 'ship')
+    os.makedirs(ship)
+    conn = make_db(db, 1000, 10)
+    shutil.copyfile(db, rsynct_segments.base_name(ship, 1000 + 9 * 300))
+    last = 1000 + 9 * 300
+    for start in (4000, 7000):
+        conn.executemany("INSERT INTO archive VALUES (?, ?)",
+                         [(start + i * 300, 1.0) for i in range(5)])
+        conn.commit()
+        (path, last, n) = rsynct_segments.write_segment(conn, last, ship)
+        assert n == 5
+    assert rsynct_segments.write_segment(conn, last, ship) is None
+    conn.close()
+
+    out = str(tmp_path / 'out.sdb')
+    assert rsynct_segments.restore(ship, out) == last
+    assert rows(out) == rows(db)
+
+    base = rsynct_segments.compact(ship)
+    assert rsynct_segments.segments_in(ship) == []
+    assert rows(base) == rows(db)
+
+
+def test_damaged_segment(tmp_path):
+    conn = make_db(str(tmp_path / 'weewx.sdb'), 1000, 3)
+    (path, last, n) = rsynct_segments.write_segment(conn, 0, str(tmp_path))
+    conn.close()
+    with gzip.open(path, 'rb') as f:
+        lines = f.read().splitlines(True)
+    lines[1] = lines[1].replace(b'0.1', b'9.9').replace(b'0.0', b'9.9')
+    with gzip.open(path, 'wb') as f:
+        f.write(b''.join(lines))
+    with pytest.raises(rsynct_segments.SegmentError):
+        rsynct_segments.read_segment(path)
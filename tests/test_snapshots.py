@@ -0,0 +1,48 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import json
+import os
+import time
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_snapshots_expired(tmp_path):
+    dates = ['2024/01/%02d' % d for d in range(1, 32)] + \
+        ['2023/12/31', '2023/11/30']
+    snapshots = rsynctransfer.Snapshots(str(tmp_path / 'snapshots'), '/backup',
+                                        '2024/02/01')
+    snapshots.dates = sorted(dates)
+    assert snapshots.expired() == []
+    expired = snapshots.expired(daily=7)
+    assert len(expired) == len(dates) - 7
+    assert '2024/01/31' not in expired and '2024/01/24' in expired
+    kept = set(dates) - set(snapshots.expired(daily=3, monthly=3))
+    assert kept == set(['2024/01/31', '2024/01/30', '2024/01/29',
+                        '2023/12/31', '2023/11/30'])
+    assert snapshots.link_dest() == '/backup/2024/01/31'
+
+
+def test_dated_dir_links_and_prunes(make_plan, fake_rsync, tmp_path):
+    dest = tmp_path / 'dest'
+    plan = make_plan(dated_dir='true', keep_daily='2')
+    older = ['2000/01/01', '2000/01/02', '2000/01/03']
+    for date in older:
+        (dest / date).mkdir(parents=True)
+    with open(rsynctransfer.state_file(plan.state_dir, 'snapshots',
+                                       plan.dest_key), 'w') as f:
+        json.dump(older, f)
+    today = time.strftime("%Y/%m/%d")
+    assert plan.job().run() == 'ok'
+    [call] = fake_rsync.calls()
+    assert '--link-dest=%s/2000/01/03' % dest in call
+    assert call[-1] == "%s/%s/" % (dest, today)
+    # today's and the one before it
+    assert sorted(os.listdir(str(dest / '2000'))) == ['01']
+    assert os.listdir(str(dest / '2000' / '01')) == ['03']
+    with open(rsynctransfer.state_file(plan.state_dir, 'snapshots',
+                                       plan.dest_key)) as f:
+        assert json.load(f) == ['2000/01/03', today]
@@ -0,0 +1,53 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+import shutil
+
+import pytest
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_ssh_master_private_dir(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(str(shared), 0o777)
+    master = rsynctransfer.SshMaster('me', 'example.org',
+                                     control_dir=str(shared))
+    assert not master.private
+    assert 'ControlPath' not in master.rsh()
+    master = rsynctransfer.SshMaster('me', 'example.org',
+                                     control_dir=str(tmp_path / 'mine'))
+    assert master.private
+    assert oct(os.stat(str(tmp_path / 'mine')).st_mode & 0o777) == oct(0o700)
+
+
+def test_ssh_master_shared(make_plan):
+    # one master per host, whichever section is sending to it
+    plans = [make_plan(server='example.org', remote_root=root)
+             for root in ('/a', '/b')]
+    assert plans[0].master is plans[1].master
+    rsh = plans[0].cmd[plans[0].cmd.index('-e') + 1]
+    assert 'ControlPath=%s' % plans[0].master.control_path in rsh
+    assert 'ControlMaster=no' in rsh
+    assert make_plan(server='example.org', ssh_master='false').master is None
+
+
+@pytest.mark.skipif(not os.environ.get('RSYNCT_TEST_SSH') or
+                    not shutil.which('ssh'),
+                    reason="RSYNCT_TEST_SSH=user@host[:port] for an sshd")
+def test_ssh_master_against_sshd(tmp_path):
+    (target, _, port) = os.environ['RSYNCT_TEST_SSH'].partition(':')
+    (user, _, host) = target.rpartition('@')
+    master = rsynctransfer.SshMaster(user or None, host, port or None,
+                                     persist=30,
+                                     control_dir=str(tmp_path / 'ssh'))
+    try:
+        assert master.ensure()
+        assert master.check()
+    finally:
+        master.close()
+    assert not master.check()
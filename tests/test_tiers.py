@@ -0,0 +1,62 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import user.rsynctransfer as rsynctransfer
+
+
+def test_tier_filters(tmp_path):
+    tiers = rsynctransfer.Tiers([('current', ['index.html', '*.json'], 0),
+                                 ('plots', ['*.png'], 900),
+                                 ('rest', None, 3600)],
+                                str(tmp_path / 'tiers'))
+    assert tiers.due(10000) == ['current', 'plots', 'rest']
+    assert tiers.filters(['current', 'plots', 'rest']) == []
+    assert tiers.filters(['current']) == [
+        '--include=index.html', '--include=*.json', '--exclude=*.png',
+        '--include=*/', '--exclude=*', '--prune-empty-dirs']
+    assert tiers.filters(['current', 'rest']) == [
+        '--include=index.html', '--include=*.json', '--exclude=*.png']
+    tiers.sent(['current', 'plots', 'rest'], 10000)
+    assert tiers.due(10300) == ['current']
+    # a little early still counts
+    assert tiers.due(10850) == ['current', 'plots']
+
+
+def test_rsynct_tiers_bad_interval():
+    bad = []
+    tiers = rsynctransfer.rsynct_tiers({'plots': {'include': '*.png',
+                                                  'interval': '15m'}}, bad)
+    assert tiers == [('plots', ['*.png'], 0)]
+    assert len(bad) == 1 and 'plots' in bad[0]
+
+
+def test_tiers_job(make_plan, fake_rsync):
+    plan = make_plan(tiers={'current': {'include': ['index.html']},
+                            'plots': {'include': '*.png', 'interval': '900'}})
+    assert plan.validate() == []
+    job = plan.job()
+    assert job.run() == 'ok' and job.in_sync
+    # all due the first time, so no filters
+    assert not [arg for arg in fake_rsync.calls()[0]
+                if arg.startswith(('--include', '--exclude'))]
+    job = plan.job()
+    assert job.run() == 'ok' and not job.in_sync
+    assert fake_rsync.calls()[1][2:6] == [
+        '--include=index.html', '--exclude=*.png', '--include=*/',
+        '--exclude=*']
+    # a tier is only counted as sent once it has been
+    plan.tiers.last['plots'] -= 900
+    job = plan.job()
+    job.rsync = failed(job.rsync)
+    assert job.run() != 'ok'
+    assert plan.tiers.due(job.phases.start) == ['current', 'plots']
+
+
+def failed(rsync):
+    """rsync, as if it had failed."""
+    def wrapper(cmd, stdin=None):
+        (output, returncode, timed_out) = rsync(cmd, stdin)
+        return output, 1, timed_out
+    return wrapper
@@ -0,0 +1,64 @@
+#
+#    Copyright (c) 2024 Glenn McKechnie <glenn.mckechnie@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+import os
+import threading
+
+import user.rsynctransfer as rsynctransfer
+
+
+def test_job_runs_rsync(make_plan, fake_rsync, tmp_path):
+    plan = make_plan(rsync_options='-a --exclude=*.tmp')
+    job = plan.job()
+    assert job.run() == 'ok'
+    dest = str(tmp_path / 'dest') + os.sep
+    assert fake_rsync.calls() == [['-a', '--exclude=*.tmp', '--stats',
+                                   str(tmp_path / 'html') + os.sep, dest]]
+    # made ready for rsync
+    assert os.path.isdir(dest)
+    assert job.rsyncinfo['Number of regular files transferred'] == '5'
+    assert job.in_sync
+
+
+def test_worker_merges_queued_jobs(make_plan, fake_rsync):
+    plan = make_plan()
+    worker = rsynctransfer.TransferWorker()
+    running = threading.Event()
+    release = threading.Event()
+    first = plan.job()
+    first_run = first.run
+
+    def held():
+        running.set()
+        release.wait(10)
+        return first_run()
+    first.run = held
+    worker.submit(first)
+    assert running.wait(10)
+    thread = worker.threads[plan.dest_key]
+    # while the first runs, the rest wait, as one job
+    queued = [plan.job() for n in range(3)]
+    for job in queued:
+        worker.submit(job)
+    assert worker.pending == {plan.dest_key: queued[-1]}
+    assert queued[-1].merged == 2
+    release.set()
+    thread.join(10)
+    assert not thread.is_alive() and worker.threads == {}
+    assert len(fake_rsync.calls()) == 2
+    assert [job.phases is not None for job in queued] == [False, False, True]
+
+
+def test_worker_one_thread_per_destination(make_plan, fake_rsync, tmp_path):
+    worker = rsynctransfer.TransferWorker()
+    jobs = [make_plan(remote_root=str(tmp_path / name)).job()
+            for name in ('a', 'b')]
+    for job in jobs:
+        worker.submit(job)
+    for thread in list(worker.threads.values()):
+        thread.join(10)
+    assert [job.merged for job in jobs] == [0, 0]
+    assert sorted(call[-1] for call in fake_rsync.calls()) == [
+        str(tmp_path / 'a') + os.sep, str(tmp_path / 'b') + os.sep]